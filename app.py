@@ -1,12 +1,16 @@
 #app.py
 import streamlit as st
 import streamlit.components.v1 as components
+import os
+import time
 import uuid
 import json
 import random
-from pathlib import Path
-from core import build_clients, build_pipeline, generate_storybook
-from core.config import THEME_POOL
+from core import build_clients, get_pipeline, release_pipeline, warmup_pipeline, pipeline_stats, iter_storybook
+from core.config import THEME_POOL, QUALITY_PRESETS, QUALITY_PRESET, GENERATION_MODES, GENERATION_MODE, PROMPT_MODES, PROMPT_MODE
+from core.cache import IMAGE_CACHE
+from core.config import OUT_DIR
+from core.jobs import submit_job, job_status
 
 
 # Configure basic page settings
@@ -43,6 +47,57 @@ st.sidebar.markdown(
     "but the app can also run on CPU (slower)."
 )
 
+# Speed/quality trade-off for the in-session renderer (workers use their --preset)
+quality_preset = st.sidebar.selectbox(
+    "Quality preset",
+    list(QUALITY_PRESETS),
+    index=list(QUALITY_PRESETS).index(QUALITY_PRESET),
+    format_func=lambda p: f"{p} ({QUALITY_PRESETS[p]['steps']} steps)",
+    help="'draft' uses LCM-LoRA for 4-step images (fine on CPU); 'final' uses DPM++ 2M Karras with more steps.",
+)
+
+# Multi-call (streamed story + one prompt per scene) or a single JSON call
+generation_mode = st.sidebar.selectbox(
+    "Text generation",
+    list(GENERATION_MODES),
+    index=list(GENERATION_MODES).index(GENERATION_MODE),
+    help="'one_shot' writes the character, scenes and image prompts in one LLM call; "
+    "'multi_call' streams the story and writes each scene's prompt separately.",
+)
+
+# LLM-written or locally composed SD prompts (multi_call mode)
+prompt_mode = st.sidebar.selectbox(
+    "Image prompts",
+    list(PROMPT_MODES),
+    index=list(PROMPT_MODES).index(PROMPT_MODE),
+    help="'template' composes each scene's image prompt locally (no LLM call per scene); "
+    "'agent' asks the prompt agent for every scene.",
+)
+
+# Background mode: queue the book for `python -m core.jobs` workers
+use_workers = st.sidebar.checkbox(
+    "Run in background workers",
+    value=bool(os.environ.get("USE_WORKERS")),
+    help="Queue the book for the worker processes started with `python -m core.jobs` "
+    "instead of rendering it in this browser session. Workers use their own GROQ_API_KEY.",
+)
+
+
+# Load SDXL once per process in the background so the first click doesn't pay for it
+@st.cache_resource
+def _start_warmup():
+    return warmup_pipeline(os.environ.get("HF_TOKEN"), background=True)
+
+
+if os.environ.get("WARMUP_PIPELINE"):
+    _start_warmup()
+
+with st.sidebar.expander("Pipeline cache"):
+    st.json(pipeline_stats())
+
+with st.sidebar.expander("Image cache"):
+    st.json(IMAGE_CACHE.stats())
+
 # ---- Main UI ----
 st.title("🎄 Christmas Storybook Generator")
 
@@ -95,10 +150,20 @@ generate_btn = st.button("Generate Christmas storybook 🎁")
 
 # ---- Generation logic ----
 if generate_btn:
-    if not groq_api_key:
+    if not groq_api_key and not use_workers:
         st.error("Please provide your GROQ API key in the sidebar before generating.")
     elif not keywords.strip():
         st.error("Please provide at least one theme or keyword.")
+    elif use_workers:
+        job_id = submit_job(
+            name=child_name,
+            age=int(child_age),
+            keywords=keywords,
+            generation_mode=generation_mode,
+            prompt_mode=prompt_mode,
+        )
+        # Keep the job in the URL so the page can pick it up again after a reload
+        st.query_params["job"] = job_id
     else:
         story_id = str(uuid.uuid4())[:8]
 
@@ -106,120 +171,101 @@ if generate_btn:
         with st.spinner("Building LLM agents (story + prompt writer)..."):
             story_agent, prompt_agent = build_clients(groq_api_key)
 
-        # 2) Build diffusion pipeline
+        # 2) Get the shared diffusion pipeline (loaded once per process)
         with st.spinner("Loading image generation pipeline (this may take a while)..."):
-            pipe = build_pipeline(hf_token or None)
-
-        # 3) Generate story, scenes and images (+ HTML grid)
-        with st.spinner("Generating story and illustrations..."):
-            result = generate_storybook(
+            pipe = get_pipeline(hf_token or None, preset=quality_preset)
+
+        # 3) Generate story, scenes and images, drawing each slide as soon as it is rendered
+        status = st.status("Writing the story...", expanded=False)
+        info_slot = st.container()
+        live_slot = st.empty()
+        result = None
+        try:
+            live = live_slot.container()
+            row = None
+            for event in iter_storybook(
                 story_agent=story_agent,
                 prompt_agent=prompt_agent,
                 pipe=pipe,
                 name=child_name,
                 age=int(child_age),
                 keywords=keywords,
-                story_id=story_id, 
-            )
-
-        st.success("Storybook generated successfully!")
-
-        # Title: Name (age): theme - id
-        display_title = f"{child_name} ({int(child_age)}): {keywords} - {story_id}"
-        
-
-        # ---- Story info ----
-        st.subheader("Story info")
-        st.markdown(
-            f"""
+                story_id=story_id,
+                generation_mode=generation_mode,
+                prompt_mode=prompt_mode,
+            ):
+                if event["type"] == "story":
+                    with info_slot:
+                        # ---- Story info ----
+                        st.subheader("Story info")
+                        st.markdown(
+                            f"""
 **Child:** {child_name} ({int(child_age)} years old)  
 **Themes:** {keywords}
 """
-        )
-        st.divider()
-
-        col1, col2 = st.columns([1, 2])
-
-        with col1:
-            st.subheader("Character")
-            st.write(result["character_desc"])
-
-        with col2:
-            st.subheader("Full story")
-            story_text = result["story"].replace("[SCENE_BREAK]", "\n")
-            st.write(story_text)
-
-        st.divider()
-
-        import base64
-        BASE_DIR = Path(__file__).resolve().parent
-
-        slides_b64 = []
-        for img_path in result["image_paths"]:
-            full_path = (BASE_DIR / img_path).resolve()
-            with open(full_path, "rb") as f:
-                b = f.read()
-            slides_b64.append(base64.b64encode(b).decode())
-
-        name = child_name
-        scenes = result["scenes"]
-
-        html = f"""
-        <style>
-          .container {{ max-width: 2400px; margin: 30px auto; padding: 0 20px; }}
-          .title {{ text-align: center; font-size: 36px; font-weight: bold; margin-bottom: 40px;
-                    background: linear-gradient(135deg, #667eea, #764ba2); -webkit-background-clip: text;
-                    -webkit-text-fill-color: transparent; }}
-          .grid {{ display: grid; grid-template-columns: repeat(4, 1fr); gap: 20px; }}
-          .card {{ position: relative; border-radius: 12px; overflow: hidden;
-                   box-shadow: 0 8px 25px rgba(0,0,0,0.12); background: #fff; }}
-          .card img {{ width: 100%; height: auto; display: block; }}
-          .caption {{
-              position: absolute;
-              bottom: 0; left: 0; right: 0;
-              padding: 12px 16px;
-              color: #fff;
-              font-weight: 800;
-              font-size: 16px;
-              line-height: 1.3;
-              text-shadow:
-                -2px -2px 0 rgba(0,0,0,0.8),
-                 2px -2px 0 rgba(0,0,0,0.8),
-                -2px  2px 0 rgba(0,0,0,0.8),
-                 2px  2px 0 rgba(0,0,0,0.8);
-          }}
-          .counter {{
-              position: absolute;
-              bottom: 8px; right: 12px;
-              font-size: 14px; font-weight: 900;
-              color: #e6f5ff;
-              text-shadow:
-                -1px -1px 0 rgba(0,0,0,0.9),
-                 1px -1px 0 rgba(0,0,0,0.9),
-                -1px  1px 0 rgba(0,0,0,0.9),
-                 1px  1px 0 rgba(0,0,0,0.9);
-          }}
-          @media (max-width: 1600px) {{ .grid {{ grid-template-columns: repeat(3, 1fr); }} .caption {{ font-size: 15px; }} }}
-          @media (max-width: 1200px) {{ .grid {{ grid-template-columns: repeat(2, 1fr); }} .caption {{ font-size: 14px; }} }}
-          @media (max-width: 700px)  {{ .grid {{ grid-template-columns: 1fr; }} .caption {{ font-size: 13px; }} }}
-        </style>
-
-        <div class="container">
-          <div class="title">Personalized AI Story for {name}</div>
-          <div class="grid">
-            {''.join([f'''
-              <div class="card">
-                <img src="data:image/png;base64,{img}">
-                <div class="caption">
-                  {scenes[i]}
-                  <div class="counter">{i+1}/{len(slides_b64)}</div>
-                </div>
-              </div>
-            ''' for i, img in enumerate(slides_b64)])}
-          </div>
-        </div>
-        """
+                        )
+                        st.divider()
+
+                        col1, col2 = st.columns([1, 2])
+
+                        with col1:
+                            st.subheader("Character")
+                            st.write(event["character_desc"])
+
+                        with col2:
+                            st.subheader("Full story")
+                            story_text = event["story"].replace("[SCENE_BREAK]", "\n")
+                            st.write(story_text)
+
+                        st.divider()
+                    status.update(label=f"Illustrating {len(event['scenes'])} scenes...")
+
+                elif event["type"] == "scene":
+                    # total is None while the story is still being written
+                    count = f"{event['index']}/{event['total'] or '…'}"
+                    if (event["index"] - 1) % 4 == 0:
+                        row = live.columns(4)
+                    row[(event["index"] - 1) % 4].image(
+                        event["image"],
+                        caption=f"{count} {event['scene']}",
+                    )
+                    status.update(label=f"Illustrated scene {count}...")
+
+                elif event["type"] == "done":
+                    result = event["result"]
+        finally:
+            release_pipeline(pipe)
+
+        status.update(label="Storybook generated successfully!", state="complete")
+        live_slot.empty()
+
+        # Same grid generate_storybook already built from the in-memory PNGs
+        html = result["html"]
 
         components.html(html, height=3000, scrolling=True)
 
 
+# ---- Background job status ----
+job_id = st.query_params.get("job")
+if job_id and not (generate_btn and not use_workers):
+    job = job_status(job_id)
+    if job is None:
+        st.warning(f"Unknown job {job_id}.")
+    elif job["status"] in ("queued", "running"):
+        total = job["total"] or 0
+        label = "Waiting for a free worker..." if job["status"] == "queued" else (
+            f"Illustrated {job['progress']}/{total} scenes..." if total else "Writing the story..."
+        )
+        st.progress(job["progress"] / total if total else 0.0, text=f"Storybook {job_id}: {label}")
+        time.sleep(2)
+        st.rerun()
+    elif job["status"] == "failed":
+        st.error(f"Storybook {job_id} failed:\n\n{job['error']}")
+    else:
+        record = json.loads((OUT_DIR / job_id / "story.json").read_text(encoding="utf-8"))
+        st.success(f"Storybook {job_id} is ready (also listed in the Stories history page).")
+        st.subheader("Character")
+        st.write(record["character_desc"])
+        cols = st.columns(4)
+        for i, (scene, img_path) in enumerate(zip(record["scenes"], record["image_paths"])):
+            cols[i % 4].image(img_path, caption=f"{i + 1}/{len(record['scenes'])} {scene}")
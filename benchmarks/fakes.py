@@ -0,0 +1,189 @@
+#benchmarks/fakes.py
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import torch
+from diffusers import AutoencoderKL, EulerDiscreteScheduler, StableDiffusionXLPipeline, UNet2DConditionModel
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
+
+_WORDS = (
+    "snow sleigh lantern cocoa reindeer elf cookie ribbon star bell mitten "
+    "pine candle chimney sled owl fox scarf present village"
+).split()
+
+
+class FakeAgent:
+    # Stands in for a datapizza Agent: same run() -> .text contract, answers
+    # derived from a hash of the prompt, so every run sees identical text.
+
+    def __init__(self, name: str, scenes: int = 12, latency: float = 0.0):
+        self.name = name
+        self.scenes = scenes
+        self.latency = latency
+
+    def _rng(self, prompt: str) -> random.Random:
+        return random.Random(hashlib.sha256(prompt.encode("utf-8")).hexdigest())
+
+    def run(self, task_input: str, *args, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._reply(task_input)
+
+    async def a_run(self, task_input: str, *args, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._reply(task_input)
+
+    async def a_stream(self, task_input: str):
+        # Same answer as a_run, in word-sized deltas spread over `latency`
+        chunks = re.findall(r"\S+\s*", self._reply(task_input).text)
+        for chunk in chunks:
+            if self.latency:
+                await asyncio.sleep(self.latency / len(chunks))
+            yield SimpleNamespace(delta=chunk)
+
+    def _reply(self, task_input: str):
+        rng = self._rng(task_input)
+
+        if '"character_desc"' in task_input:
+            # one_shot mode: the whole book as one JSON object
+            character = self._reply("character").text
+            scenes = [
+                f"The {rng.choice(_WORDS)} and the {rng.choice(_WORDS)} found a {rng.choice(_WORDS)} by the {rng.choice(_WORDS)}."
+                for _ in range(self.scenes)
+            ]
+            text = json.dumps({
+                "character_desc": character,
+                "scenes": [
+                    {"text": scene, "prompt": f"{scene} {character} cozy watercolor storybook illustration, warm candlelight"}
+                    for scene in scenes
+                ],
+            })
+        elif "[SCENE_BREAK]" in task_input:
+            scenes = [
+                f"The {rng.choice(_WORDS)} and the {rng.choice(_WORDS)} found a {rng.choice(_WORDS)} by the {rng.choice(_WORDS)}."
+                for _ in range(self.scenes)
+            ]
+            text = " [SCENE_BREAK] ".join(scenes) + " [SCENE_BREAK]"
+        elif "Stable Diffusion prompt" in task_input:
+            scene = re.search(r'"""(.*?)"""', task_input, re.S)
+            scene = scene.group(1).strip() if scene else ""
+            text = f"{scene} child in a red scarf and green mittens, cozy watercolor storybook illustration, warm candlelight"
+        else:
+            text = "A small child with curly brown hair, freckles, a red knitted sweater, blue jeans, snow boots and a striped scarf."
+        return SimpleNamespace(text=text)
+
+
+def _bytes_to_unicode() -> dict[int, str]:
+    # CLIP's byte -> printable character table (transformers 5 no longer
+    # exports it)
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return dict(zip(bs, map(chr, cs)))
+
+
+def _tiny_tokenizer(path: Path) -> CLIPTokenizer:
+    # Byte-level vocab with no merges: every character is a token. Built on
+    # disk so nothing has to be downloaded.
+    path.mkdir(parents=True, exist_ok=True)
+    chars = list(_bytes_to_unicode().values())
+    vocab = {c: i for i, c in enumerate(chars)}
+    vocab.update({c + "</w>": i + len(chars) for i, c in enumerate(chars)})
+    vocab["<|startoftext|>"] = len(vocab)
+    vocab["<|endoftext|>"] = len(vocab)
+    # Written atomically: DevicePool replicas build this at the same time
+    for name, text in (("vocab.json", json.dumps(vocab)), ("merges.txt", "#version: 0.2\n")):
+        tmp = path / f"{name}.{os.getpid()}.tmp"
+        tmp.write_text(text, encoding="utf-8")
+        os.replace(tmp, path / name)
+    # SDXL pads prompts to model_max_length; CLIP's context is 77 tokens
+    return CLIPTokenizer(str(path / "vocab.json"), str(path / "merges.txt"), model_max_length=77)
+
+
+def build_tiny_sdxl(workdir: Path, seed: int = 0) -> StableDiffusionXLPipeline:
+    # Randomly initialised SDXL with the real pipeline code path (two text
+    # encoders, text_time conditioning, 8x VAE) but a few MB of weights, so it
+    # renders WIDTH x HEIGHT images on a CPU in well under a second per step.
+    torch.manual_seed(seed)
+    tokenizer = _tiny_tokenizer(Path(workdir) / "tiny-tokenizer")
+
+    text_config = CLIPTextConfig(
+        vocab_size=len(tokenizer),
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        hidden_size=32,
+        intermediate_size=37,
+        num_attention_heads=4,
+        num_hidden_layers=5,
+        projection_dim=32,
+        hidden_act="gelu",
+    )
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        attention_head_dim=(2, 4),
+        use_linear_projection=True,
+        addition_embed_type="text_time",
+        addition_time_embed_dim=8,
+        transformer_layers_per_block=(1, 1),
+        # 6 time ids * addition_time_embed_dim + text_encoder_2 projection_dim
+        projection_class_embeddings_input_dim=6 * 8 + 32,
+        cross_attention_dim=64,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=(16, 16, 16, 16),
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        layers_per_block=1,
+        norm_num_groups=8,
+        latent_channels=4,
+        sample_size=128,
+    )
+    scheduler = EulerDiscreteScheduler(
+        beta_start=0.00085,
+        beta_end=0.012,
+        beta_schedule="scaled_linear",
+        steps_offset=1,
+        timestep_spacing="leading",
+    )
+
+    pipe = StableDiffusionXLPipeline(
+        vae=vae,
+        text_encoder=CLIPTextModel(text_config),
+        text_encoder_2=CLIPTextModelWithProjection(text_config),
+        tokenizer=tokenizer,
+        tokenizer_2=tokenizer,
+        unet=unet,
+        scheduler=scheduler,
+        add_watermarker=False,
+    )
+    pipe.register_to_config(_name_or_path="benchmarks/tiny-sdxl")
+    pipe.set_progress_bar_config(disable=True)
+    return pipe.to("cpu")
+
+
+def tiny_pipeline(workdir: Path, seed: int = 0, preset: str = "standard") -> StableDiffusionXLPipeline:
+    # Picklable factory for DevicePool replicas: each process builds the same
+    # tiny pipeline from the same seed
+    from core.pipeline import with_preset
+
+    return with_preset(build_tiny_sdxl(workdir, seed=seed), preset)
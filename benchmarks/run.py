@@ -0,0 +1,169 @@
+#benchmarks/run.py
+import argparse
+import functools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import torch
+
+from core.config import GENERATION_MODES, PROMPT_MODES, QUALITY_PRESETS
+from core.devices import DevicePool
+from core.media import MEDIA_DIR
+from core.pipeline import peak_rss_bytes
+from core.storybook import generate_storybook
+from core.tracing import recording
+from .fakes import FakeAgent, tiny_pipeline
+
+
+def run_benchmark(
+    books: int = 2,
+    scenes: int = 12,
+    preset: str = "standard",
+    generation_mode: str = "multi_call",
+    prompt_mode: str = "agent",
+    llm_latency: float = 0.0,
+    seed: int = 0,
+    workdir: Path | None = None,
+    devices: int = 0,
+) -> dict:
+    # Runs in a scratch directory so the image cache, outputs and catalog start
+    # empty; every book gets its own name and seeds, so nothing is a cache hit.
+    workdir = Path(workdir or tempfile.mkdtemp(prefix="storybook-bench-")).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+
+    story_ids = []
+    pipe = None
+    try:
+        if devices:
+            # CPU replicas in their own processes, each on a slice of the cores
+            pipe = DevicePool(["cpu"] * devices, preset=preset, factory=functools.partial(tiny_pipeline, workdir, seed, preset))
+        else:
+            pipe = tiny_pipeline(workdir, seed, preset)
+        story_agent = FakeAgent("story", scenes=scenes, latency=llm_latency)
+        prompt_agent = FakeAgent("prompt", scenes=scenes, latency=llm_latency)
+
+        def book(i: int, story_id: str):
+            story_ids.append(story_id)
+            return generate_storybook(
+                story_agent=story_agent,
+                prompt_agent=prompt_agent,
+                pipe=pipe,
+                name=f"Bench{i}",
+                age=7,
+                keywords="snow, reindeer, cocoa",
+                story_id=story_id,
+                seed=seed + i * 1000,
+                generation_mode=generation_mode,
+                prompt_mode=prompt_mode,
+            )
+
+        # One unrecorded book pays for lazy imports, allocator and thread pool start-up
+        book(0, "bench-warmup")
+
+        images = 0
+        with recording() as recorder:
+            start = time.perf_counter()
+            for i in range(1, books + 1):
+                images += len(book(i, f"bench-{i:03d}")["image_paths"])
+            wall = time.perf_counter() - start
+    finally:
+        if isinstance(pipe, DevicePool):
+            pipe.close()
+        os.chdir(cwd)
+        for story_id in story_ids:
+            shutil.rmtree(MEDIA_DIR / story_id, ignore_errors=True)
+
+    return {
+        "benchmark": "storybook",
+        "config": {
+            "books": books,
+            "scenes": scenes,
+            "preset": preset,
+            "steps": QUALITY_PRESETS[preset]["steps"],
+            "generation_mode": generation_mode,
+            "prompt_mode": prompt_mode,
+            "devices": devices,
+            "llm_latency": llm_latency,
+            "torch_threads": torch.get_num_threads(),
+            "workdir": str(workdir),
+        },
+        "books": books,
+        "images": images,
+        "wall_seconds": round(wall, 3),
+        "seconds_per_book": round(wall / books, 3),
+        "images_per_second": round(images / wall, 3),
+        "peak_rss_mb": round(peak_rss_bytes() / 1024**2, 1),
+        "stages": recorder.report(),
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    # A metric regresses when it is more than `tolerance` (relative) slower
+    regressions = []
+    checks = [("seconds_per_book", report["seconds_per_book"], baseline.get("seconds_per_book"))]
+    for name, stage in report["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if base:
+            checks.append((f"stages.{name}.mean_seconds", stage["mean_seconds"], base["mean_seconds"]))
+
+    for name, value, base in checks:
+        if base and value > base * (1 + tolerance):
+            regressions.append(f"{name}: {value} vs baseline {base} (+{(value / base - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline end-to-end storybook benchmark (fake LLM, tiny random SDXL, CPU).")
+    parser.add_argument("--books", type=int, default=2)
+    parser.add_argument("--scenes", type=int, default=12)
+    parser.add_argument("--preset", default="standard", choices=sorted(QUALITY_PRESETS))
+    parser.add_argument("--generation-mode", default="multi_call", choices=GENERATION_MODES)
+    parser.add_argument("--prompt-mode", default="agent", choices=PROMPT_MODES)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds each fake LLM call sleeps.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--devices", type=int, default=0, help="Render on a DevicePool of N CPU replica processes.")
+    parser.add_argument("--threads", type=int, help="torch.set_num_threads, for comparable numbers across boxes.")
+    parser.add_argument("--workdir", type=Path, help="Keep outputs here instead of a deleted temp dir.")
+    parser.add_argument("--out", type=Path, help="Also write the JSON report to this file.")
+    parser.add_argument("--baseline", type=Path, help="Earlier report; exit 1 if anything regressed past --tolerance.")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    report = run_benchmark(
+        books=args.books,
+        scenes=args.scenes,
+        preset=args.preset,
+        generation_mode=args.generation_mode,
+        prompt_mode=args.prompt_mode,
+        llm_latency=args.llm_latency,
+        seed=args.seed,
+        workdir=args.workdir,
+        devices=args.devices,
+    )
+    if args.workdir is None:
+        shutil.rmtree(report["config"]["workdir"], ignore_errors=True)
+
+    regressions = []
+    if args.baseline:
+        regressions = compare(report, json.loads(args.baseline.read_text(encoding="utf-8")), args.tolerance)
+        report["regressions"] = regressions
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        args.out.write_text(text + "\n", encoding="utf-8")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,25 @@
 #core/__init__.py
-from .clients import build_clients
-from .pipeline import build_pipeline
-from .storybook import generate_storybook
+import importlib
 
-__all__ = ["build_clients", "build_pipeline", "generate_storybook"]
+# Public name -> submodule. Loaded on first use, so the SQLite/PIL helpers
+# (cache, catalog, jobs, media) import without datapizza, torch or diffusers.
+_EXPORTS = {
+    "build_clients": "clients",
+    "build_pipeline": "pipeline",
+    "get_pipeline": "pipeline",
+    "release_pipeline": "pipeline",
+    "warmup_pipeline": "pipeline",
+    "pipeline_stats": "pipeline",
+    "DevicePool": "devices",
+    "generate_storybook": "storybook",
+    "iter_storybook": "storybook",
+    "regenerate_scene": "storybook",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(f".{_EXPORTS[name]}", __name__), name)
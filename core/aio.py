@@ -0,0 +1,44 @@
+#core/aio.py
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import Future
+
+# One long-lived event loop thread for all LLM I/O. The async OpenAI clients
+# (and their keep-alive connections) stay bound to it, and requests from every
+# session and thread meet there, so identical ones can be coalesced.
+_LOOP = None
+_THREAD = None
+_LOCK = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _LOOP, _THREAD
+    with _LOCK:
+        if _LOOP is None:
+            loop = asyncio.new_event_loop()
+            _THREAD = threading.Thread(target=loop.run_forever, name="llm-loop", daemon=True)
+            _THREAD.start()
+            _LOOP = loop
+    return _LOOP
+
+
+async def _with_context(values: list, coro):
+    # Tasks on the loop thread start from that thread's context; carry over the
+    # caller's context variables (e.g. the story trace) explicitly.
+    for var, value in values:
+        var.set(value)
+    return await coro
+
+
+def submit(coro) -> Future:
+    values = list(contextvars.copy_context().items())
+    return asyncio.run_coroutine_threadsafe(_with_context(values, coro), get_loop())
+
+
+def run(coro):
+    # Blocking bridge for sync callers
+    if threading.current_thread() is _THREAD:
+        coro.close()
+        raise RuntimeError("aio.run() would deadlock on the LLM loop thread; await the coroutine instead.")
+    return submit(coro).result()
@@ -0,0 +1,65 @@
+#core/assets.py
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from PIL import Image
+
+from .cache import IMAGE_CACHE
+from .tracing import bind, stage
+
+# PNG encoding (zlib) releases the GIL, so it runs here while the UNet renders the next batch
+_ENCODER = ThreadPoolExecutor(max_workers=2, thread_name_prefix="png-encode")
+
+
+def encode_png(image: Image.Image) -> bytes:
+    with stage("png_encode"):
+        buf = BytesIO()
+        image.save(buf, format="PNG")
+        return buf.getvalue()
+
+
+def _encode_and_store(image: Image.Image, key: str, cache) -> bytes:
+    png = encode_png(image)
+    if cache is not None:
+        cache.put_bytes(key, png)
+    return png
+
+
+class SceneAsset:
+    # One rendered illustration, PNG-encoded exactly once. The same bytes feed
+    # the image cache and the story PNG on disk; the thumbnails and the PDF
+    # exporter use the in-memory image directly.
+
+    def __init__(self, image: Image.Image, prompt: str, key: str, seed: int | None, png: bytes | Future):
+        self.image = image
+        self.prompt = prompt
+        self.key = key
+        self.seed = seed
+        self._png = png
+
+    @classmethod
+    def rendered(cls, image: Image.Image, prompt: str, key: str, seed: int | None, cache=IMAGE_CACHE):
+        return cls(image, prompt, key, seed, _ENCODER.submit(bind(_encode_and_store), image, key, cache))
+
+    @classmethod
+    def from_png(cls, png: bytes, prompt: str, key: str, seed: int | None):
+        image = Image.open(BytesIO(png))
+        image.load()
+        return cls(image, prompt, key, seed, png)
+
+    @property
+    def png(self) -> bytes:
+        if isinstance(self._png, Future):
+            self._png = self._png.result()
+        return self._png
+
+    def save(self, path: Path, cache=IMAGE_CACHE):
+        # Hard-link the cached PNG so repeated scenes share one file across stories.
+        # Story PNGs may be links into the cache, so never write through them.
+        png = self.png
+        if cache is not None and cache.link(self.key, path):
+            return
+        path = Path(path)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_bytes(png)
+        tmp.replace(path)
@@ -0,0 +1,145 @@
+#core/batch.py
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+import traceback
+from pathlib import Path
+
+from .config import *
+
+
+def read_manifest(path: Path) -> list[dict]:
+    path = Path(path)
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.suffix.lower() in (".jsonl", ".ndjson"):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+
+    books = []
+    for i, row in enumerate(rows, 1):
+        missing = [k for k in ("name", "age", "keywords") if not str(row.get(k) or "").strip()]
+        if missing:
+            raise ValueError(f"{path}: row {i} is missing {', '.join(missing)}")
+        books.append({
+            "story_id": str(row.get("id") or "").strip() or manifest_story_id(row),
+            "name": str(row["name"]).strip(),
+            "age": int(row["age"]),
+            "keywords": str(row["keywords"]).strip(),
+        })
+    return books
+
+
+def manifest_story_id(row: dict) -> str:
+    # Stable id per (name, age, keywords) so a re-run finds the books it already made
+    payload = json.dumps([str(row["name"]).strip(), int(row["age"]), str(row["keywords"]).strip()], ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:8]
+
+
+def is_finished(story_id: str) -> bool:
+    return (Path(OUT_DIR) / story_id / "story.json").exists()
+
+
+def run_batch(
+    books: list[dict],
+    groq_api_key: str,
+    hf_token: str | None = None,
+    fail_fast: bool = False,
+    log=print,
+    preset: str = QUALITY_PRESET,
+    backend: str = INFERENCE_BACKEND,
+    generation_mode: str = GENERATION_MODE,
+    prompt_mode: str = PROMPT_MODE,
+    devices: list[str] | None = None,
+) -> dict:
+    from .clients import build_clients
+    from .pipeline import get_pipeline, release_pipeline
+    from .storybook import generate_storybook
+
+    todo = [b for b in books if not is_finished(b["story_id"])]
+    log(f"{len(books)} books in manifest, {len(books) - len(todo)} already done, {len(todo)} to generate")
+
+    stats = {"books": 0, "images": 0, "failed": [], "skipped": len(books) - len(todo)}
+    if not todo:
+        return stats
+
+    story_agent, prompt_agent = build_clients(groq_api_key)
+    if devices:
+        # One pipeline replica per device; each book's scenes are spread over them
+        from .devices import DevicePool, detect_devices
+
+        pipe = DevicePool(detect_devices() if devices == ["auto"] else devices, hf_token, preset=preset, backend=backend)
+    else:
+        pipe = get_pipeline(hf_token, preset=preset, backend=backend)
+
+    start = time.perf_counter()
+    try:
+        for n, book in enumerate(todo, 1):
+            try:
+                result = generate_storybook(
+                    story_agent=story_agent,
+                    prompt_agent=prompt_agent,
+                    pipe=pipe,
+                    generation_mode=generation_mode,
+                    prompt_mode=prompt_mode,
+                    **book,
+                )
+            except Exception:
+                if fail_fast:
+                    raise
+                stats["failed"].append(book["story_id"])
+                log(f"[{n}/{len(todo)}] {book['story_id']} FAILED\n{traceback.format_exc()}")
+                continue
+
+            stats["books"] += 1
+            stats["images"] += len(result["image_paths"])
+            elapsed = time.perf_counter() - start
+            log(
+                f"[{n}/{len(todo)}] {book['story_id']} done: "
+                f"{stats['books'] / elapsed * 3600:.1f} books/h, {stats['images'] / elapsed:.3f} images/s"
+            )
+    finally:
+        if devices:
+            pipe.close()
+        else:
+            release_pipeline(pipe)
+
+    elapsed = time.perf_counter() - start
+    stats["seconds"] = round(elapsed, 1)
+    stats["books_per_hour"] = round(stats["books"] / elapsed * 3600, 2)
+    stats["images_per_second"] = round(stats["images"] / elapsed, 4)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate storybooks from a CSV/JSONL manifest of name, age, keywords.")
+    parser.add_argument("manifest", type=Path, help="CSV with a header row, or JSONL; optional 'id' column.")
+    parser.add_argument("--groq-api-key", default=os.environ.get("GROQ_API_KEY"))
+    parser.add_argument("--hf-token", default=os.environ.get("HF_TOKEN"))
+    parser.add_argument("--limit", type=int, help="Only process the first N rows of the manifest.")
+    parser.add_argument("--preset", default=QUALITY_PRESET, choices=sorted(QUALITY_PRESETS), help="Speed/quality preset for every book.")
+    parser.add_argument("--backend", default=INFERENCE_BACKEND, choices=INFERENCE_BACKENDS, help="Inference backend for the pipeline.")
+    parser.add_argument("--generation-mode", default=GENERATION_MODE, choices=GENERATION_MODES, help="How the story and prompts are written.")
+    parser.add_argument("--prompt-mode", default=PROMPT_MODE, choices=PROMPT_MODES, help="'template' builds SD prompts locally, with no prompt-agent calls.")
+    parser.add_argument("--devices", nargs="+", help="Render on a pool of pipeline replicas, e.g. 'cuda:0 cuda:1', 'cpu cpu' or 'auto'.")
+    parser.add_argument("--fail-fast", action="store_true", help="Stop at the first failed book.")
+    args = parser.parse_args(argv)
+
+    if not args.groq_api_key:
+        parser.error("a GROQ API key is required (--groq-api-key or GROQ_API_KEY)")
+
+    books = read_manifest(args.manifest)
+    if args.limit is not None:
+        books = books[:args.limit]
+
+    stats = run_batch(books, args.groq_api_key, args.hf_token or None, fail_fast=args.fail_fast, preset=args.preset, backend=args.backend, generation_mode=args.generation_mode, prompt_mode=args.prompt_mode, devices=args.devices)
+    print(json.dumps(stats, indent=2))
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
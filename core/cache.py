@@ -0,0 +1,172 @@
+#core/cache.py
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import closing
+from io import BytesIO
+from pathlib import Path
+from PIL import Image
+
+from .config import *
+from .db import connect
+
+
+def image_cache_key(
+    prompt: str,
+    negative_prompt: str,
+    seed: int | None,
+    steps: int,
+    guidance: float,
+    width: int,
+    height: int,
+    model_id: str,
+    sampler: str | None = None,
+) -> str:
+    # sampler (scheduler / LoRA) is only part of the key when set, so images
+    # rendered with the model's default sampler keep their existing keys
+    fields = [prompt, negative_prompt, seed, steps, guidance, width, height, model_id]
+    if sampler is not None:
+        fields.append(sampler)
+    payload = json.dumps(fields, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ImageCache:
+    # Content-addressed PNG store: <root>/<key[:2]>/<key>.png. Recency lives in
+    # a sidecar SQLite index (<root>/index.sqlite3), so LRU order survives
+    # restarts and is shared by every process. The PNGs themselves are never
+    # touched on a hit: story PNGs are hard links to the same inodes.
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.png"
+
+    def _entries(self):
+        return self.root.glob("*/*.png")
+
+    def _index(self):
+        conn = connect(self.root / "index.sqlite3")
+        conn.execute("CREATE TABLE IF NOT EXISTS used (key TEXT PRIMARY KEY, at REAL NOT NULL)")
+        return conn
+
+    def _touch(self, key: str):
+        with closing(self._index()) as conn:
+            conn.execute("INSERT OR REPLACE INTO used (key, at) VALUES (?, ?)", (key, time.time()))
+
+    def _total_size(self) -> int:
+        if self._size is None:
+            self._size = sum(p.stat().st_size for p in self._entries())
+        return self._size
+
+    def get_bytes(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        self._touch(key)
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def get(self, key: str) -> Image.Image | None:
+        data = self.get_bytes(key)
+        if data is None:
+            return None
+        img = Image.open(BytesIO(data))
+        img.load()
+        return img
+
+    def put_bytes(self, key: str, data: bytes) -> Path:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write next to the target and rename, so readers never see half a PNG
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            with self._lock:
+                # Only the change in size counts, so an overwrite adds nothing twice
+                old = path.stat().st_size if path.exists() else 0
+                os.replace(tmp, path)
+                if self._size is None:
+                    self._total_size()
+                else:
+                    self._size += len(data) - old
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+        self._touch(key)
+        with self._lock:
+            self._evict()
+        return path
+
+    def put(self, key: str, image: Image.Image) -> Path:
+        buf = BytesIO()
+        image.save(buf, format="PNG")
+        return self.put_bytes(key, buf.getvalue())
+
+    def link(self, key: str, dest: Path) -> bool:
+        # Materialize a cached image at dest as a hard link (copy if the
+        # filesystem can't link), so identical scenes share one file on disk.
+        src = self._path(key)
+        if not src.exists():
+            return False
+        dest = Path(dest)
+        tmp = dest.with_name(dest.name + ".tmp")
+        tmp.unlink(missing_ok=True)
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+        return True
+
+    def _evict(self):
+        if self._size <= self.max_bytes:
+            return
+        with closing(self._index()) as conn:
+            used = {row["key"]: row["at"] for row in conn.execute("SELECT key, at FROM used")}
+            # Files from before the index existed fall back to their mtime
+            entries = []
+            for path in self._entries():
+                stat = path.stat()
+                entries.append((used.get(path.stem, stat.st_mtime), stat.st_size, path))
+            entries.sort(key=lambda e: e[0])
+            evicted = []
+            for _, size, path in entries:
+                if self._size <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                self._size -= size
+                self.evictions += 1
+                evicted.append((path.stem,))
+            conn.executemany("DELETE FROM used WHERE key = ?", evicted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bytes": self._total_size(),
+                "max_bytes": self.max_bytes,
+            }
+
+
+IMAGE_CACHE = ImageCache(IMAGE_CACHE_DIR, int(IMAGE_CACHE_MAX_GB * 1024**3))
@@ -0,0 +1,156 @@
+#core/catalog.py
+import argparse
+import json
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+
+from .config import *
+from .db import connect
+
+
+def _init_db(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stories (
+            id TEXT PRIMARY KEY,
+            display_title TEXT NOT NULL,
+            name TEXT NOT NULL,
+            age INTEGER,
+            keywords TEXT,
+            created REAL NOT NULL,
+            path TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS stories_created ON stories(created)")
+    try:
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS stories_fts USING fts5(id UNINDEXED, name, keywords, story)"
+        )
+    except sqlite3.OperationalError:
+        # SQLite built without FTS5: search falls back to LIKE on name/keywords
+        pass
+
+
+def _has_fts(conn) -> bool:
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'stories_fts'").fetchone()
+    return row is not None
+
+
+def _connect():
+    conn = connect(CATALOG_PATH)
+    _init_db(conn)
+    return conn
+
+
+def _index(conn, record: dict, path: Path, created: float):
+    story_id = record["id"]
+    title = record.get("display_title") or f"{record['name']} ({record['age']} y) – {story_id}"
+    conn.execute(
+        "INSERT OR REPLACE INTO stories (id, display_title, name, age, keywords, created, path) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (story_id, title, record["name"], record.get("age"), record.get("keywords", ""), created, str(path)),
+    )
+    if _has_fts(conn):
+        conn.execute("DELETE FROM stories_fts WHERE id = ?", (story_id,))
+        conn.execute(
+            "INSERT INTO stories_fts (id, name, keywords, story) VALUES (?, ?, ?, ?)",
+            (story_id, record["name"], record.get("keywords", ""), record.get("story", "").replace("[SCENE_BREAK]", " ")),
+        )
+
+
+def index_story(record: dict, path: Path):
+    path = Path(path).resolve()
+    with closing(_connect()) as conn:
+        _index(conn, record, path, path.stat().st_mtime)
+
+
+def rebuild_catalog(out_dir: Path = OUT_DIR) -> int:
+    # Backfills the catalog from every outputs/<id>/story.json on disk
+    count = 0
+    with closing(_connect()) as conn:
+        conn.execute("BEGIN")
+        conn.execute("DELETE FROM stories")
+        if _has_fts(conn):
+            conn.execute("DELETE FROM stories_fts")
+        for path in Path(out_dir).glob("*/story.json"):
+            with open(path, encoding="utf-8") as f:
+                record = json.load(f)
+            _index(conn, record, path.resolve(), path.stat().st_mtime)
+            count += 1
+        conn.execute("COMMIT")
+    return count
+
+
+def index_missing(out_dir: Path = OUT_DIR) -> int:
+    # Indexes the outputs/<id>/story.json files the catalog doesn't know yet
+    # (stories written before the catalog existed, or copied in by hand)
+    with closing(_connect()) as conn:
+        known = {row["id"] for row in conn.execute("SELECT id FROM stories")}
+        missing = [p for p in Path(out_dir).glob("*/story.json") if p.parent.name not in known]
+        if not missing:
+            return 0
+        conn.execute("BEGIN")
+        for path in missing:
+            with open(path, encoding="utf-8") as f:
+                record = json.load(f)
+            _index(conn, record, path.resolve(), path.stat().st_mtime)
+        conn.execute("COMMIT")
+    return len(missing)
+
+
+def _fts_query(query: str) -> str:
+    # Every word must match, as a prefix, anywhere in name/keywords/story
+    words = [w.replace('"', '""') for w in query.split()]
+    return " ".join(f'"{w}"*' for w in words)
+
+
+def _where(conn, query: str) -> tuple[str, tuple]:
+    query = query.strip()
+    if not query:
+        return "", ()
+    if _has_fts(conn):
+        return "WHERE id IN (SELECT id FROM stories_fts WHERE stories_fts MATCH ?)", (_fts_query(query),)
+    like = f"%{query}%"
+    return "WHERE name LIKE ? OR keywords LIKE ? OR display_title LIKE ?", (like, like, like)
+
+
+def search_stories(query: str = "", limit: int = 20, offset: int = 0) -> list[dict]:
+    with closing(_connect()) as conn:
+        where, params = _where(conn, query)
+        rows = conn.execute(
+            f"SELECT id, display_title, name, age, keywords, created, path FROM stories {where} "
+            "ORDER BY created DESC LIMIT ? OFFSET ?",
+            (*params, limit, offset),
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def count_stories(query: str = "") -> int:
+    with closing(_connect()) as conn:
+        where, params = _where(conn, query)
+        return conn.execute(f"SELECT COUNT(*) FROM stories {where}", params).fetchone()[0]
+
+
+def load_story(story_id: str) -> dict | None:
+    with closing(_connect()) as conn:
+        row = conn.execute("SELECT path FROM stories WHERE id = ?", (story_id,)).fetchone()
+    if row is None or not Path(row["path"]).exists():
+        return None
+    with open(row["path"], encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the storybook catalog index.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rebuild = sub.add_parser("rebuild", help="Re-index every outputs/<id>/story.json.")
+    rebuild.add_argument("--out-dir", type=Path, default=OUT_DIR)
+    args = parser.parse_args(argv)
+
+    if args.command == "rebuild":
+        print(f"Indexed {rebuild_catalog(args.out_dir)} stories into {CATALOG_PATH}")
+
+
+if __name__ == "__main__":
+    main()
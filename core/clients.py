@@ -1,64 +1,103 @@
 #core/clients.py
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from datapizza.clients.openai import OpenAIClient
 from datapizza.agents import Agent
 from datapizza.tools import tool
 from .config import *
+from .llm_cache import CachedAgent, LLM_CACHE
+from .tracing import stage
+from .sanitizer import sanitize
+
+# Long-lived agents per (API key hash, cache options), least recently used
+# evicted past LLM_CLIENT_POOL_SIZE; one rate limiter per API key.
+_POOL: OrderedDict[tuple, tuple] = OrderedDict()
+_LIMITERS: dict[str, "TokenBucket"] = {}
+_POOL_LOCK = threading.Lock()
 
 
 @tool
 def sanitize_keywords(keywords: str) -> str:
-    replacements = {
-        "gun": "snowball blaster",
-        "guns": "snowball blasters",
-        "weapon": "magic snow wand",
-        "weapons": "magic snow wands",
-        "knife": "carving knife for gingerbread",
-        "knives": "carving knives for gingerbread",
-        "sword": "candy cane sword",
-        "swords": "candy cane swords",
-        "war": "snowball tournament",
-        "battle": "snowball battle",
-        "battles": "snowball battles",
-        "fight": "playful snowball fight",
-        "fights": "playful snowball fights",
-        "fighting": "playing with snowballs",
-        "monster": "friendly monster",
-        "monsters": "friendly monsters",
-        "demon": "grumpy snow spirit",
-        "demons": "grumpy snow spirits",
-        "ghost": "shy winter ghost",
-        "ghosts": "shy winter ghosts",
-        "zombie": "sleepy snowwalker",
-        "zombies": "sleepy snowwalkers",
-        "blood": "red cranberry sauce",
-        "gore": "messy frosting",
-        "killing": "defeating in a snowball game",
-        "kill": "defeat in a snowball game",
-        "alcohol": "hot chocolate",
-        "beer": "gingerbread soda",
-        "wine": "sparkling cranberry juice",
-        "vodka": "extra-strong hot chocolate",
-        "whisky": "spiced apple cider",
-        "whiskey": "spiced apple cider",
-        "rum": "vanilla sugar syrup",
-        "drugs": "magic Christmas candies",
-        "drug": "magic Christmas candy",
-        "smoke": "chimney smoke from cozy houses",
-        "smoking": "chimney smoke from cozy houses",
-        "death": "the end of winter",
-        "dead": "fast asleep after a long snow day",
-    }
-    out = keywords
-    for k, v in replacements.items():
-        out = out.replace(k, v).replace(k.title(), v)
-    return out
-
-
-def build_clients(groq_api_key: str):
+    return sanitize(keywords)
+
+
+class TokenBucket:
+    # Requests-per-minute and tokens-per-minute budgets, refilled continuously.
+    # Callers queue on the lock, so they are served in arrival order. Token
+    # costs are estimated up front and corrected by settle() once the real
+    # usage is known (the balance may briefly go negative).
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        self.requests = float(requests_per_minute)
+        self.tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.waited_seconds = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens: int):
+        tokens = min(tokens, self.tpm)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                wait = max((1 - self.requests) * 60 / self.rpm, (tokens - self.tokens) * 60 / self.tpm)
+                with stage("llm_rate_limit_wait"):
+                    await asyncio.sleep(wait)
+                self.waited_seconds += wait
+
+    def settle(self, estimated: int, actual: int):
+        self.tokens -= actual - estimated
+
+
+def limiter_for(groq_api_key: str) -> TokenBucket:
+    key = hashlib.sha256(groq_api_key.encode("utf-8")).hexdigest()
+    with _POOL_LOCK:
+        limiter = _LIMITERS.get(key)
+        if limiter is None:
+            limiter = _LIMITERS[key] = TokenBucket(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+    return limiter
+
+
+def build_clients(groq_api_key: str, use_cache: bool = True, cache_stories: bool = LLM_CACHE_STORIES):
+    # Pooled: every session with the same key shares one client (and its
+    # HTTP keep-alive connections), one rate limiter and the in-flight requests.
+    key = (hashlib.sha256(groq_api_key.encode("utf-8")).hexdigest(), use_cache, cache_stories)
+    with _POOL_LOCK:
+        agents = _POOL.get(key)
+        if agents is not None:
+            _POOL.move_to_end(key)
+            return agents
+
+    agents = _build_clients(groq_api_key, use_cache, cache_stories)
+    with _POOL_LOCK:
+        agents = _POOL.setdefault(key, agents)
+        _POOL.move_to_end(key)
+        while len(_POOL) > LLM_CLIENT_POOL_SIZE:
+            _POOL.popitem(last=False)
+    return agents
+
+
+def _build_clients(groq_api_key: str, use_cache: bool, cache_stories: bool):
+    model = "llama-3.3-70b-versatile"
     client = OpenAIClient(
         api_key=groq_api_key,
         base_url="https://api.groq.com/openai/v1",
-        model="llama-3.3-70b-versatile",
+        model=model,
     )
 
     story_agent = Agent(
@@ -80,4 +119,9 @@ def build_clients(groq_api_key: str):
         ),
     )
 
-    return story_agent, prompt_agent
\ No newline at end of file
+    limiter = limiter_for(groq_api_key)
+    cache = LLM_CACHE if use_cache else None
+    story_agent = CachedAgent(story_agent, model, cache, enabled=cache_stories, limiter=limiter, client=client)
+    prompt_agent = CachedAgent(prompt_agent, model, cache, limiter=limiter)
+
+    return story_agent, prompt_agent
@@ -5,14 +5,139 @@ import os
 OUT_DIR = Path("outputs")
 OUT_DIR.mkdir(exist_ok=True)
 
+CACHE_DIR = Path(".cache")
+IMAGE_CACHE_DIR = CACHE_DIR / "images"
+IMAGE_CACHE_MAX_GB = 5
+LLM_CACHE_PATH = CACHE_DIR / "llm.sqlite3"
+LLM_CACHE_TTL_DAYS = 30
+LLM_CACHE_MAX_ENTRIES = 50_000
+# Story text is not cached by default so repeated themes still get new stories
+LLM_CACHE_STORIES = False
+
+DATA_DIR = Path(".data")
+JOBS_DB_PATH = DATA_DIR / "jobs.sqlite3"
+CATALOG_PATH = DATA_DIR / "catalog.sqlite3"
+
+# Span tracing (core/tracing.py): "off" disables it, "local" writes a per-story
+# timings.json next to story.json, "otel" also emits OpenTelemetry spans.
+TRACING = os.environ.get("TRACING", "local")
+
+
+MODEL_ID = "stabilityai/stable-diffusion-xl-base-1.0"
+# Idle cached pipelines are evicted before a new load when free memory drops below this
+PIPELINE_MIN_FREE_GB = 8
+
+# How build_pipeline trades speed for memory. Offload only applies on CUDA;
+# cpu_bf16 only kicks in on CPUs with native bf16 (AVX512-BF16 / AMX).
+MEMORY_PROFILES = {
+    "fast": {
+        "offload": None, "attention_slicing": False, "vae_slicing": False,
+        "vae_tiling": False, "channels_last": True, "cpu_bf16": False,
+    },
+    "balanced": {
+        "offload": None, "attention_slicing": True, "vae_slicing": True,
+        "vae_tiling": False, "channels_last": True, "cpu_bf16": False,
+    },
+    "low-mem": {
+        "offload": "model", "attention_slicing": True, "vae_slicing": True,
+        "vae_tiling": True, "channels_last": False, "cpu_bf16": True,
+    },
+    "minimal": {
+        "offload": "sequential", "attention_slicing": True, "vae_slicing": True,
+        "vae_tiling": True, "channels_last": False, "cpu_bf16": True,
+    },
+}
+MEMORY_PROFILE = os.environ.get("MEMORY_PROFILE", "balanced")
+
+# Inference backend behind build_pipeline:
+#   eager    - plain PyTorch
+#   compile  - torch.compile on the UNet (inductor cache persisted under COMPILED_DIR)
+#   ipex     - Intel Extension for PyTorch (CPU)
+#   onnx     - ONNX Runtime via optimum[onnxruntime], exported once to COMPILED_DIR
+#   openvino - OpenVINO via optimum[openvino], exported once to COMPILED_DIR
+INFERENCE_BACKENDS = ("eager", "compile", "ipex", "onnx", "openvino")
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "eager")
+COMPILED_DIR = CACHE_DIR / "compiled"
+
 
 STEPS = 10
 GUIDANCE = 7.5
+
+# Speed/quality presets: scheduler, denoising steps and CFG scale, plus an
+# optional LoRA fused into the UNet (LCM-LoRA needs the "lcm" scheduler and
+# guidance ~1). scheduler None keeps the model's own (Euler for SDXL base).
+# Measure seconds per image on a node with `python -m core.pipeline --presets ...`.
+QUALITY_PRESETS = {
+    "draft": {"scheduler": "lcm", "steps": 4, "guidance": 1.0, "lora": "latent-consistency/lcm-lora-sdxl"},
+    "fast": {"scheduler": "euler_a", "steps": 8, "guidance": 5.0, "lora": None},
+    "standard": {"scheduler": None, "steps": STEPS, "guidance": GUIDANCE, "lora": None},
+    "balanced": {"scheduler": "unipc", "steps": 15, "guidance": 7.0, "lora": None},
+    "final": {"scheduler": "dpmpp_2m_karras", "steps": 25, "guidance": 7.5, "lora": None},
+}
+QUALITY_PRESET = os.environ.get("QUALITY_PRESET", "standard")
 WIDTH = 576
 HEIGHT = 768
 MIN_SCENES = 10
 MAX_SCENES = 15
 MAX_WORDS = 200
+# Scenes longer than this are re-split on sentence boundaries
+MAX_SCENE_CHARS = 300
+
+# PDF variants: images are downsampled to `dpi` at their printed size and
+# embedded as JPEG (`quality`) or lossless Flate. generate_storybook writes the
+# variants in PDF_EXPORT_VARIANTS; the first one is built page by page while
+# scenes render, the others in worker processes at the end.
+PDF_VARIANTS = {
+    "screen": {"dpi": 110, "image_format": "jpeg", "quality": 80, "suffix": ""},
+    "print": {"dpi": 300, "image_format": "jpeg", "quality": 92, "suffix": "_print"},
+}
+PDF_EXPORT_VARIANTS = ["screen"]
+# Worker processes for the variants after the first
+PDF_EXPORT_MAX_WORKERS = 2
+# Device pool (core/devices.py): one pipeline replica per GPU / NUMA node / CPU
+# slice, each in its own process. Replicas send a heartbeat every
+# DEVICE_HEARTBEAT_SECONDS; one silent for DEVICE_HEARTBEAT_TIMEOUT, dead, or
+# stuck on one scene for DEVICE_TASK_TIMEOUT is restarted up to
+# DEVICE_MAX_RESTARTS times and its scene requeued. A scene that fails
+# DEVICE_TASK_ATTEMPTS times fails the book.
+DEVICE_HEARTBEAT_SECONDS = 5.0
+DEVICE_HEARTBEAT_TIMEOUT = 120.0
+DEVICE_TASK_TIMEOUT = 900.0
+DEVICE_MAX_RESTARTS = 2
+DEVICE_TASK_ATTEMPTS = 2
+# Text-encoder outputs kept per loaded pipeline (~0.6 MB each at fp32)
+PROMPT_EMBED_CACHE_SIZE = 128
+# Scenes sent through the UNet together; the actual batch shrinks to fit free memory
+MAX_BATCH_SIZE = 4
+# Concurrent prompt-agent requests per book, and retries when Groq rate-limits us
+PROMPT_WORKERS = 4
+LLM_MAX_RETRIES = 5
+# Extra sanitizer terms merged over the built-in lexicon (.json or "term = replacement" lines)
+SANITIZER_LEXICON_PATH = os.environ.get("SANITIZER_LEXICON") or None
+# Token-bucket budget per GROQ API key; match your Groq plan's limits for the
+# model (these are the free-tier ones for llama-3.3-70b-versatile)
+LLM_REQUESTS_PER_MINUTE = 30
+LLM_TOKENS_PER_MINUTE = 12_000
+# API keys whose clients (and keep-alive connections) are kept warm
+LLM_CLIENT_POOL_SIZE = 16
+# How the book's text is written:
+#   multi_call - streamed story, then a character description and one prompt
+#                request per scene (2 + N calls)
+#   one_shot   - character, scenes and per-scene prompts in one JSON reply,
+#                plus a repair call only when fields are missing or invalid
+GENERATION_MODES = ("multi_call", "one_shot")
+GENERATION_MODE = os.environ.get("GENERATION_MODE", "multi_call")
+# Where multi_call mode gets each scene's SD prompt:
+#   agent    - one prompt-agent call per scene
+#   template - composed locally from the scene text, the character and the
+#              style (core/images.py), no LLM call, fitted to CLIP's 77 tokens
+PROMPT_MODES = ("agent", "template")
+PROMPT_MODE = os.environ.get("PROMPT_MODE", "agent")
+# Both SDXL text encoders read 77 CLIP tokens, start/end tokens included
+CLIP_MAX_TOKENS = 77
+# JSON mode for one-shot calls: "json_object" works on every Groq model,
+# "json_schema" (strict schema) only on models that support structured outputs
+LLM_RESPONSE_FORMAT = os.environ.get("LLM_RESPONSE_FORMAT", "json_object")
 
 
 STYLE_PRESET = (
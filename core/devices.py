@@ -0,0 +1,402 @@
+#core/devices.py
+import itertools
+import multiprocessing as mp
+from multiprocessing.connection import wait
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+from pathlib import Path
+
+from .config import *
+from .assets import SceneAsset
+from .tracing import bind, record
+
+
+def numa_nodes() -> list[list[int]]:
+    # CPU ids per NUMA node (Linux sysfs), restricted to the CPUs we may use
+    allowed = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else set(range(os.cpu_count() or 1))
+    nodes = []
+    for path in sorted(Path("/sys/devices/system/node").glob("node[0-9]*/cpulist")):
+        cpus = set()
+        for part in path.read_text().strip().split(","):
+            if "-" in part:
+                lo, hi = part.split("-")
+                cpus.update(range(int(lo), int(hi) + 1))
+            elif part:
+                cpus.add(int(part))
+        cpus &= allowed
+        if cpus:
+            nodes.append(sorted(cpus))
+    return nodes or [sorted(allowed)]
+
+
+def detect_devices() -> list[str]:
+    # One replica per CUDA device, else one per NUMA node
+    import torch
+
+    if torch.cuda.is_available():
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    return ["cpu"] * len(numa_nodes())
+
+
+def _cpu_sets(devices: list[str]) -> list[list[int] | None]:
+    # CPU replicas are pinned to a NUMA node each when there are as many nodes
+    # as replicas, otherwise to an even slice of the CPUs we may use
+    cpu_slots = [i for i, d in enumerate(devices) if d.startswith("cpu")]
+    sets = [None] * len(devices)
+    if not cpu_slots:
+        return sets
+    nodes = numa_nodes()
+    if len(nodes) != len(cpu_slots):
+        cpus = sorted(cpu for node in nodes for cpu in node)
+        size = max(1, len(cpus) // len(cpu_slots))
+        nodes = [cpus[i * size:(i + 1) * size] or cpus for i in range(len(cpu_slots))]
+    for slot, cpus in zip(cpu_slots, nodes):
+        sets[slot] = cpus
+    return sets
+
+
+# Read once, when the OpenMP/MKL runtimes load. A spawned child can import
+# torch while unpickling its arguments (a factory from a module that imports
+# it), before any of its own code runs, so these are set in the parent around
+# Process.start().
+_THREAD_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS")
+_ENV_LOCK = threading.Lock()
+
+
+def _heartbeat(send, interval: float, stop: threading.Event):
+    while not stop.wait(interval):
+        send(("beat",))
+
+
+def _replica(device: str, cpus, pipeline_kwargs: dict, factory, tasks, conn, interval: float):
+    # Runs in the child process. Pinning happens before the first parallel
+    # region starts torch's worker threads, which inherit it. Each replica
+    # reports on its own pipe: killing one mid-write can only garble a pipe
+    # that is thrown away with it.
+    lock = threading.Lock()
+
+    def send(message: tuple):
+        with lock:
+            conn.send(message)
+
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(send, interval, stop), daemon=True).start()
+    try:
+        import torch
+        from .images import iter_illustrations
+        from .pipeline import get_pipeline
+
+        if cpus:
+            torch.set_num_threads(len(cpus))
+        if device.startswith("cuda:"):
+            # Anything allocated on plain "cuda" lands on this replica's GPU
+            torch.cuda.set_device(device)
+        pipe = factory() if factory is not None else get_pipeline(device=device, **pipeline_kwargs)
+        send(("ready",))
+
+        while (task := tasks.get()) is not None:
+            task_id, prompt, seed, width, height = task
+            start = time.perf_counter()
+            try:
+                asset = next(iter_illustrations(
+                    [prompt], pipe, width=width, height=height, batch_size=1,
+                    seeds=[seed] if seed is not None else None,
+                ))
+                send(("done", task_id, asset.png, asset.key, time.perf_counter() - start))
+            except Exception:
+                send(("failed", task_id, traceback.format_exc()))
+    except Exception:
+        send(("crashed", traceback.format_exc()))
+    finally:
+        stop.set()
+
+
+class DevicePool:
+    # One pipeline replica per device, each in its own (spawned) process, fed
+    # one scene at a time. Pass it wherever a pipeline goes (iter_illustrations,
+    # generate_ai_illustration, generate_storybook): a book's scenes are spread
+    # over the replicas and come back in scene order.
+    #
+    # Replicas are watched through heartbeats (sent from a side thread, so they
+    # prove the process is alive, not that it is making progress) and a
+    # per-scene timeout. A dead, silent or stuck one is restarted (up to
+    # max_restarts) and its scene requeued on another.
+    # factory (a picklable callable returning a pipeline) replaces
+    # get_pipeline, e.g. for tiny CPU pipelines in tests and benchmarks.
+
+    def __init__(
+        self,
+        devices: list[str] | None = None,
+        hf_token: str | None = None,
+        preset: str = QUALITY_PRESET,
+        backend: str = INFERENCE_BACKEND,
+        profile: str = MEMORY_PROFILE,
+        factory=None,
+        heartbeat_seconds: float = DEVICE_HEARTBEAT_SECONDS,
+        heartbeat_timeout: float = DEVICE_HEARTBEAT_TIMEOUT,
+        task_timeout: float = DEVICE_TASK_TIMEOUT,
+        max_restarts: int = DEVICE_MAX_RESTARTS,
+        task_attempts: int = DEVICE_TASK_ATTEMPTS,
+    ):
+        self.devices = list(devices or detect_devices())
+        self.pipeline_kwargs = {"hf_token": hf_token, "preset": preset, "backend": backend, "profile": profile}
+        self.factory = factory
+        self.heartbeat_seconds = heartbeat_seconds
+        self.heartbeat_timeout = heartbeat_timeout
+        self.task_timeout = task_timeout
+        self.max_restarts = max_restarts
+        self.task_attempts = task_attempts
+        self.quality_preset = preset
+
+        self._ctx = mp.get_context("spawn")
+        self._cpus = _cpu_sets(self.devices)
+        self._slots = []
+        self._lock = threading.Lock()
+        self._calls = itertools.count()
+        self._jobs = {}
+        self._pending = deque()
+        self._checked = time.monotonic()
+        for slot, device in enumerate(self.devices):
+            self._slots.append({"device": device, "restarts": 0, "rendered": 0, "failed": False})
+            self._spawn(slot)
+
+    def _spawn(self, slot: int):
+        state = self._slots[slot]
+        tasks = self._ctx.Queue()
+        reader, writer = self._ctx.Pipe(duplex=False)
+        proc = self._ctx.Process(
+            target=_replica,
+            args=(state["device"], self._cpus[slot], self.pipeline_kwargs, self.factory, tasks, writer, self.heartbeat_seconds),
+            name=f"replica-{slot}",
+            daemon=True,
+        )
+        threads = {var: str(len(self._cpus[slot])) for var in _THREAD_VARS} if self._cpus[slot] else {}
+        with _ENV_LOCK:
+            saved = {var: os.environ.get(var) for var in threads}
+            os.environ.update(threads)
+            try:
+                proc.start()
+            finally:
+                for var, value in saved.items():
+                    if value is None:
+                        os.environ.pop(var, None)
+                    else:
+                        os.environ[var] = value
+        writer.close()
+        state.update(proc=proc, tasks=tasks, conn=reader, ready=False, task=None, beat=time.monotonic())
+
+    def _retire(self, slot: int, reason: str) -> tuple | None:
+        # Stops a replica that died or went silent, restarts it if it has
+        # restarts left, and hands back the task it was holding
+        state = self._slots[slot]
+        proc = state["proc"]
+        if proc.is_alive():
+            proc.terminate()
+        proc.join(timeout=5)
+        state["conn"].close()
+        task = state["task"]
+        record("device_restart", 0.0, device=state["device"], reason=reason)
+        if state["restarts"] < self.max_restarts:
+            state["restarts"] += 1
+            self._spawn(slot)
+        else:
+            state.update(failed=True, ready=False, task=None)
+        return task
+
+    def _requeue(self, task: tuple | None):
+        # Back to the front of the queue, unless its call was abandoned
+        if task is not None and task[0][0] in self._jobs:
+            self._pending.appendleft(task)
+
+    def _conns(self) -> list:
+        return [state["conn"] for state in self._slots if not state["failed"]]
+
+    def _check_health(self):
+        # Heartbeats pile up in the pipes while no call is reading them; read
+        # them first so an idle replica isn't mistaken for a silent one
+        self._receive(wait(self._conns(), timeout=0))
+        now = time.monotonic()
+        self._checked = now
+        for slot, state in enumerate(self._slots):
+            if state["failed"]:
+                continue
+            if not state["proc"].is_alive():
+                reason = f"exited with code {state['proc'].exitcode}"
+            elif now - state["beat"] > self.heartbeat_timeout:
+                reason = f"no heartbeat for {now - state['beat']:.0f}s"
+            elif state["task"] is not None and now - state["started"] > self.task_timeout:
+                reason = f"scene {state['task'][0][1] + 1} took over {self.task_timeout:.0f}s"
+            else:
+                continue
+            self._requeue(self._retire(slot, reason))
+        if all(state["failed"] for state in self._slots):
+            raise RuntimeError("Every device replica failed; see the device_restart spans for reasons.")
+
+    def _dispatch(self):
+        for state in self._slots:
+            if self._pending and state["ready"] and state["task"] is None:
+                task = self._pending.popleft()
+                self._jobs[task[0][0]]["attempts"][task[0]] += 1
+                state.update(task=task, started=time.monotonic())
+                state["tasks"].put(task)
+
+    def _receive(self, ready: list):
+        # Another caller may have read a pipe since wait() saw it ready, and a
+        # retired replica's pipe is closed, so each one is checked again here
+        for slot, state in enumerate(self._slots):
+            conn = state["conn"]
+            if conn not in ready or state["failed"] or conn.closed:
+                continue
+            try:
+                while not conn.closed and conn.poll():
+                    self._handle(slot, conn.recv())
+            except (EOFError, OSError):
+                # The replica is gone; have the health check restart it now
+                self._checked = 0.0
+
+    def iter_illustrations(
+        self,
+        prompts,
+        width: int = WIDTH,
+        height: int = HEIGHT,
+        seeds: list[int] | None = None,
+    ):
+        # Same contract as images.iter_illustrations: consumes prompts as they
+        # arrive (any iterable) and yields a SceneAsset per prompt, in order.
+        # Prompts are pulled on a thread so results keep flowing while the
+        # next prompt is still being written. Several calls can share the pool;
+        # the lock is only held while pool state changes, never across a yield.
+        inbox = queue.Queue()
+        stop = threading.Event()
+
+        def feed():
+            source = iter(prompts)
+            try:
+                for index, prompt in enumerate(source):
+                    if stop.is_set():
+                        break
+                    inbox.put(("prompt", index, prompt))
+                else:
+                    inbox.put(("end", None, None))
+            except BaseException as e:
+                inbox.put(("error", e, None))
+            finally:
+                # An abandoned call stops asking for prompts (and LLM calls)
+                if stop.is_set() and hasattr(source, "close"):
+                    source.close()
+
+        # Tasks are keyed (call, scene index), so results that come back for a
+        # call that was abandoned are recognised and dropped
+        with self._lock:
+            call = next(self._calls)
+            job = self._jobs[call] = {"attempts": {}, "finished": {}, "error": None}
+        threading.Thread(target=bind(feed), name="device-pool-feed", daemon=True).start()
+        total = None
+        next_index = 0
+        try:
+            while total is None or next_index < total:
+                with self._lock:
+                    while True:
+                        try:
+                            kind, index, prompt = inbox.get_nowait()
+                        except queue.Empty:
+                            break
+                        if kind == "error":
+                            raise index
+                        if kind == "end":
+                            total = len(job["attempts"])
+                        else:
+                            job["attempts"][(call, index)] = 0
+                            self._pending.append(((call, index), prompt, seeds[index] if seeds is not None else None, width, height))
+                    if time.monotonic() - self._checked > self.heartbeat_seconds:
+                        self._check_health()
+                    self._dispatch()
+                    conns = self._conns()
+
+                ready = wait(conns, timeout=0.05)
+
+                with self._lock:
+                    self._receive(ready)
+                    self._dispatch()
+                    if job["error"] is not None:
+                        raise job["error"]
+                    finished = []
+                    while next_index in job["finished"]:
+                        finished.append(job["finished"].pop(next_index))
+                        next_index += 1
+                yield from finished
+        finally:
+            stop.set()
+            with self._lock:
+                del self._jobs[call]
+                self._pending = deque(task for task in self._pending if task[0][0] != call)
+
+    def _handle(self, slot: int, message: tuple):
+        kind = message[0]
+        state = self._slots[slot]
+        state["beat"] = time.monotonic()
+        if kind == "ready":
+            state["ready"] = True
+        elif kind == "crashed":
+            self._requeue(self._retire(slot, message[1].strip().splitlines()[-1]))
+        elif kind in ("done", "failed"):
+            task = state["task"]
+            if task is None or task[0] != message[1]:
+                return
+            state["task"] = None
+            task_id, prompt, seed = task[:3]
+            job = self._jobs.get(task_id[0])
+            if job is None:
+                return
+            index = task_id[1]
+            if kind == "done":
+                _, _, png, key, seconds = message
+                state["rendered"] += 1
+                record("device_render", seconds, device=state["device"], scene=index + 1)
+                job["finished"][index] = SceneAsset.from_png(png, prompt, key, seed)
+            elif job["attempts"][task_id] >= self.task_attempts:
+                job["error"] = RuntimeError(f"Scene {index + 1} failed on {state['device']}:\n{message[2]}")
+            else:
+                self._pending.appendleft(task)
+
+    def health(self) -> list[dict]:
+        with self._lock:
+            self._receive(wait(self._conns(), timeout=0))
+            now = time.monotonic()
+            return [
+                {
+                    "slot": slot,
+                    "device": state["device"],
+                    "pid": state["proc"].pid,
+                    "alive": state["proc"].is_alive(),
+                    "ready": state["ready"],
+                    "busy": state["task"] is not None,
+                    "restarts": state["restarts"],
+                    "failed": state["failed"],
+                    "rendered": state["rendered"],
+                    "seconds_since_heartbeat": round(now - state["beat"], 1),
+                }
+                for slot, state in enumerate(self._slots)
+            ]
+
+    def close(self):
+        for state in self._slots:
+            if state["proc"].is_alive():
+                state["tasks"].put(None)
+        for state in self._slots:
+            state["proc"].join(timeout=10)
+            if state["proc"].is_alive():
+                state["proc"].terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,24 +1,109 @@
 #core/export.py
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from io import BytesIO
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
+from reportlab.pdfbase.pdfmetrics import stringWidth
 from reportlab.lib.utils import ImageReader
 from PIL import Image
 
+from .config import *
+from .tracing import stage
 
-def export_storybook_pdf(pdf_path: str, title: str, scenes: list[str], image_paths: list[str]):
-    from reportlab.lib.pagesizes import A4
-    from reportlab.pdfgen import canvas
-    from reportlab.lib.utils import ImageReader
+MARGIN = 36
+TITLE_FONT = ("Helvetica-Bold", 18)
+TEXT_FONT = ("Helvetica", 11)
 
-    c = canvas.Canvas(pdf_path, pagesize=A4)
-    page_w, page_h = A4
-    margin = 36
 
-    for i, (scene, img_path) in enumerate(zip(scenes, image_paths), start=1):
-        c.setFont("Helvetica-Bold", 18)
-        c.drawString(margin, page_h - margin, f"{title}  ({i}/{len(image_paths)})")
+@lru_cache(maxsize=4096)
+def _word_width(word: str, font: str, size: float) -> float:
+    return stringWidth(word, font, size)
 
-        img = Image.open(img_path).convert("RGB")
+
+def wrap_text(text: str, font: str, size: float, max_width: float) -> list[str]:
+    # Greedy line breaking on cached per-word widths (base-14 fonts have no
+    # kerning, so a line is just its words plus the spaces between them).
+    space = _word_width(" ", font, size)
+    lines = []
+    line = []
+    width = 0.0
+    for w in text.split():
+        ww = _word_width(w, font, size)
+        if line and width + space + ww > max_width:
+            lines.append(" ".join(line))
+            line = [w]
+            width = ww
+        else:
+            width += (space if line else 0) + ww
+            line.append(w)
+    if line:
+        lines.append(" ".join(line))
+    return lines
+
+
+class StorybookPDF:
+    # Incremental A4 storybook writer: add_page() as soon as each scene's image
+    # exists, close() at the end. With total=None the "(i/N)" page counter is a
+    # form filled in by close(), so pages can be written before N is known.
+
+    def __init__(
+        self,
+        pdf_path: str,
+        title: str,
+        total: int | None = None,
+        dpi: int = PDF_VARIANTS["screen"]["dpi"],
+        image_format: str = PDF_VARIANTS["screen"]["image_format"],
+        quality: int = PDF_VARIANTS["screen"]["quality"],
+    ):
+        self.c = canvas.Canvas(pdf_path, pagesize=A4, pageCompression=1)
+        self.title = title
+        self.total = total
+        self.dpi = dpi
+        self.image_format = image_format
+        self.quality = quality
+        self.pages = 0
+
+    def _embed(self, img: Image.Image, draw_w: float, draw_h: float) -> ImageReader:
+        # Downsample to the pixels the page can actually show at this DPI
+        target = (max(1, round(draw_w / 72 * self.dpi)), max(1, round(draw_h / 72 * self.dpi)))
+        if img.width > target[0] or img.height > target[1]:
+            img = img.resize(target, Image.LANCZOS)
+        if self.image_format != "jpeg":
+            return ImageReader(img)
+        # ReportLab embeds JPEG streams as-is (DCTDecode), no re-encoding
+        buf = BytesIO()
+        img.save(buf, format="JPEG", quality=self.quality, optimize=True)
+        buf.seek(0)
+        return ImageReader(buf)
+
+    def add_page(self, scene: str, image):
+        with stage("pdf_page"):
+            self._add_page(scene, image)
+
+    def _add_page(self, scene: str, image):
+        c = self.c
+        page_w, page_h = A4
+        margin = MARGIN
+        self.pages += 1
+        i = self.pages
+
+        c.setFont(*TITLE_FONT)
+        prefix = f"{self.title}  ({i}/"
+        if self.total is not None:
+            c.drawString(margin, page_h - margin, f"{prefix}{self.total})")
+        else:
+            c.drawString(margin, page_h - margin, prefix)
+            c.saveState()
+            c.translate(margin + stringWidth(prefix, *TITLE_FONT), page_h - margin)
+            c.doForm("page_total")
+            c.restoreState()
+
+        img = image if isinstance(image, Image.Image) else Image.open(image)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
         iw, ih = img.size
 
         max_w = page_w - 2 * margin
@@ -29,25 +114,75 @@ def export_storybook_pdf(pdf_path: str, title: str, scenes: list[str], image_pat
         x = (page_w - draw_w) / 2
         y = page_h - margin - 40 - draw_h
 
-        c.drawImage(ImageReader(img), x, y, width=draw_w, height=draw_h, preserveAspectRatio=True, mask='auto')
+        c.drawImage(self._embed(img, draw_w, draw_h), x, y, width=draw_w, height=draw_h, preserveAspectRatio=True, mask='auto')
 
-        c.setFont("Helvetica", 11)
+        c.setFont(*TEXT_FONT)
         text_obj = c.beginText(margin, y - 20)
         text_obj.setLeading(14)
-
-        words = scene.split()
-        line = ""
-        for w in words:
-            cand = (line + " " + w).strip()
-            if c.stringWidth(cand, "Helvetica", 11) <= (page_w - 2 * margin):
-                line = cand
-            else:
-                text_obj.textLine(line)
-                line = w
-        if line:
+        for line in wrap_text(scene, *TEXT_FONT, page_w - 2 * margin):
             text_obj.textLine(line)
 
         c.drawText(text_obj)
         c.showPage()
 
-    c.save()
\ No newline at end of file
+    def close(self):
+        with stage("pdf_save"):
+            if self.total is None:
+                self.c.beginForm("page_total")
+                self.c.setFont(*TITLE_FONT)
+                self.c.drawString(0, 0, f"{self.pages})")
+                self.c.endForm()
+            self.c.save()
+
+
+def export_storybook_pdf(
+    pdf_path: str,
+    title: str,
+    scenes: list[str],
+    image_paths: list[str],
+    images: list | None = None,
+    variant: str = "screen",
+):
+    # In-memory images (when the caller still has them) save decoding the PNGs again
+    sources = images if images is not None else image_paths
+    opts = PDF_VARIANTS[variant]
+
+    pdf = StorybookPDF(
+        pdf_path, title, total=len(sources),
+        dpi=opts["dpi"], image_format=opts["image_format"], quality=opts["quality"],
+    )
+    for scene, src in zip(scenes, sources):
+        pdf.add_page(scene, src)
+    pdf.close()
+
+
+def variant_pdf_path(base_path: str, variant: str) -> str:
+    stem, ext = str(base_path).rsplit(".", 1)
+    return f"{stem}{PDF_VARIANTS[variant]['suffix']}.{ext}"
+
+
+def export_storybook_variants(
+    base_path: str,
+    title: str,
+    scenes: list[str],
+    image_paths: list[str],
+    variants: list[str] = PDF_EXPORT_VARIANTS,
+) -> dict[str, str]:
+    # Worker processes (spawned: this runs in threaded processes with torch
+    # loaded, where fork is unsafe), one per variant up to
+    # PDF_EXPORT_MAX_WORKERS; each reads the PNGs from disk itself
+    paths = {v: variant_pdf_path(base_path, v) for v in variants}
+    with stage("pdf_variants", variants=",".join(variants)):
+        if len(variants) == 1:
+            export_storybook_pdf(paths[variants[0]], title, scenes, image_paths, variant=variants[0])
+            return paths
+
+        workers = max(1, min(len(variants), PDF_EXPORT_MAX_WORKERS, os.cpu_count() or 1))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as pool:
+            futures = [
+                pool.submit(export_storybook_pdf, paths[v], title, scenes, image_paths, None, v)
+                for v in variants
+            ]
+            for f in futures:
+                f.result()
+    return paths
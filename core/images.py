@@ -1,9 +1,31 @@
 #core/images.py
+import random
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
+import numpy as np
 import torch
 from diffusers import StableDiffusionPipeline
 from datapizza.agents import Agent
 from .config import *
 from .story import *
+from .pipeline import exported_backend, free_memory, preset_options, record_render
+from .cache import IMAGE_CACHE, image_cache_key
+from .assets import SceneAsset
+from .devices import DevicePool
+from .tracing import stage, step_timer
+
+# Rough UNet + VAE working set per image (CFG pair included) for one megapixel at fp16
+_BYTES_PER_MEGAPIXEL = 3 * 1024**3
+
+# Text-encoder outputs per prompt, one LRU per loaded text encoder (preset
+# views share it). Dropped with the pipeline when the registry evicts it.
+_EMBEDDINGS = weakref.WeakKeyDictionary()
+_EMBED_LOCK = threading.Lock()
+_EMBED_STATS = {"hits": 0, "misses": 0}
+
 
 def generate_ai_illustration(
     scene_text: str,
@@ -13,6 +35,7 @@ def generate_ai_illustration(
     pipe: StableDiffusionPipeline,
     width: int = WIDTH,
     height: int = HEIGHT,
+    seed: int | None = None,
 ):
     custom_prompt = generate_image_prompt(
         prompt_agent=prompt_agent,
@@ -21,15 +44,482 @@ def generate_ai_illustration(
         style_preset=style_preset,
     )
 
-    with torch.inference_mode():
-        result = pipe(
-            prompt=custom_prompt,
-            negative_prompt=NEGATIVE,
+    seeds = [seed] if seed is not None else None
+    asset = next(iter_illustrations([custom_prompt], pipe, width=width, height=height, batch_size=1, seeds=seeds))
+    return asset.image, custom_prompt
+
+
+def _is_oom(err: Exception) -> bool:
+    if isinstance(err, (torch.cuda.OutOfMemoryError, MemoryError)):
+        return True
+    msg = str(err).lower()
+    return isinstance(err, RuntimeError) and ("out of memory" in msg or "can't allocate memory" in msg)
+
+
+def auto_batch_size(pipe: StableDiffusionPipeline, width: int = WIDTH, height: int = HEIGHT) -> int:
+    # With CPU offload the weights sit on the CPU but the UNet still runs on the GPU
+    free = free_memory(str(getattr(pipe, "_execution_device", pipe.device)))
+    if free is None:
+        return 1
+    bytes_per_elem = torch.finfo(pipe.dtype).bits // 8
+    per_image = _BYTES_PER_MEGAPIXEL * (width * height / 1024**2) * (bytes_per_elem / 2)
+    return max(1, min(MAX_BATCH_SIZE, int(free // per_image)))
+
+
+def illustration_key(pipe: StableDiffusionPipeline, prompt: str, width: int = WIDTH, height: int = HEIGHT, seed: int | None = None) -> str:
+    _, opts = preset_options(pipe)
+    sampler = None
+    if opts["scheduler"] or opts["lora"]:
+        sampler = "+".join(x for x in (opts["scheduler"], opts["lora"]) if x)
+    return image_cache_key(
+        prompt=prompt,
+        negative_prompt=NEGATIVE,
+        seed=seed,
+        steps=opts["steps"],
+        guidance=opts["guidance"],
+        width=width,
+        height=height,
+        model_id=getattr(pipe, "name_or_path", None) or MODEL_ID,
+        sampler=sampler,
+    )
+
+
+def encode_prompts(pipe: StableDiffusionPipeline, prompts: list[str]):
+    # Returns (prompt_embeds, pooled_prompt_embeds) for the batch, running both
+    # SDXL text encoders only on prompts this pipeline hasn't seen. NEGATIVE is
+    # encoded once per pipeline; the LLM writes every scene prompt from
+    # scratch, so there is no fixed prefix to reuse inside a prompt.
+    with _EMBED_LOCK:
+        cache = _EMBEDDINGS.setdefault(pipe.text_encoder_2, OrderedDict())
+        found = {}
+        for p in prompts:
+            if p in cache:
+                cache.move_to_end(p)
+                found[p] = cache[p]
+        _EMBED_STATS["hits"] += sum(p in found for p in prompts)
+
+    todo = list(dict.fromkeys(p for p in prompts if p not in found))
+    if todo:
+        with stage("text_encode"):
+            embeds, _, pooled, _ = pipe.encode_prompt(
+                prompt=todo,
+                device=pipe._execution_device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=False,
+            )
+        with _EMBED_LOCK:
+            _EMBED_STATS["misses"] += len(todo)
+            for i, p in enumerate(todo):
+                found[p] = cache[p] = (embeds[i:i + 1], pooled[i:i + 1])
+            while len(cache) > PROMPT_EMBED_CACHE_SIZE:
+                cache.popitem(last=False)
+
+    return (
+        torch.cat([found[p][0] for p in prompts]),
+        torch.cat([found[p][1] for p in prompts]),
+    )
+
+
+def prompt_embedding_kwargs(pipe: StableDiffusionPipeline, prompts: list[str], guidance: float) -> dict:
+    embeds, pooled = encode_prompts(pipe, prompts)
+    kwargs = {"prompt_embeds": embeds, "pooled_prompt_embeds": pooled}
+    # Without CFG (guidance <= 1, e.g. LCM) the negative branch is never run
+    if guidance > 1:
+        neg, neg_pooled = encode_prompts(pipe, [NEGATIVE])
+        kwargs["negative_prompt_embeds"] = neg.expand(len(prompts), -1, -1)
+        kwargs["negative_pooled_prompt_embeds"] = neg_pooled.expand(len(prompts), -1)
+    return kwargs
+
+
+def embedding_stats() -> dict:
+    with _EMBED_LOCK:
+        return {**_EMBED_STATS, "entries": sum(len(c) for c in _EMBEDDINGS.values())}
+
+
+def new_seed() -> int:
+    return random.randrange(2**31)
+
+
+def make_generator(seed: int) -> torch.Generator:
+    # CPU generators give the same latents whatever device the UNet runs on
+    return torch.Generator(device="cpu").manual_seed(seed)
+
+
+def _render_batch(pipe, prompts: list[str], seeds: list[int | None], width: int, height: int, opts: dict):
+    if exported_backend(pipe):
+        # optimum pipelines: plain prompts and one numpy generator per call,
+        # so a batch holds a single scene to keep its seed
+        seed = seeds[0]
+        return pipe(
+            prompt=prompts,
+            negative_prompt=[NEGATIVE] * len(prompts) if opts["guidance"] > 1 else None,
             height=height,
             width=width,
-            num_inference_steps=STEPS,
-            guidance_scale=GUIDANCE,
+            num_inference_steps=opts["steps"],
+            guidance_scale=opts["guidance"],
+            generator=np.random.RandomState(seed) if seed is not None else None,
         )
-        image = result.images[0]
 
-    return image, custom_prompt
\ No newline at end of file
+    embeds = prompt_embedding_kwargs(pipe, prompts, opts["guidance"])
+    # Per-step UNet timings and the VAE decode, only while tracing
+    timer = step_timer()
+    result = pipe(
+        **embeds,
+        height=height,
+        width=width,
+        num_inference_steps=opts["steps"],
+        guidance_scale=opts["guidance"],
+        generator=[make_generator(sd) for sd in seeds] if seeds[0] is not None else None,
+        callback_on_step_end=timer,
+    )
+    if timer is not None:
+        timer.finish()
+    return result
+
+
+def iter_illustrations(
+    prompts,
+    pipe: StableDiffusionPipeline,
+    width: int = WIDTH,
+    height: int = HEIGHT,
+    batch_size: int | None = None,
+    cache=IMAGE_CACHE,
+    seeds: list[int] | None = None,
+):
+    # Consumes prompts as they arrive (any iterable) and yields a SceneAsset per
+    # prompt in the same order, one batch at a time. Cached images skip diffusion.
+    # seeds[i] seeds the i-th prompt; without seeds images are not reproducible.
+    if isinstance(pipe, DevicePool):
+        # Each replica renders one scene at a time and checks its own cache
+        yield from pipe.iter_illustrations(prompts, width=width, height=height, seeds=seeds)
+        return
+    if exported_backend(pipe):
+        batch_size = 1
+    batch_size = batch_size or auto_batch_size(pipe, width, height)
+    _, opts = preset_options(pipe)
+    prompts = iter(prompts)
+    done = 0
+    pending = []
+    exhausted = False
+    while pending or not exhausted:
+        while not exhausted and len(pending) < batch_size:
+            try:
+                pending.append(next(prompts))
+            except StopIteration:
+                exhausted = True
+        if not pending:
+            break
+
+        batch = pending[:batch_size]
+        batch_seeds = seeds[done:done + len(batch)] if seeds is not None else [None] * len(batch)
+        keys = [illustration_key(pipe, pr, width, height, sd) for pr, sd in zip(batch, batch_seeds)]
+        cached = [cache.get_bytes(k) if cache is not None else None for k in keys]
+        assets = [
+            SceneAsset.from_png(png, pr, k, sd) if png is not None else None
+            for png, pr, k, sd in zip(cached, batch, keys, batch_seeds)
+        ]
+        missing = [j for j, asset in enumerate(assets) if asset is None]
+
+        if missing:
+            try:
+                start = time.perf_counter()
+                with stage("diffusion", images=len(missing), steps=opts["steps"]), torch.inference_mode():
+                    result = _render_batch(
+                        pipe, [batch[j] for j in missing], [batch_seeds[j] for j in missing], width, height, opts,
+                    )
+                record_render(pipe, time.perf_counter() - start, len(missing))
+            except Exception as e:
+                if batch_size == 1 or not _is_oom(e):
+                    raise
+                # Retry the same scenes with half the batch
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                batch_size //= 2
+                continue
+
+            # Encoding and the cache write happen on a thread pool, off the render path
+            for j, img in zip(missing, result.images):
+                assets[j] = SceneAsset.rendered(img, batch[j], keys[j], batch_seeds[j], cache=cache)
+
+        del pending[:len(batch)]
+        done += len(batch)
+        yield from assets
+
+
+def render_illustrations(
+    prompts: list[str],
+    pipe: StableDiffusionPipeline,
+    width: int = WIDTH,
+    height: int = HEIGHT,
+    batch_size: int | None = None,
+    seeds: list[int] | None = None,
+):
+    return [asset.image for asset in iter_illustrations(prompts, pipe, width=width, height=height, batch_size=batch_size, seeds=seeds)]
+
+
+# Template prompts: the scene's action, setting and details plus the character
+# and the style, picked out with a few word lists (no model, no network) and
+# fitted to CLIP's token limit.
+_STOPWORDS = frozenset("""
+a an the and or but so then than that this these those it its he she they them their his her him we us our you your i me my
+is are was were be been being am do does did has have had will would can could should may might must
+of to in on at by for with from into onto over under up down out off about as if when while where who whom whose which what
+very just too also still even all some any each every no not nor once again more most much many there here now soon suddenly
+finally together
+""".split())
+_PREPOSITIONS = frozenset("""
+in on at by near under inside outside beside behind through across around into over along beneath above below atop among toward towards
+""".split())
+_PLACES = frozenset("""
+forest woods village town city house home cottage cabin kitchen room bedroom attic porch yard garden street square market shop
+bakery workshop factory school church barn stable field meadow hill hills mountain mountains valley lake pond river bridge sky
+clouds roof rooftop rooftops chimney fireplace hearth window tree trees park station train sleigh castle palace cave igloo pole
+snow library toyshop stairs hallway table door doorway path road lane rink
+""".split())
+_VERBS = frozenset("""
+built build builds made make makes found find finds saw see sees went go goes ran run runs flew fly flies rode ride rides gave
+give gives took take takes brought bring brings sang sing sings danced dance dances baked bake bakes hugged hug hugs opened open
+opens wrapped wrap wraps decorated decorate decorates played play plays laughed laugh laughs looked look looks held hold holds
+sat sit sits stood stand stands slid slide slides skated skate skates climbed climb climbs carried carry carries followed follow
+follows helped help helps shared share shares watched watch watches waved wave waves met meet meets hung hang hangs lit light
+threw throw throws caught catch catches fed feed feeds knitted knit knits painted paint paints discovered discover discovers
+woke wake wakes ate eat eats drank drink drinks slept sleep sleeps came come comes began begin begins told tell tells said say says
+heard hear hears felt feel feels knew know knows wrote write writes read reads dreamed dreamt dream dreams smiled smile smiles
+""".split())
+# Words that start a new clause: a phrase ends before them
+_CLAUSE_BREAKS = frozenset("and but or while when then because as so that who which until after before".split())
+# Kept with the name that follows ("Mrs. Claus"); their "." doesn't end a sentence
+_HONORIFICS = frozenset("mr mrs ms miss dr st".split())
+# Proper nouns an SD model knows; any other mid-sentence capitalised word is taken for a name
+_KNOWN_NAMES = frozenset("santa claus rudolph christmas north pole".split())
+_TOKEN = re.compile(r"[A-Za-z][A-Za-z'-]*|[.!?,;:]")
+
+
+def _is_verb(word: str) -> bool:
+    return word in _VERBS or (len(word) > 4 and word.endswith("ed"))
+
+
+def scene_features(scene_text: str, names=()) -> dict:
+    # -> {"action", "setting", "details"}: the first verb phrase with its
+    # subject ("dog built a big snowman"), the first prepositional phrase
+    # ending in a place ("in the snowy park") and up to four other runs of
+    # content words ("hot cocoa"), names removed. Phrases end at clause and
+    # phrase boundaries, so a noun phrase ("a warm cup of hot cocoa") stays whole.
+    names = {n.lower() for n in names}
+    tokens = []
+    sentence_start = True
+    honorific = False
+    for token in _TOKEN.findall(scene_text):
+        lower = token.lower()
+        if token == "." and honorific:
+            continue
+        if token in ".!?,;:":
+            tokens.append(token)
+            sentence_start = token in ".!?"
+            honorific = False
+            continue
+        if lower in _HONORIFICS:
+            tokens.append(lower)
+            honorific = True
+            sentence_start = False
+            continue
+        is_name = lower in names or (token[0].isupper() and not sentence_start and lower not in _KNOWN_NAMES)
+        if is_name and honorific:
+            # "Mr. Frost" goes as a whole
+            tokens[-1] = None
+        tokens.append(None if is_name else lower)
+        sentence_start = False
+        honorific = False
+
+    def content(word) -> bool:
+        return bool(word) and word not in ".!?,;:" and word not in _STOPWORDS and word not in _PREPOSITIONS
+
+    def phrase(start: int) -> list[tuple[int, str]]:
+        # (index, word) from start up to the next punctuation, preposition or
+        # clause break, trailing function words dropped
+        words = []
+        i = start
+        while i < len(tokens):
+            word = tokens[i]
+            if word is not None and (word in ".!?,;:" or (i > start and (word in _PREPOSITIONS or word in _CLAUSE_BREAKS))):
+                break
+            if word is not None:
+                words.append((i, word))
+            i += 1
+        while words and words[-1][1] in _STOPWORDS:
+            words.pop()
+        return words
+
+    used = set()
+    action = []
+    # A listed verb beats a guessed "-ed" word ("were tired. ... gave them")
+    verbs = [i for i, w in enumerate(tokens) if w in _VERBS] or [i for i, w in enumerate(tokens) if w and _is_verb(w)]
+    if verbs:
+        start = verbs[0]
+        while start > 0 and (content(tokens[start - 1]) or tokens[start - 1] is None) and verbs[0] - start < 3:
+            start -= 1
+        words = phrase(verbs[0])
+        action = [w for w in tokens[start:verbs[0]] if w is not None] + [w for _, w in words]
+        used.update(range(start, words[-1][0] + 1))
+        if start > 0 and tokens[start - 1] in _HONORIFICS:
+            action.insert(0, tokens[start - 1])
+            used.add(start - 1)
+
+    setting = []
+    for i, word in enumerate(tokens):
+        if word in _PREPOSITIONS and i not in used:
+            words = phrase(i)
+            places = [j for j, (_, w) in enumerate(words) if w in _PLACES]
+            if places:
+                words = words[:places[-1] + 1]
+                setting = [w for _, w in words]
+                used.update(range(i, words[-1][0] + 1))
+                break
+
+    details = []
+    run = []
+    for i, word in enumerate(tokens + ["."]):
+        if i < len(tokens) and i not in used and content(word) and not _is_verb(word):
+            run.append(word)
+            continue
+        if run and " ".join(run) not in details:
+            details.append(" ".join(run))
+        run = []
+    return {"action": " ".join(action), "setting": " ".join(setting), "details": details[:4]}
+
+
+def _prompt_tokenizers(pipe) -> list:
+    return [t for t in (getattr(pipe, "tokenizer", None), getattr(pipe, "tokenizer_2", None)) if t is not None]
+
+
+def _token_counter(pipe):
+    # Tokens a phrase costs in the stricter of the pipeline's CLIP tokenizers;
+    # without a pipeline, a rough count (a token per word piece and punctuation)
+    tokenizers = _prompt_tokenizers(pipe)
+    if tokenizers:
+        return lambda text: max(len(t(text, add_special_tokens=False)["input_ids"]) for t in tokenizers)
+    return lambda text: sum(1 + len(w) // 8 for w in re.findall(r"\w+|[^\w\s]", text))
+
+
+def _phrases(text: str) -> list[str]:
+    return [p.strip(" .") for p in re.split(r"[,;]", text) if p.strip(" .")]
+
+
+def template_prompt(
+    scene_text: str,
+    character_desc: str,
+    style_preset: str,
+    pipe: StableDiffusionPipeline | None = None,
+    names=(),
+    max_tokens: int = CLIP_MAX_TOKENS,
+) -> str:
+    # "<action> <setting>, <character>, <details>, <style>", built phrase by
+    # phrase within the encoders' budget (max_tokens minus start/end tokens).
+    # Phrases are admitted in order of importance (the scene, the start of the
+    # style, who the character is, the details, the character's clothes, the
+    # rest of the style) and whatever
+    # doesn't fit is left out whole rather than cut mid-phrase.
+    count = _token_counter(pipe)
+    budget = max_tokens - 2
+
+    features = scene_features(scene_text, names)
+    scene = " ".join(w for w in (features["action"], features["setting"]) if w)
+    if not scene:
+        scene = " ".join(features["details"]) or " ".join(scene_text.split()[:8])
+        features["details"] = []
+    if count(scene) > budget // 2 and features["action"] and features["setting"]:
+        # The action alone, before cutting into a phrase
+        scene = features["action"]
+    scene_words = scene.split()
+    while len(scene_words) > 1 and count(" ".join(scene_words)) > budget // 2:
+        scene_words.pop()
+    scene = " ".join(scene_words)
+
+    character = _phrases(character_desc)
+    style = _phrases(style_preset)
+    sections = {"scene": [scene] if scene else [], "character": character, "details": features["details"], "style": style}
+    ranked = (
+        [("scene", 0)] * bool(scene)
+        + [("style", i) for i in range(min(2, len(style)))]
+        + [("character", i) for i in range(min(3, len(character)))]
+        + [("details", i) for i in range(len(features["details"]))]
+        + [("character", i) for i in range(3, len(character))]
+        + [("style", i) for i in range(2, len(style))]
+    )
+
+    kept = set()
+    used = -1  # n phrases cost n - 1 separating commas
+    for key in ranked:
+        section, i = key
+        cost = count(sections[section][i]) + 1
+        if used + cost <= budget:
+            kept.add(key)
+            used += cost
+
+    def compose() -> str:
+        return ", ".join(
+            phrase
+            for section in ("scene", "character", "details", "style")
+            for i, phrase in enumerate(sections[section])
+            if (section, i) in kept
+        )
+
+    # Phrase costs don't always add up exactly once joined; drop the least
+    # important phrases until the real count fits
+    prompt = compose()
+    for key in reversed(ranked):
+        if count(prompt) <= budget:
+            break
+        if key in kept and key != ("scene", 0):
+            kept.discard(key)
+            prompt = compose()
+    return prompt
+
+
+def iter_ai_illustrations(
+    scene_texts,
+    character_desc: str,
+    style_preset: str,
+    prompt_agent: Agent,
+    pipe: StableDiffusionPipeline,
+    width: int = WIDTH,
+    height: int = HEIGHT,
+    batch_size: int | None = None,
+    seeds: list[int] | None = None,
+    prompt_mode: str = PROMPT_MODE,
+    names=(),
+):
+    # scene_texts: a list, or a StoryStream whose scenes are still arriving.
+    # prompt_mode "template" composes each prompt locally instead of asking
+    # prompt_agent; names (e.g. the child's) are kept out of those prompts.
+    def builder(scene_text: str) -> str:
+        return template_prompt(scene_text, character_desc, style_preset, pipe, names=names)
+
+    prompts = iter_image_prompts(
+        prompt_agent=prompt_agent,
+        scene_texts=scene_texts,
+        character_desc=character_desc,
+        style_preset=style_preset,
+        builder=builder if prompt_mode == "template" else None,
+    )
+    yield from iter_illustrations(prompts, pipe, width=width, height=height, batch_size=batch_size, seeds=seeds)
+
+
+def generate_ai_illustrations(
+    scene_texts: list[str],
+    character_desc: str,
+    style_preset: str,
+    prompt_agent: Agent,
+    pipe: StableDiffusionPipeline,
+    width: int = WIDTH,
+    height: int = HEIGHT,
+    batch_size: int | None = None,
+    seeds: list[int] | None = None,
+):
+    return [
+        (asset.image, asset.prompt)
+        for asset in iter_ai_illustrations(
+            scene_texts, character_desc, style_preset, prompt_agent, pipe,
+            width=width, height=height, batch_size=batch_size, seeds=seeds,
+        )
+    ]
@@ -0,0 +1,250 @@
+#core/jobs.py
+import argparse
+import json
+import multiprocessing as mp
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from contextlib import closing
+
+from .config import *
+from .db import connect
+
+# A worker that stops heartbeating for this long is presumed dead and its job is requeued
+JOB_STALE_SECONDS = 300
+# A job whose worker died this many times is marked failed instead of requeued
+JOB_MAX_ATTEMPTS = 3
+# Jobs never store the GROQ key itself, only the name of the worker environment
+# variable that holds it: GROQ_API_KEY or GROQ_API_KEY_<suffix>
+JOB_KEY_ENV = "GROQ_API_KEY"
+
+
+def _init_db(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            story_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            params TEXT NOT NULL,
+            key_env TEXT NOT NULL DEFAULT 'GROQ_API_KEY',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            progress INTEGER NOT NULL DEFAULT 0,
+            total INTEGER,
+            error TEXT,
+            worker TEXT,
+            created REAL NOT NULL,
+            started REAL,
+            finished REAL,
+            heartbeat REAL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, created)")
+
+    # Queues created before key references and attempt counts
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+    if "key_env" not in columns:
+        conn.execute(f"ALTER TABLE jobs ADD COLUMN key_env TEXT NOT NULL DEFAULT '{JOB_KEY_ENV}'")
+    if "attempts" not in columns:
+        conn.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+    if "groq_api_key" in columns:
+        conn.execute("UPDATE jobs SET groq_api_key = NULL WHERE groq_api_key IS NOT NULL")
+
+
+def _connect():
+    conn = connect(JOBS_DB_PATH)
+    _init_db(conn)
+    return conn
+
+
+def submit_job(
+    name: str,
+    age: int,
+    keywords: str,
+    key_env: str = JOB_KEY_ENV,
+    story_id: str | None = None,
+    generation_mode: str = GENERATION_MODE,
+    prompt_mode: str = PROMPT_MODE,
+) -> str:
+    if key_env != JOB_KEY_ENV and not key_env.startswith(f"{JOB_KEY_ENV}_"):
+        raise ValueError(f"Unknown key variable {key_env!r}; expected {JOB_KEY_ENV} or {JOB_KEY_ENV}_<suffix>.")
+
+    story_id = story_id or str(uuid.uuid4())[:8]
+    params = {
+        "name": name,
+        "age": age,
+        "keywords": keywords,
+        "generation_mode": generation_mode,
+        "prompt_mode": prompt_mode,
+    }
+    with closing(_connect()) as conn:
+        conn.execute(
+            "INSERT INTO jobs (story_id, status, params, key_env, created) VALUES (?, 'queued', ?, ?, ?)",
+            (story_id, json.dumps(params, ensure_ascii=False), key_env, time.time()),
+        )
+    return story_id
+
+
+def job_status(story_id: str) -> dict | None:
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT story_id, status, params, attempts, progress, total, error, worker, created, started, finished FROM jobs WHERE story_id = ?",
+            (story_id,),
+        ).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job["params"] = json.loads(job["params"])
+    return job
+
+
+def requeue_stale_jobs(stale_seconds: float = JOB_STALE_SECONDS, max_attempts: int = JOB_MAX_ATTEMPTS) -> int:
+    # Returns the number of jobs put back in the queue; jobs that already had
+    # max_attempts workers die on them are failed instead.
+    now = time.time()
+    with closing(_connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, finished = ? "
+                "WHERE status = 'running' AND heartbeat < ? AND attempts >= ?",
+                (f"Worker stopped heartbeating on {max_attempts} attempts.", now, now - stale_seconds, max_attempts),
+            )
+            cur = conn.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL, progress = 0 WHERE status = 'running' AND heartbeat < ?",
+                (now - stale_seconds,),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return cur.rowcount
+
+
+def claim_job(worker_id: str) -> dict | None:
+    with closing(_connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1"
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            now = time.time()
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, started = ?, heartbeat = ?, attempts = attempts + 1 WHERE story_id = ?",
+                (worker_id, now, now, row["story_id"]),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    job = dict(row)
+    job["params"] = json.loads(job["params"])
+    return job
+
+
+def _update_job(story_id: str, **fields):
+    fields["heartbeat"] = time.time()
+    cols = ", ".join(f"{k} = ?" for k in fields)
+    with closing(_connect()) as conn:
+        conn.execute(f"UPDATE jobs SET {cols} WHERE story_id = ?", (*fields.values(), story_id))
+
+
+def run_job(job: dict, pipe):
+    from .clients import build_clients
+    from .storybook import iter_storybook
+
+    story_id = job["story_id"]
+    groq_api_key = os.environ.get(job["key_env"])
+    if not groq_api_key:
+        raise RuntimeError(f"{job['key_env']} is not set in this worker's environment.")
+
+    story_agent, prompt_agent = build_clients(groq_api_key)
+    for event in iter_storybook(
+        story_agent=story_agent,
+        prompt_agent=prompt_agent,
+        pipe=pipe,
+        story_id=story_id,
+        **job["params"],
+    ):
+        if event["type"] == "story":
+            _update_job(story_id, total=len(event["scenes"]))
+        elif event["type"] == "scene":
+            _update_job(story_id, progress=event["index"])
+
+
+def _heartbeat(story_id: str, stop: threading.Event, interval: float = 30.0):
+    while not stop.wait(interval):
+        _update_job(story_id)
+
+
+def run_worker(
+    worker_id: str | None = None,
+    poll_interval: float = 2.0,
+    max_jobs: int | None = None,
+    preset: str = QUALITY_PRESET,
+    backend: str = INFERENCE_BACKEND,
+):
+    # Long-lived consumer: loads its pipeline once, then runs queued books one
+    # at a time until max_jobs (or forever).
+    from .pipeline import get_pipeline
+
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    pipe = get_pipeline(os.environ.get("HF_TOKEN"), preset=preset, backend=backend)
+    handled = 0
+
+    while max_jobs is None or handled < max_jobs:
+        requeue_stale_jobs()
+        job = claim_job(worker_id)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+
+        # Keep the heartbeat fresh while a long diffusion batch runs
+        stop = threading.Event()
+        beat = threading.Thread(target=_heartbeat, args=(job["story_id"], stop), daemon=True)
+        beat.start()
+        try:
+            run_job(job, pipe)
+        except Exception:
+            stop.set()
+            _update_job(
+                job["story_id"], status="failed", error=traceback.format_exc(), finished=time.time(),
+            )
+        else:
+            stop.set()
+            _update_job(job["story_id"], status="done", finished=time.time())
+        beat.join()
+        handled += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run storybook generation workers.")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes, each with its own pipeline.")
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    parser.add_argument("--preset", default=QUALITY_PRESET, choices=sorted(QUALITY_PRESETS), help="Speed/quality preset for this worker's pipeline.")
+    parser.add_argument("--backend", default=INFERENCE_BACKEND, choices=INFERENCE_BACKENDS, help="Inference backend for this worker's pipeline.")
+    args = parser.parse_args()
+
+    if args.workers == 1:
+        run_worker(poll_interval=args.poll_interval, preset=args.preset, backend=args.backend)
+        return
+
+    ctx = mp.get_context("spawn")
+    procs = [
+        ctx.Process(target=run_worker, kwargs={"poll_interval": args.poll_interval, "preset": args.preset, "backend": args.backend}, name=f"storybook-worker-{i}")
+        for i in range(args.workers)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+
+if __name__ == "__main__":
+    main()
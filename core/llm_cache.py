@@ -0,0 +1,255 @@
+#core/llm_cache.py
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from contextlib import closing
+from dataclasses import dataclass
+from pathlib import Path
+from datapizza.agents import Agent
+
+from .config import *
+from .db import connect
+from . import aio
+
+
+def llm_cache_key(agent_name: str, system_prompt: str, model: str, prompt: str) -> str:
+    payload = json.dumps([agent_name, system_prompt, model, prompt], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CachedResponse:
+    text: str
+    cached: bool = True
+    # Shared another caller's live request rather than read from the cache
+    coalesced: bool = False
+
+
+@dataclass
+class StreamChunk:
+    delta: str
+    usage: object = None
+    cached: bool = False
+
+
+class LLMCache:
+    # SQLite-backed response store with a TTL and a cap on the number of rows
+    # (least recently used rows go first).
+
+    def __init__(self, path: Path, ttl_seconds: float, max_entries: int):
+        self.path = Path(path)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        with closing(connect(self.path)) as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    agent TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)")
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with closing(connect(self.path)) as conn:
+            row = conn.execute("SELECT text, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row["created"] > self.ttl_seconds:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is not None:
+                conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row["text"]
+
+    def put(self, key: str, agent_name: str, text: str):
+        now = time.time()
+        with closing(connect(self.path)) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, agent, text, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, agent_name, text, now, now),
+            )
+            conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,))
+            conn.execute(
+                """
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
+
+    def stats(self) -> dict:
+        with closing(connect(self.path)) as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": entries, "max_entries": self.max_entries}
+
+
+def response_format(schema: dict) -> dict:
+    if LLM_RESPONSE_FORMAT == "json_schema":
+        return {"type": "json_schema", "json_schema": {"name": schema.get("title", "response"), "schema": schema}}
+    return {"type": "json_object"}
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English, plus room for a short answer
+    return len(text) // 4 + 256
+
+
+class CachedAgent:
+    # Drop-in wrapper around a datapizza Agent. Every call runs on the shared
+    # LLM event loop (core/aio.py); run() is the blocking bridge to a_run().
+    #   - With the cache enabled, answers come from the cache when the same
+    #     agent/system prompt/model has already seen the prompt, and identical
+    #     prompts already in flight (from any session) share one request.
+    #   - With a limiter, requests wait for rate-limit budget instead of
+    #     tripping 429s.
+    #   - With a schema, the client is asked for a JSON reply (see
+    #     LLM_RESPONSE_FORMAT); the prompt should describe the schema too.
+
+    # key -> asyncio.Future of the request in flight; only touched on the loop thread
+    _inflight: dict[str, asyncio.Future] = {}
+
+    def __init__(self, agent: Agent, model: str, cache: "LLMCache | None", enabled: bool = True, limiter=None, client=None):
+        self.agent = agent
+        self.model = model
+        self.client = client
+        self.cache = cache
+        self.enabled = enabled and cache is not None
+        self.limiter = limiter
+        self.coalesced = 0
+        self.response_format_supported = True
+
+    def __getattr__(self, name):
+        return getattr(self.agent, name)
+
+    def run(self, task_input: str, **kwargs):
+        return aio.run(self.a_run(task_input, **kwargs))
+
+    async def a_run(self, task_input: str, schema: dict | None = None, **kwargs):
+        if not self.enabled:
+            return await self._request(task_input, schema, **kwargs)
+
+        model = self.model if schema is None else f"{self.model}+{LLM_RESPONSE_FORMAT}"
+        key = llm_cache_key(self.agent.name, self.agent.system_prompt, model, task_input)
+        text = await asyncio.to_thread(self.cache.get, key)
+        if text is not None:
+            return CachedResponse(text)
+
+        inflight = CachedAgent._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            try:
+                resp = await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # The original caller gave up (not us): send our own request
+                if not inflight.cancelled():
+                    raise
+                return await self.a_run(task_input, schema, **kwargs)
+            return None if resp is None else CachedResponse(resp.text, cached=False, coalesced=True)
+
+        future = asyncio.get_running_loop().create_future()
+        CachedAgent._inflight[key] = future
+        try:
+            resp = await self._request(task_input, schema, **kwargs)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Nobody may be waiting; don't log "exception never retrieved"
+            future.exception()
+            raise
+        else:
+            future.set_result(resp)
+        finally:
+            CachedAgent._inflight.pop(key, None)
+
+        if resp is not None and resp.text:
+            await asyncio.to_thread(self.cache.put, key, self.agent.name, resp.text)
+        return resp
+
+    async def a_stream(self, task_input: str):
+        # Streaming variant of a_run: yields StreamChunks as the model writes.
+        # It talks to the client directly (no tool calls, no coalescing); a
+        # cached answer, or an agent built without a client, comes back as a
+        # single chunk. The last chunk carries the token usage when known.
+        key = None
+        if self.enabled:
+            key = llm_cache_key(self.agent.name, self.agent.system_prompt, self.model, task_input)
+            text = await asyncio.to_thread(self.cache.get, key)
+            if text is not None:
+                yield StreamChunk(text, cached=True)
+                return
+
+        if self.client is None:
+            resp = await self._request(task_input)
+            yield StreamChunk(resp.text, getattr(resp, "usage", None))
+            text = resp.text
+        else:
+            estimate = estimate_tokens(task_input)
+            if self.limiter is not None:
+                await self.limiter.acquire(estimate)
+            parts = []
+            usage = None
+            async for resp in self.client.a_stream_invoke(task_input, system_prompt=self.agent.system_prompt):
+                usage = getattr(resp, "usage", None) or usage
+                delta = getattr(resp, "delta", None) or ""
+                if delta:
+                    parts.append(delta)
+                    yield StreamChunk(delta)
+            yield StreamChunk("", usage)
+            if self.limiter is not None and usage is not None and usage.prompt_tokens:
+                self.limiter.settle(estimate, usage.prompt_tokens + usage.completion_tokens)
+            text = "".join(parts)
+
+        if key is not None and text:
+            await asyncio.to_thread(self.cache.put, key, self.agent.name, text)
+
+    async def _request(self, task_input: str, schema: dict | None = None, **kwargs):
+        async def call():
+            if schema is None or self.client is None:
+                return await self.agent.a_run(task_input, **kwargs)
+            if self.response_format_supported:
+                try:
+                    return await self.client.a_invoke(
+                        task_input,
+                        system_prompt=self.agent.system_prompt,
+                        response_format=response_format(schema),
+                    )
+                except TypeError as e:
+                    if "response_format" not in str(e):
+                        raise
+                    # This client takes no response_format: the prompt already
+                    # asks for JSON and story.parse_json_reply copes with the reply
+                    self.response_format_supported = False
+            return await self.client.a_invoke(task_input, system_prompt=self.agent.system_prompt)
+
+        if self.limiter is None:
+            return await call()
+
+        estimate = estimate_tokens(task_input)
+        await self.limiter.acquire(estimate)
+        resp = await call()
+        usage = getattr(resp, "usage", None)
+        if usage is not None and usage.prompt_tokens:
+            self.limiter.settle(estimate, usage.prompt_tokens + usage.completion_tokens)
+        return resp
+
+
+LLM_CACHE = LLMCache(LLM_CACHE_PATH, LLM_CACHE_TTL_DAYS * 86400, LLM_CACHE_MAX_ENTRIES)
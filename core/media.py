@@ -0,0 +1,133 @@
+#core/media.py
+import html as html_lib
+import os
+import shutil
+from pathlib import Path
+from PIL import Image
+
+from .config import *
+
+# Streamlit serves <app dir>/static/ at app/static/ when server.enableStaticServing
+# is on (see .streamlit/config.toml), so story media is published there.
+MEDIA_DIR = Path(__file__).resolve().parents[1] / "static" / "media"
+MEDIA_URL = "app/static/media"
+THUMB_WIDTHS = (320, 640)
+THUMB_QUALITY = 80
+
+
+def _publish(src: Path, dest: Path):
+    # Re-published when the story PNG is replaced (e.g. by regenerate_scene)
+    if dest.exists() and os.path.samefile(src, dest):
+        return
+    tmp = dest.with_name(dest.name + ".tmp")
+    tmp.unlink(missing_ok=True)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+
+def _thumbnail(image: Image.Image, width: int, dest: Path):
+    thumb = image.convert("RGB")
+    thumb.thumbnail((width, width * 4), Image.LANCZOS)
+    tmp = dest.with_name(dest.name + ".tmp")
+    thumb.save(tmp, format="WEBP", quality=THUMB_QUALITY, method=4)
+    os.replace(tmp, dest)
+
+
+def build_media(story_id: str, image_paths: list, images: list | None = None, force: bool = False) -> list[dict]:
+    # Publishes every story image (full-res PNG, hard-linked) plus WebP
+    # thumbnails under MEDIA_DIR/<story_id>/ and returns their URLs. Existing
+    # files are reused, so older stories only pay for this once. force rebuilds
+    # the thumbnails: a PNG linked from the image cache can be older than them.
+    out_dir = MEDIA_DIR / story_id
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    media = []
+    for i, img_path in enumerate(image_paths):
+        img_path = Path(img_path)
+        stem = img_path.stem
+        _publish(img_path, out_dir / img_path.name)
+
+        thumbs = [(w, out_dir / f"{stem}_{w}.webp") for w in THUMB_WIDTHS]
+        src_mtime = img_path.stat().st_mtime
+        if force or not all(p.exists() and p.stat().st_mtime >= src_mtime for _, p in thumbs):
+            image = images[i] if images is not None else Image.open(img_path)
+            for w, p in thumbs:
+                _thumbnail(image, w, p)
+
+        base = f"{MEDIA_URL}/{story_id}"
+        media.append({
+            "src": f"{base}/{stem}_{THUMB_WIDTHS[-1]}.webp",
+            "srcset": ", ".join(f"{base}/{stem}_{w}.webp {w}w" for w in THUMB_WIDTHS),
+            "full": f"{base}/{img_path.name}",
+        })
+    return media
+
+
+def gallery_html(name: str, scenes: list[str], media: list[dict]) -> str:
+    # Cards show the srcset thumbnails; the full-resolution PNG is only
+    # fetched when a card is clicked (opens in a new tab).
+    cards = "".join(
+        f'''
+          <a class="card" href="{m['full']}" target="_blank" rel="noopener">
+            <img src="{m['src']}" srcset="{m['srcset']}"
+                 sizes="(max-width: 700px) 100vw, (max-width: 1200px) 50vw, (max-width: 1600px) 33vw, 25vw"
+                 loading="lazy" decoding="async">
+            <div class="caption">
+              {html_lib.escape(scenes[i])}
+              <div class="counter">{i+1}/{len(media)}</div>
+            </div>
+          </a>
+        '''
+        for i, m in enumerate(media)
+    )
+
+    return f"""
+    <style>
+      .container {{ max-width: 2400px; margin: 30px auto; padding: 0 20px; }}
+      .title {{ text-align: center; font-size: 36px; font-weight: bold; margin-bottom: 40px;
+                background: linear-gradient(135deg, #667eea, #764ba2); -webkit-background-clip: text;
+                -webkit-text-fill-color: transparent; }}
+      .grid {{ display: grid; grid-template-columns: repeat(4, 1fr); gap: 20px; }}
+      .card {{ position: relative; display: block; border-radius: 12px; overflow: hidden; cursor: zoom-in;
+               box-shadow: 0 8px 25px rgba(0,0,0,0.12); background: #fff; color: inherit; text-decoration: none; }}
+      .card img {{ width: 100%; height: auto; display: block; aspect-ratio: auto {WIDTH} / {HEIGHT}; }}
+      .caption {{
+          position: absolute;
+          bottom: 0; left: 0; right: 0;
+          padding: 12px 16px;
+          color: #fff;
+          font-weight: 800;
+          font-size: 16px;
+          line-height: 1.3;
+          text-shadow:
+            -2px -2px 0 rgba(0,0,0,0.8),
+             2px -2px 0 rgba(0,0,0,0.8),
+            -2px  2px 0 rgba(0,0,0,0.8),
+             2px  2px 0 rgba(0,0,0,0.8);
+      }}
+      .counter {{
+          position: absolute;
+          bottom: 8px; right: 12px;
+          font-size: 14px; font-weight: 900;
+          color: #e6f5ff;
+          text-shadow:
+            -1px -1px 0 rgba(0,0,0,0.9),
+             1px -1px 0 rgba(0,0,0,0.9),
+            -1px  1px 0 rgba(0,0,0,0.9),
+             1px  1px 0 rgba(0,0,0,0.9);
+      }}
+      @media (max-width: 1600px) {{ .grid {{ grid-template-columns: repeat(3, 1fr); }} .caption {{ font-size: 15px; }} }}
+      @media (max-width: 1200px) {{ .grid {{ grid-template-columns: repeat(2, 1fr); }} .caption {{ font-size: 14px; }} }}
+      @media (max-width: 700px)  {{ .grid {{ grid-template-columns: 1fr; }} .caption {{ font-size: 13px; }} }}
+    </style>
+
+    <div class="container">
+      <div class="title">Personalized AI Story for {html_lib.escape(name)}</div>
+      <div class="grid">
+        {cards}
+      </div>
+    </div>
+    """
@@ -1,21 +1,520 @@
 #core/pipeline.py
-from diffusers import StableDiffusionXLPipeline  
+import copy
+import os
+import re
+import sys
+import threading
+import time
+from pathlib import Path
+from diffusers import (
+    StableDiffusionXLPipeline,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    EulerDiscreteScheduler,
+    LCMScheduler,
+    UniPCMultistepScheduler,
+)
 import torch
 
-def build_pipeline(hf_token: str | None = None):
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    dtype = torch.float16 if device == "cuda" else torch.float32
+from .config import *
+
+
+# Process-wide registry: one loaded pipeline per (model_id, dtype, device,
+# profile, lora, backend), shared by every Streamlit session and rerun living in this
+# process. Quality presets that only change the scheduler are cheap views over
+# the same weights, kept in the entry's "views".
+_PIPELINES: dict[tuple, dict] = {}
+_LOCK = threading.RLock()
+# One lock per registry key, so only loads of the same pipeline wait on each other
+_LOAD_LOCKS: dict[tuple, threading.Lock] = {}
+_STATS = {"loads": 0, "hits": 0, "evictions": 0, "load_seconds": 0.0}
+_STATS_HOOKS = []
+# Measured diffusion time per quality preset, fed by record_render()
+_RENDERS: dict[str, dict] = {}
+
+SCHEDULERS = {
+    "euler": (EulerDiscreteScheduler, {}),
+    "euler_a": (EulerAncestralDiscreteScheduler, {}),
+    "dpmpp_2m_karras": (DPMSolverMultistepScheduler, {"algorithm_type": "dpmsolver++", "use_karras_sigmas": True}),
+    "unipc": (UniPCMultistepScheduler, {}),
+    "lcm": (LCMScheduler, {}),
+}
+
+
+def default_device() -> str:
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def cpu_supports_bf16() -> bool:
+    try:
+        flags = Path("/proc/cpuinfo").read_text()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def default_dtype(device: str, profile: str = MEMORY_PROFILE) -> torch.dtype:
+    if device.startswith("cuda"):
+        return torch.float16
+    if MEMORY_PROFILES[profile]["cpu_bf16"] and cpu_supports_bf16():
+        return torch.bfloat16
+    return torch.float32
+
+
+def _slug(*parts) -> str:
+    return "--".join(re.sub(r"[^A-Za-z0-9._-]+", "-", str(p)) for p in parts if p)
+
+
+def _fused_checkpoint(hf_token: str | None, model_id: str, lora: str) -> str:
+    # Exporters read a plain diffusers checkpoint, so the LoRA is fused and saved once first
+    path = COMPILED_DIR / "fused" / _slug(model_id, lora)
+    if not (path / "model_index.json").exists():
+        pipe = StableDiffusionXLPipeline.from_pretrained(model_id, use_safetensors=True, token=hf_token)
+        pipe.load_lora_weights(lora, token=hf_token)
+        pipe.fuse_lora()
+        pipe.unload_lora_weights()
+        pipe.save_pretrained(path)
+    return str(path)
+
+
+def _build_exported(
+    backend: str,
+    hf_token: str | None,
+    model_id: str,
+    device: str,
+    lora: str | None,
+):
+    # ONNX / OpenVINO graphs are exported on first use and loaded from disk afterwards
+    try:
+        if backend == "onnx":
+            from optimum.onnxruntime import ORTStableDiffusionXLPipeline as pipeline_cls
+        else:
+            from optimum.intel import OVStableDiffusionXLPipeline as pipeline_cls
+    except ImportError as e:
+        extra = "onnxruntime" if backend == "onnx" else "openvino"
+        raise ImportError(f"The {backend!r} backend needs `pip install optimum[{extra}]`.") from e
+
+    path = COMPILED_DIR / backend / _slug(model_id, lora)
+    kwargs = {}
+    if backend == "onnx":
+        kwargs["provider"] = "CUDAExecutionProvider" if device.startswith("cuda") else "CPUExecutionProvider"
+
+    if (path / "model_index.json").exists():
+        pipe = pipeline_cls.from_pretrained(path, **kwargs)
+    else:
+        source = _fused_checkpoint(hf_token, model_id, lora) if lora else model_id
+        pipe = pipeline_cls.from_pretrained(source, export=True, token=hf_token, **kwargs)
+        pipe.save_pretrained(path)
+
+    if backend == "openvino":
+        pipe.compile()
+    # Keep the original model id for image cache keys
+    pipe.register_to_config(_name_or_path=model_id)
+    # images.py renders these through their plain prompt API (see exported_backend)
+    pipe.exported_backend = backend
+    return pipe
+
+
+def exported_backend(pipe) -> str | None:
+    # "onnx" / "openvino" for optimum pipelines. They take prompts and numpy
+    # generators only: no prompt embeddings, step callbacks or torch generators.
+    return getattr(pipe, "exported_backend", None)
+
+
+def build_pipeline(
+    hf_token: str | None = None,
+    model_id: str = MODEL_ID,
+    device: str | None = None,
+    dtype: torch.dtype | None = None,
+    profile: str = MEMORY_PROFILE,
+    lora: str | None = None,
+    backend: str = INFERENCE_BACKEND,
+):
+    if profile not in MEMORY_PROFILES:
+        raise ValueError(f"Unknown memory profile {profile!r}, expected one of {sorted(MEMORY_PROFILES)}.")
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}, expected one of {list(INFERENCE_BACKENDS)}.")
+    opts = MEMORY_PROFILES[profile]
+    device = device or default_device()
+
+    # Exported graphs manage their own precision and memory, so the profile doesn't apply
+    if backend in ("onnx", "openvino"):
+        return _build_exported(backend, hf_token, model_id, device, lora)
+
+    dtype = dtype or default_dtype(device, profile)
 
     pipe = StableDiffusionXLPipeline.from_pretrained(
-        "stabilityai/stable-diffusion-xl-base-1.0",
+        model_id,
         torch_dtype=dtype,
         use_safetensors=True,
-        variant="fp16" if dtype == torch.float16 else None,
+        # bf16 is loaded from the fp16 weights too: half the download and RAM of fp32
+        variant="fp16" if dtype in (torch.float16, torch.bfloat16) else None,
         token=hf_token,
     )
 
-    pipe = pipe.to(device)
-    if device == "cuda":
+    if lora:
+        # Fused into the UNet once at load time, so sampling pays nothing extra (needs peft)
+        pipe.load_lora_weights(lora, token=hf_token)
+        pipe.fuse_lora()
+        pipe.unload_lora_weights()
+
+    if opts["channels_last"]:
+        pipe.unet.to(memory_format=torch.channels_last)
+
+    offload = opts["offload"] if device.startswith("cuda") else None
+    if offload == "sequential":
+        pipe.enable_sequential_cpu_offload(device=device)
+    elif offload == "model":
+        pipe.enable_model_cpu_offload(device=device)
+    else:
+        pipe = pipe.to(device)
+
+    if opts["attention_slicing"]:
         pipe.enable_attention_slicing()
+    if opts["vae_slicing"]:
+        pipe.vae.enable_slicing()
+    if opts["vae_tiling"]:
+        pipe.vae.enable_tiling()
+
+    if backend == "compile":
+        # Compilation happens on the first call; inductor's on-disk caches make
+        # later processes reuse the generated kernels instead of rebuilding them.
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", str((COMPILED_DIR / "inductor").resolve()))
+        os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+        pipe.unet = torch.compile(pipe.unet)
+    elif backend == "ipex":
+        try:
+            import intel_extension_for_pytorch as ipex
+        except ImportError as e:
+            raise ImportError("The 'ipex' backend needs `pip install intel-extension-for-pytorch`.") from e
+        pipe.unet = ipex.optimize(pipe.unet.eval(), dtype=dtype, inplace=True)
+        pipe.vae = ipex.optimize(pipe.vae.eval(), dtype=dtype, inplace=True)
 
     return pipe
+
+
+def make_scheduler(name: str, base_config):
+    if name not in SCHEDULERS:
+        raise ValueError(f"Unknown scheduler {name!r}, expected one of {sorted(SCHEDULERS)}.")
+    cls, kwargs = SCHEDULERS[name]
+    return cls.from_config(base_config, **kwargs)
+
+
+def with_preset(pipe, preset: str):
+    # Same weights, own scheduler instance (schedulers keep per-run state).
+    # The preset name is what images.py reads steps and guidance from. A
+    # shallow copy works for every backend, including the optimum pipelines.
+    opts = QUALITY_PRESETS[preset]
+    base = pipe.scheduler
+    view = copy.copy(pipe)
+    view.scheduler = make_scheduler(opts["scheduler"], base.config) if opts["scheduler"] else base.__class__.from_config(base.config)
+    view.quality_preset = preset
+    return view
+
+
+def preset_options(pipe) -> tuple[str, dict]:
+    # Pipelines built without a preset render with the plain STEPS / GUIDANCE
+    name = getattr(pipe, "quality_preset", "standard")
+    return name, QUALITY_PRESETS[name]
+
+
+def record_render(pipe, seconds: float, images: int):
+    name, _ = preset_options(pipe)
+    with _LOCK:
+        entry = _RENDERS.setdefault(name, {"images": 0, "seconds": 0.0})
+        entry["images"] += images
+        entry["seconds"] += seconds
+
+
+def add_stats_hook(hook):
+    # hook(event, info) is called on "load", "hit" and "evict"
+    _STATS_HOOKS.append(hook)
+
+
+def _emit(event: str, info: dict):
+    for hook in list(_STATS_HOOKS):
+        hook(event, info)
+
+
+def free_memory(device: str) -> int | None:
+    if device.startswith("cuda"):
+        free, _ = torch.cuda.mem_get_info(torch.device(device))
+        return free
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _pipeline_key(
+    model_id: str,
+    device: str | None,
+    dtype: torch.dtype | None,
+    profile: str,
+    preset: str,
+    backend: str,
+) -> tuple:
+    if preset not in QUALITY_PRESETS:
+        raise ValueError(f"Unknown quality preset {preset!r}, expected one of {sorted(QUALITY_PRESETS)}.")
+    if profile not in MEMORY_PROFILES:
+        raise ValueError(f"Unknown memory profile {profile!r}, expected one of {sorted(MEMORY_PROFILES)}.")
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}, expected one of {list(INFERENCE_BACKENDS)}.")
+    device = device or default_device()
+    dtype = dtype or default_dtype(device, profile)
+    return (model_id, str(dtype), device, profile, QUALITY_PRESETS[preset]["lora"], backend)
+
+
+def _load(
+    key: tuple,
+    hf_token: str | None,
+    model_id: str,
+    device: str | None,
+    dtype: torch.dtype | None,
+    profile: str,
+) -> dict:
+    with _LOCK:
+        entry = _PIPELINES.get(key)
+        if entry is not None:
+            _STATS["hits"] += 1
+            _emit("hit", {"key": key})
+            return entry
+
+        load_lock = _LOAD_LOCKS.setdefault(key, threading.Lock())
+
+    with load_lock:
+        with _LOCK:
+            entry = _PIPELINES.get(key)
+            if entry is not None:
+                _STATS["hits"] += 1
+                _emit("hit", {"key": key})
+                return entry
+
+        evict_pipelines(device=key[2], min_free_bytes=PIPELINE_MIN_FREE_GB * 1024**3)
+
+        start = time.perf_counter()
+        pipe = build_pipeline(hf_token, model_id=model_id, device=device, dtype=dtype, profile=profile, lora=key[4], backend=key[5])
+        elapsed = time.perf_counter() - start
+
+        entry = {"pipe": pipe, "views": {}, "refs": 0, "load_seconds": elapsed, "last_used": time.time()}
+        with _LOCK:
+            _PIPELINES[key] = entry
+            _STATS["loads"] += 1
+            _STATS["load_seconds"] += elapsed
+        _emit("load", {"key": key, "seconds": elapsed})
+        return entry
+
+
+def get_pipeline(
+    hf_token: str | None = None,
+    model_id: str = MODEL_ID,
+    device: str | None = None,
+    dtype: torch.dtype | None = None,
+    profile: str = MEMORY_PROFILE,
+    preset: str = QUALITY_PRESET,
+    backend: str = INFERENCE_BACKEND,
+):
+    key = _pipeline_key(model_id, device, dtype, profile, preset, backend)
+    entry = _load(key, hf_token, model_id, device, dtype, profile)
+    with _LOCK:
+        entry["refs"] += 1
+        entry["last_used"] = time.time()
+        view = entry["views"].get(preset)
+        if view is None:
+            view = entry["views"][preset] = with_preset(entry["pipe"], preset)
+    return view
+
+
+def release_pipeline(pipe):
+    with _LOCK:
+        for entry in _PIPELINES.values():
+            if entry["pipe"] is pipe or any(v is pipe for v in entry["views"].values()):
+                entry["refs"] = max(0, entry["refs"] - 1)
+                entry["last_used"] = time.time()
+                return
+
+
+def warmup_pipeline(
+    hf_token: str | None = None,
+    model_id: str = MODEL_ID,
+    device: str | None = None,
+    dtype: torch.dtype | None = None,
+    profile: str = MEMORY_PROFILE,
+    preset: str = QUALITY_PRESET,
+    backend: str = INFERENCE_BACKEND,
+    background: bool = False,
+):
+    key = _pipeline_key(model_id, device, dtype, profile, preset, backend)
+    if not background:
+        return _load(key, hf_token, model_id, device, dtype, profile)["pipe"]
+
+    thread = threading.Thread(
+        target=_load,
+        args=(key, hf_token, model_id, device, dtype, profile),
+        name="sdxl-warmup",
+        daemon=True,
+    )
+    thread.start()
+    return thread
+
+
+def evict_pipelines(device: str | None = None, min_free_bytes: int | None = None) -> int:
+    # Drops idle (refs == 0) pipelines, least recently used first. With
+    # min_free_bytes set, stops as soon as the device has that much free memory.
+    evicted = 0
+    with _LOCK:
+        idle = sorted(
+            (k for k, e in _PIPELINES.items() if e["refs"] == 0 and (device is None or k[2] == device)),
+            key=lambda k: _PIPELINES[k]["last_used"],
+        )
+        for key in idle:
+            if min_free_bytes is not None:
+                free = free_memory(key[2])
+                if free is None or free >= min_free_bytes:
+                    break
+            del _PIPELINES[key]
+            evicted += 1
+            _STATS["evictions"] += 1
+            _emit("evict", {"key": key})
+
+    if evicted and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return evicted
+
+
+def pipeline_stats() -> dict:
+    with _LOCK:
+        return {
+            **_STATS,
+            "pipelines": [
+                {
+                    "model_id": k[0],
+                    "dtype": k[1],
+                    "device": k[2],
+                    "profile": k[3],
+                    "lora": k[4],
+                    "backend": k[5],
+                    "presets": sorted(e["views"]),
+                    "refs": e["refs"],
+                    "load_seconds": round(e["load_seconds"], 2),
+                }
+                for k, e in _PIPELINES.items()
+            ],
+            "seconds_per_image": {
+                name: round(r["seconds"] / r["images"], 3) for name, r in _RENDERS.items() if r["images"]
+            },
+        }
+
+
+def peak_rss_bytes() -> int:
+    import resource
+
+    # ru_maxrss is in KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def profile_pipeline(
+    pipe,
+    prompt: str = "a cozy cabin in the snow",
+    steps: int | None = None,
+    width: int = WIDTH,
+    height: int = HEIGHT,
+    guidance: float | None = None,
+) -> dict:
+    # Renders one image and reports per-denoising-step latency plus peak memory.
+    # Steps and guidance default to the pipeline's quality preset.
+    _, opts = preset_options(pipe)
+    steps = steps or opts["steps"]
+    guidance = opts["guidance"] if guidance is None else guidance
+    step_times = []
+    last = [time.perf_counter()]
+
+    def on_step_end(pipeline, step, timestep, callback_kwargs):
+        now = time.perf_counter()
+        step_times.append(now - last[0])
+        last[0] = now
+        return callback_kwargs
+
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+    # Exported pipelines have no step callback: only the total is reported
+    callback = {} if exported_backend(pipe) else {"callback_on_step_end": on_step_end}
+    start = time.perf_counter()
+    last[0] = start
+    with torch.inference_mode():
+        pipe(
+            prompt=prompt,
+            negative_prompt=NEGATIVE,
+            width=width,
+            height=height,
+            num_inference_steps=steps,
+            guidance_scale=guidance,
+            **callback,
+        )
+    total = time.perf_counter() - start
+
+    report = {
+        "steps": steps,
+        "seconds_per_image": round(total, 3),
+        "step_seconds_mean": round(sum(step_times) / len(step_times), 4) if step_times else None,
+        "step_seconds_max": round(max(step_times), 4) if step_times else None,
+        "peak_rss_mb": round(peak_rss_bytes() / 1024**2, 1),
+    }
+    if torch.cuda.is_available():
+        report["peak_cuda_mb"] = round(torch.cuda.max_memory_allocated() / 1024**2, 1)
+    return report
+
+
+def _profile_worker(profile: str, preset: str, backend: str, device: str | None, hf_token: str | None, queue):
+    start = time.perf_counter()
+    pipe = build_pipeline(hf_token, device=device, profile=profile, lora=QUALITY_PRESETS[preset]["lora"], backend=backend)
+    pipe = with_preset(pipe, preset)
+    report = {
+        "profile": profile,
+        "preset": preset,
+        "backend": backend,
+        "device": device or default_device(),
+        "dtype": str(getattr(pipe, "dtype", None)) if not exported_backend(pipe) else backend,
+        "load_seconds": round(time.perf_counter() - start, 2),
+        "rss_after_load_mb": round(peak_rss_bytes() / 1024**2, 1),
+    }
+    # The first call pays for kernel selection / compilation; time the second
+    warm = time.perf_counter()
+    profile_pipeline(pipe, steps=1)
+    report["first_call_seconds"] = round(time.perf_counter() - warm, 2)
+    report.update(profile_pipeline(pipe))
+    queue.put(report)
+
+
+def main(argv=None):
+    import argparse
+    import json
+    import multiprocessing as mp
+
+    parser = argparse.ArgumentParser(description="Measure seconds per image, step latency and peak memory per memory profile and quality preset.")
+    parser.add_argument("profiles", nargs="*", default=list(MEMORY_PROFILES))
+    parser.add_argument("--presets", nargs="+", default=[QUALITY_PRESET], choices=sorted(QUALITY_PRESETS))
+    parser.add_argument("--backends", nargs="+", default=[INFERENCE_BACKEND], choices=INFERENCE_BACKENDS)
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--hf-token", default=os.environ.get("HF_TOKEN"))
+    args = parser.parse_args(argv)
+
+    # One fresh process per run, otherwise peak RSS only ever goes up
+    ctx = mp.get_context("spawn")
+    for backend in args.backends:
+        for profile in args.profiles:
+            for preset in args.presets:
+                queue = ctx.Queue()
+                proc = ctx.Process(target=_profile_worker, args=(profile, preset, backend, args.device, args.hf_token, queue))
+                proc.start()
+                proc.join()
+                if proc.exitcode == 0:
+                    print(json.dumps(queue.get()))
+                else:
+                    print(json.dumps({"profile": profile, "preset": preset, "backend": backend, "error": proc.exitcode}))
+
+
+if __name__ == "__main__":
+    main()
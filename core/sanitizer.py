@@ -0,0 +1,147 @@
+#core/sanitizer.py
+import json
+import re
+from pathlib import Path
+
+from .config import *
+
+# Child-safe replacements, matched as whole words, case-insensitively
+DEFAULT_LEXICON = {
+    "gun": "snowball blaster",
+    "guns": "snowball blasters",
+    "weapon": "magic snow wand",
+    "weapons": "magic snow wands",
+    "knife": "carving knife for gingerbread",
+    "knives": "carving knives for gingerbread",
+    "sword": "candy cane sword",
+    "swords": "candy cane swords",
+    "war": "snowball tournament",
+    "battle": "snowball battle",
+    "battles": "snowball battles",
+    "fight": "playful snowball fight",
+    "fights": "playful snowball fights",
+    "fighting": "playing with snowballs",
+    "monster": "friendly monster",
+    "monsters": "friendly monsters",
+    "demon": "grumpy snow spirit",
+    "demons": "grumpy snow spirits",
+    "ghost": "shy winter ghost",
+    "ghosts": "shy winter ghosts",
+    "zombie": "sleepy snowwalker",
+    "zombies": "sleepy snowwalkers",
+    "blood": "red cranberry sauce",
+    "gore": "messy frosting",
+    "killing": "defeating in a snowball game",
+    "kill": "defeat in a snowball game",
+    "alcohol": "hot chocolate",
+    "beer": "gingerbread soda",
+    "wine": "sparkling cranberry juice",
+    "vodka": "extra-strong hot chocolate",
+    "whisky": "spiced apple cider",
+    "whiskey": "spiced apple cider",
+    "rum": "vanilla sugar syrup",
+    "drugs": "magic Christmas candies",
+    "drug": "magic Christmas candy",
+    "smoke": "chimney smoke from cozy houses",
+    "smoking": "chimney smoke from cozy houses",
+    "death": "the end of winter",
+    "dead": "fast asleep after a long snow day",
+}
+
+
+def _normalize(term: str) -> str:
+    return " ".join(term.lower().split())
+
+
+def load_lexicon(path: Path) -> dict[str, str]:
+    # JSON object {"term": "replacement"}, or a text file with one
+    # `term = replacement` per line (blank lines and # comments ignored)
+    path = Path(path)
+    text = path.read_text(encoding="utf-8")
+    if path.suffix.lower() == ".json":
+        return {str(k): str(v) for k, v in json.loads(text).items()}
+
+    lexicon = {}
+    for n, line in enumerate(text.splitlines(), 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        term, sep, replacement = line.partition("=")
+        if not sep or not term.strip() or not replacement.strip():
+            raise ValueError(f"{path}:{n}: expected 'term = replacement', got {line!r}")
+        lexicon[term.strip()] = replacement.strip()
+    return lexicon
+
+
+def _match_case(source: str, replacement: str) -> str:
+    if len(source) > 1 and source.isupper():
+        return replacement.upper()
+    if source[:1].isupper():
+        return replacement[:1].upper() + replacement[1:]
+    return replacement
+
+
+def _trie_pattern(terms) -> str:
+    # Prefix-factored alternation ("gun(?:s)?" rather than "guns|gun"), so the
+    # regex engine steps through shared prefixes once instead of per term.
+    # Longer continuations are tried first, and a term may end where another
+    # continues, so the longest term at a position wins.
+    trie = {}
+    for term in terms:
+        node = trie
+        for ch in term:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def build(node: dict) -> str:
+        end = "" in node
+        branches = [
+            (r"\s+" if ch == " " else re.escape(ch)) + build(child)
+            for ch, child in sorted(node.items())
+            if ch
+        ]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if end:
+            return f"(?:{body})?" if len(branches) > 1 or len(body) > 1 else f"{body}?"
+        return body
+
+    return build(trie)
+
+
+class Sanitizer:
+    # The whole lexicon compiled into one word-bounded, prefix-factored
+    # alternation and applied in a single pass. Replacement phrases are matched
+    # too and kept as they are, so already-sanitized text comes back unchanged
+    # ("snowball battle" never becomes "snowball snowball battle").
+
+    def __init__(self, lexicon: dict[str, str]):
+        self.replacements = {_normalize(k): v for k, v in lexicon.items()}
+        terms = set(self.replacements)
+        terms.update(_normalize(v) for v in self.replacements.values())
+        self.pattern = re.compile(rf"\b{_trie_pattern(terms)}\b", re.IGNORECASE)
+
+    def _replace(self, match: re.Match) -> str:
+        found = match.group(0)
+        replacement = self.replacements.get(_normalize(found))
+        if replacement is None:
+            return found
+        return _match_case(found, replacement)
+
+    def __call__(self, text: str) -> str:
+        return self.pattern.sub(self._replace, text)
+
+
+def build_sanitizer(lexicon_path: Path | None = SANITIZER_LEXICON_PATH) -> Sanitizer:
+    lexicon = dict(DEFAULT_LEXICON)
+    if lexicon_path:
+        lexicon.update(load_lexicon(lexicon_path))
+    return Sanitizer(lexicon)
+
+
+SANITIZER = build_sanitizer()
+
+
+def sanitize(text: str) -> str:
+    return SANITIZER(text)
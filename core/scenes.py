@@ -0,0 +1,193 @@
+#core/scenes.py
+import re
+
+from .config import *
+
+# Scene separators as models actually write them: [SCENE_BREAK], [Scene Break], [ SCENE-BREAK ]
+SCENE_BREAK = re.compile(r"\[\s*scene[\s_-]*break\s*\]", re.IGNORECASE)
+# Longest separator a stream can leave half-written at the end of a delta
+_BREAK_LOOKBEHIND = 32
+
+# Leftover numbering/titles at the start of a scene: "Scene 3:", "3.", "2)"
+_LEADING_LABEL = re.compile(r"^(?:scene\s*\d+\s*[:.)-]?|\d+\s*[.):-])\s*", re.IGNORECASE)
+
+# A sentence ends at ., ! or ? (or an ellipsis), optionally followed by closing
+# quotes/brackets, when the next word starts a new sentence or the text ends.
+_SENTENCE_END = re.compile(r"""(?:[.!?]+|…)["'”’)\]]*(?=\s+["'“‘(\[]*[A-Z0-9]|\s*$)""")
+_ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "st", "mt", "jr", "sr", "prof", "vs", "etc"}
+
+
+def split_sentences(text: str) -> list[str]:
+    sentences = []
+    start = 0
+    for m in _SENTENCE_END.finditer(text):
+        if m.group(0) == ".":
+            word = text[text.rfind(" ", start, m.start()) + 1:m.start()]
+            # "Mrs. Claus", "St. Nicholas", initials like "J. Frost"
+            if word.lower() in _ABBREVIATIONS or (len(word) == 1 and word.isupper()):
+                continue
+        sentence = text[start:m.end()].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = m.end()
+    tail = text[start:].strip()
+    if tail:
+        sentences.append(tail)
+    return sentences
+
+
+def _clean(text: str) -> str:
+    return _LEADING_LABEL.sub("", " ".join(text.split()))
+
+
+def _pack(sentences: list[str], max_chars: int) -> list[str]:
+    # Greedy: consecutive sentences share a scene while they fit in max_chars.
+    # A single sentence longer than that stays whole.
+    chunks = []
+    current = []
+    size = 0
+    for sentence in sentences:
+        if current and size + 1 + len(sentence) > max_chars:
+            chunks.append(" ".join(current))
+            current = []
+            size = 0
+        size += len(sentence) + (1 if current else 0)
+        current.append(sentence)
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+def _spread(sentences: list[str], count: int) -> list[str]:
+    # count scenes of consecutive sentences, as even as possible
+    count = max(1, min(count, len(sentences)))
+    size, extra = divmod(len(sentences), count)
+    chunks = []
+    start = 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(" ".join(sentences[start:end]))
+        start = end
+    return chunks
+
+
+class SceneSegmenter:
+    # Incremental scene splitter for a streamed story. feed() takes each text
+    # delta and returns the scenes it completed; close() flushes the rest.
+    # Scenes are cleaned up, long ones re-split on sentence boundaries, and the
+    # book is held to max_scenes scenes and max_words words. Whatever is cut is
+    # counted in dropped_scenes / dropped_words (see report()).
+
+    def __init__(
+        self,
+        min_scenes: int = MIN_SCENES,
+        max_scenes: int = MAX_SCENES,
+        max_words: int = MAX_WORDS,
+        max_chars: int = MAX_SCENE_CHARS,
+    ):
+        self.min_scenes = min_scenes
+        self.max_scenes = max_scenes
+        self.max_words = max_words
+        self.max_chars = max_chars
+        self.scenes = []
+        self.words = 0
+        self.dropped_scenes = 0
+        self.dropped_words = 0
+        self.closed = False
+        self._parts = []
+        self._buffer = ""
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    def feed(self, delta: str) -> list[str]:
+        if not delta:
+            return []
+        self._parts.append(delta)
+        # Only the new text (plus a possibly half-written separator) is searched
+        pos = max(0, len(self._buffer) - _BREAK_LOOKBEHIND)
+        self._buffer += delta
+
+        scenes = []
+        while (m := SCENE_BREAK.search(self._buffer, pos)) is not None:
+            scenes += self._accept(_clean(self._buffer[:m.start()]))
+            self._buffer = self._buffer[m.end():]
+            pos = 0
+        return scenes
+
+    def close(self) -> list[str]:
+        # Text after the last separator is a scene too. When the model left out
+        # the separators, it is spread over enough scenes to reach min_scenes.
+        rest = _clean(self._buffer)
+        self._buffer = ""
+        self.closed = True
+
+        scenes = []
+        missing = self.min_scenes - len(self.scenes)
+        if rest and missing > 1:
+            sentences = split_sentences(rest)
+            for chunk in _spread(sentences, max(missing, min(len(sentences), self.max_scenes - len(self.scenes)))):
+                scenes += self._accept(chunk)
+        else:
+            scenes += self._accept(rest)
+
+        if not self.scenes:
+            raise ValueError("No scenes generated. Check [SCENE_BREAK] formatting.")
+        return scenes
+
+    def _accept(self, text: str) -> list[str]:
+        if not text:
+            return []
+        if len(text) > self.max_chars:
+            chunks = _pack(split_sentences(text), self.max_chars)
+        else:
+            chunks = [text]
+
+        accepted = []
+        for chunk in chunks:
+            chunk = self._fit(chunk)
+            if chunk:
+                self.scenes.append(chunk)
+                accepted.append(chunk)
+        return accepted
+
+    def _fit(self, chunk: str) -> str | None:
+        words = len(chunk.split())
+        if len(self.scenes) >= self.max_scenes or self.words >= self.max_words:
+            self.dropped_scenes += 1
+            self.dropped_words += words
+            return None
+        if self.words + words > self.max_words:
+            # Keep the sentences that still fit in the word budget
+            kept = []
+            budget = self.max_words - self.words
+            for sentence in split_sentences(chunk):
+                n = len(sentence.split())
+                if n > budget:
+                    break
+                kept.append(sentence)
+                budget -= n
+            self.dropped_words += words - sum(len(s.split()) for s in kept)
+            if not kept:
+                self.dropped_scenes += 1
+                return None
+            chunk = " ".join(kept)
+            words = len(chunk.split())
+        self.words += words
+        return chunk
+
+    def report(self) -> dict:
+        return {
+            "scenes": len(self.scenes),
+            "words": self.words,
+            "dropped_scenes": self.dropped_scenes,
+            "dropped_words": self.dropped_words,
+            "below_min_scenes": len(self.scenes) < self.min_scenes,
+        }
+
+
+def split_scenes(story: str, **limits) -> list[str]:
+    # The whole-text version, for stories that are already complete
+    segmenter = SceneSegmenter(**limits)
+    return segmenter.feed(story) + segmenter.close()
@@ -1,10 +1,74 @@
 #core/story.py
+import asyncio
+import json
+import queue
+import re
+import random
+import time
 from datapizza.agents import Agent
 from .config import *
+from .tracing import stage
+from .sanitizer import sanitize
+from .scenes import SceneSegmenter
+from . import aio
 
 
-def generate_story(story_agent: Agent, name: str, age: int, keywords: str) -> str:
-    prompt = f"""
+def _is_rate_limited(err: Exception) -> bool:
+    status = getattr(err, "status_code", None) or getattr(getattr(err, "response", None), "status_code", None)
+    return status == 429 or "rate limit" in str(err).lower()
+
+
+def _retry_after(err: Exception) -> float | None:
+    headers = getattr(getattr(err, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff(err: Exception, attempt: int) -> float:
+    return (_retry_after(err) or min(30.0, 2 ** attempt)) + random.uniform(0, 0.5)
+
+
+def _annotate(span, resp):
+    usage = getattr(resp, "usage", None)
+    if usage is not None:
+        span.set("prompt_tokens", usage.prompt_tokens)
+        span.set("completion_tokens", usage.completion_tokens)
+    if getattr(resp, "cached", False):
+        span.set("cached", True)
+    if getattr(resp, "coalesced", False):
+        span.set("coalesced", True)
+
+
+def run_agent(agent: Agent, prompt: str, retries: int = LLM_MAX_RETRIES):
+    for attempt in range(retries + 1):
+        try:
+            with stage("llm_call", agent=getattr(agent, "name", None) or "agent", attempt=attempt) as span:
+                resp = agent.run(prompt)
+                _annotate(span, resp)
+            return resp
+        except Exception as e:
+            if attempt == retries or not _is_rate_limited(e):
+                raise
+            time.sleep(_backoff(e, attempt))
+
+
+async def a_run_agent(agent: Agent, prompt: str, retries: int = LLM_MAX_RETRIES, **kwargs):
+    for attempt in range(retries + 1):
+        try:
+            with stage("llm_call", agent=getattr(agent, "name", None) or "agent", attempt=attempt) as span:
+                resp = await agent.a_run(prompt, **kwargs)
+                _annotate(span, resp)
+            return resp
+        except Exception as e:
+            if attempt == retries or not _is_rate_limited(e):
+                raise
+            await asyncio.sleep(_backoff(e, attempt))
+
+
+def story_prompt(name: str, age: int, keywords: str) -> str:
+    return f"""
 You are writing a story split into scenes.
 
 TASK:
@@ -22,12 +86,114 @@ HARD CONSTRAINTS (ALL MUST BE RESPECTED):
 - Output ONLY the scenes with [SCENE_BREAK] separators.
 """.strip()
 
-    resp = story_agent.run(prompt)
-    return resp.text.strip()
 
+def generate_story(story_agent: Agent, name: str, age: int, keywords: str) -> str:
+    with stage("story"):
+        resp = run_agent(story_agent, story_prompt(name, age, keywords))
+    return sanitize(resp.text.strip())
 
-def generate_image_prompt(prompt_agent: Agent, scene_text: str, character_desc: str, style_preset: str) -> str:
-    prompt = f"""
+
+async def a_generate_story(story_agent: Agent, name: str, age: int, keywords: str) -> str:
+    with stage("story"):
+        resp = await a_run_agent(story_agent, story_prompt(name, age, keywords))
+    return sanitize(resp.text.strip())
+
+
+async def a_stream_story(story_agent: Agent, name: str, age: int, keywords: str, retries: int = LLM_MAX_RETRIES):
+    # Yields the story text as the model writes it. Agents without a_stream
+    # (plain datapizza Agents) answer in one piece. A rate-limited request is
+    # retried only if nothing has been yielded yet.
+    prompt = story_prompt(name, age, keywords)
+    stream = getattr(story_agent, "a_stream", None)
+    for attempt in range(retries + 1):
+        started = False
+        try:
+            with stage("llm_call", agent=getattr(story_agent, "name", None) or "agent", attempt=attempt, stream=True) as span:
+                start = time.perf_counter()
+                if stream is None:
+                    resp = await story_agent.a_run(prompt)
+                    _annotate(span, resp)
+                    started = True
+                    yield resp.text
+                else:
+                    async for chunk in stream(prompt):
+                        _annotate(span, chunk)
+                        if chunk.delta:
+                            if not started:
+                                span.set("first_token_seconds", round(time.perf_counter() - start, 4))
+                            started = True
+                            yield chunk.delta
+            return
+        except Exception as e:
+            if started or attempt == retries or not _is_rate_limited(e):
+                raise
+            await asyncio.sleep(_backoff(e, attempt))
+
+
+class StoryStream:
+    # Starts streaming the story on the shared LLM loop as soon as it is
+    # created. Iterating it with `async for` (on that loop, one consumer) yields
+    # each sanitized scene the moment its [SCENE_BREAK] arrives; .scenes fills
+    # up as it goes, and result() blocks until the whole story is in.
+
+    def __init__(self, story_agent: Agent, name: str, age: int, keywords: str, segmenter: SceneSegmenter | None = None):
+        self.segmenter = segmenter or SceneSegmenter()
+        self.scenes = []
+        self._queue = asyncio.Queue()
+        self._future = aio.submit(self._run(story_agent, name, age, keywords))
+
+    async def _run(self, story_agent: Agent, name: str, age: int, keywords: str) -> str:
+        try:
+            with stage("story", stream=True) as span:
+                start = time.perf_counter()
+                async for delta in a_stream_story(story_agent, name, age, keywords):
+                    for scene in self.segmenter.feed(delta):
+                        if not self.scenes:
+                            span.set("first_scene_seconds", round(time.perf_counter() - start, 4))
+                        self._put(scene)
+                for scene in self.segmenter.close():
+                    self._put(scene)
+                span.set("scenes", len(self.scenes))
+        except BaseException as e:
+            self._queue.put_nowait(e)
+            raise
+        self._queue.put_nowait(None)
+        return self.text
+
+    def _put(self, scene: str):
+        scene = sanitize(scene)
+        self.scenes.append(scene)
+        self._queue.put_nowait(scene)
+
+    async def __aiter__(self):
+        while (item := await self._queue.get()) is not None:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    @property
+    def text(self) -> str:
+        return sanitize(self.segmenter.text.strip())
+
+    @property
+    def max_scenes(self) -> int:
+        return self.segmenter.max_scenes
+
+    def report(self) -> dict:
+        return {"mode": "multi_call", **self.segmenter.report()}
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    def result(self) -> str:
+        return self._future.result()
+
+    def cancel(self):
+        self._future.cancel()
+
+
+def image_prompt_request(scene_text: str, character_desc: str, style_preset: str) -> str:
+    return f"""
 Create ONE Stable Diffusion prompt.
 
 Scene:
@@ -52,13 +218,77 @@ Hard rules:
 Output ONLY the prompt.
 """.strip()
 
-    resp = prompt_agent.run(prompt)
-    return resp.text.strip()
+
+def generate_image_prompt(prompt_agent: Agent, scene_text: str, character_desc: str, style_preset: str) -> str:
+    with stage("scene_prompt"):
+        resp = run_agent(prompt_agent, image_prompt_request(scene_text, character_desc, style_preset))
+    return sanitize(resp.text.strip())
 
 
+async def a_generate_image_prompt(prompt_agent: Agent, scene_text: str, character_desc: str, style_preset: str) -> str:
+    with stage("scene_prompt"):
+        resp = await a_run_agent(prompt_agent, image_prompt_request(scene_text, character_desc, style_preset))
+    return sanitize(resp.text.strip())
 
-def generate_character_desc(prompt_agent: Agent, name: str, age: int, keywords: str) -> str:
-    prompt = f"""
+
+async def _aiter(items):
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+def iter_image_prompts(
+    prompt_agent: Agent,
+    scene_texts,
+    character_desc: str,
+    style_preset: str,
+    max_workers: int = PROMPT_WORKERS,
+    builder=None,
+):
+    # scene_texts is a list, or a StoryStream still being written. Requests go
+    # out on the shared LLM event loop as scenes arrive (at most max_workers in
+    # flight); prompts are yielded in scene order as soon as each one is back,
+    # so rendering can start before the last one (or the last scene) arrives.
+    # With a builder (scene_text -> prompt) no request is made at all.
+    slots = asyncio.Semaphore(max_workers)
+    ready = queue.Queue()
+
+    async def one(scene_text: str) -> str:
+        if builder is not None:
+            with stage("scene_prompt", mode="template"):
+                return builder(scene_text)
+        async with slots:
+            return await a_generate_image_prompt(prompt_agent, scene_text, character_desc, style_preset)
+
+    async def feed():
+        try:
+            async for scene_text in _aiter(scene_texts):
+                ready.put(aio.submit(one(scene_text)))
+        finally:
+            ready.put(None)
+
+    feeder = aio.submit(feed())
+    futures = []
+    try:
+        while (future := ready.get()) is not None:
+            futures.append(future)
+            yield future.result()
+        # Surfaces an error from the scene stream itself
+        feeder.result()
+    finally:
+        feeder.cancel()
+        while not ready.empty():
+            futures.append(ready.get())
+        for future in futures:
+            if future is not None:
+                future.cancel()
+
+
+def character_prompt(name: str, age: int, keywords: str) -> str:
+    return f"""
 You are creating a highly detailed visual description of a recurring character
 for a cozy, warm Christmas storybook, optimized for Stable Diffusion prompts.
 
@@ -94,5 +324,279 @@ STYLE REQUIREMENTS:
 Output ONLY the final description sentence, nothing else.
 """.strip()
 
-    resp = prompt_agent.run(prompt)
-    return resp.text.strip()
+
+def generate_character_desc(prompt_agent: Agent, name: str, age: int, keywords: str) -> str:
+    with stage("character_desc"):
+        resp = run_agent(prompt_agent, character_prompt(name, age, keywords))
+    return sanitize(resp.text.strip())
+
+
+async def a_generate_character_desc(prompt_agent: Agent, name: str, age: int, keywords: str) -> str:
+    with stage("character_desc"):
+        resp = await a_run_agent(prompt_agent, character_prompt(name, age, keywords))
+    return sanitize(resp.text.strip())
+
+
+# One-shot mode: character, scenes and prompts in a single JSON reply
+ONE_SHOT_SCHEMA = {
+    "title": "storybook",
+    "type": "object",
+    "properties": {
+        "character_desc": {"type": "string"},
+        "scenes": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"text": {"type": "string"}, "prompt": {"type": "string"}},
+                "required": ["text", "prompt"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["character_desc", "scenes"],
+    "additionalProperties": False,
+}
+
+
+def one_shot_prompt(name: str, age: int, keywords: str, style_preset: str) -> str:
+    return f"""
+Write a Christmas storybook for {name}, age {age}, as ONE JSON object.
+Themes: {keywords}
+
+JSON schema:
+{json.dumps(ONE_SHOT_SCHEMA)}
+
+character_desc:
+- How the main character LOOKS, for an illustrator: ONE sentence, maximum 45 words, third person.
+- The character must clearly look like a {age}-year-old in face and body proportions.
+- In this order: apparent age and body type; skin tone, eye color, hair; distinctive features; winter top, bottoms and shoes with colors; 1–2 accessories.
+- No name, no numeric age, no background, no actions, no art style.
+
+scenes:
+- BETWEEN {MIN_SCENES} and {MAX_SCENES} scenes, at most {MAX_WORDS} words of story text in total.
+- text: 1–2 short sentences of the story. No numbering, no titles.
+- prompt: ONE Stable Diffusion prompt for that scene, under 70 words. It MUST restate character_desc unchanged and include this style exactly: {style_preset}
+  Warm golden/amber/orange tones, soft candlelight and fireplace glow, 2D watercolor storybook illustration with ink outlines, hygge atmosphere. No cold colors, no photorealism, no text/letters/logos.
+
+Output ONLY the JSON object.
+""".strip()
+
+
+def one_shot_repair_prompt(name: str, age: int, keywords: str, style_preset: str, book: dict, problems: dict) -> str:
+    # Asks only for what failed validation, with the valid parts as context
+    wanted = {}
+    if "character_desc" in problems:
+        wanted["character_desc"] = "string: ONE sentence, max 45 words, how the main character LOOKS"
+    if "scenes" in problems:
+        wanted["scenes"] = (
+            f"array of {MIN_SCENES}-{MAX_SCENES} objects {{\"text\": 1–2 short sentences, "
+            f"\"prompt\": Stable Diffusion prompt under 70 words}}, at most {MAX_WORDS} words of text in total"
+        )
+    elif "prompts" in problems:
+        wanted["prompts"] = "object mapping each scene number below to its Stable Diffusion prompt (string, under 70 words)"
+
+    context = [f"Storybook for {name}, age {age}. Themes: {keywords}"]
+    if "character_desc" not in problems:
+        context.append(f"Character (restate it unchanged in every prompt): {book['character_desc']}")
+    if "prompts" in problems and "scenes" not in problems:
+        context.append("Scenes that need a prompt:")
+        context += [f"{i}: {book['scenes'][i - 1]['text']}" for i in problems["prompts"]]
+
+    issues = "\n".join(f"- {field}: {issue if isinstance(issue, str) else 'none for scenes ' + ', '.join(map(str, issue))}" for field, issue in problems.items())
+    return f"""
+Your previous JSON reply had these problems:
+{issues}
+
+{chr(10).join(context)}
+
+Reply with ONE JSON object containing ONLY these fields:
+{json.dumps(wanted, ensure_ascii=False, indent=2)}
+
+Every prompt MUST include this style exactly: {style_preset}
+Warm golden tones, candlelight, 2D watercolor storybook illustration, no photorealism, no text/letters/logos.
+
+Output ONLY the JSON object.
+""".strip()
+
+
+def parse_json_reply(text: str):
+    # Tolerates ```json fences and chatter around the object
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text.strip())
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end < start:
+        return None
+    try:
+        return json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+
+
+def _text(value) -> str | None:
+    if not isinstance(value, str):
+        return None
+    value = " ".join(value.split())
+    return value or None
+
+
+def validate_one_shot(data, min_scenes: int = MIN_SCENES, max_scenes: int = MAX_SCENES):
+    # -> (book, problems). book keeps every valid field; problems maps
+    # "character_desc" / "scenes" to a reason and "prompts" to the 1-based
+    # scene numbers whose prompt is missing or empty.
+    book = {"character_desc": None, "scenes": [], "dropped_scenes": 0}
+    problems = {}
+    if not isinstance(data, dict):
+        return book, {"character_desc": "reply was not a JSON object", "scenes": "reply was not a JSON object"}
+
+    book["character_desc"] = _text(data.get("character_desc"))
+    if book["character_desc"] is None:
+        problems["character_desc"] = "missing or empty"
+
+    scenes = data.get("scenes")
+    if not isinstance(scenes, list):
+        problems["scenes"] = "missing or not an array"
+        return book, problems
+
+    for scene in scenes:
+        # A scene without text can't be a page; its prompt is useless too
+        scene = scene if isinstance(scene, dict) else {}
+        text = _text(scene.get("text"))
+        if text is None:
+            book["dropped_scenes"] += 1
+            continue
+        book["scenes"].append({"text": text, "prompt": _text(scene.get("prompt"))})
+
+    if len(book["scenes"]) > max_scenes:
+        book["dropped_scenes"] += len(book["scenes"]) - max_scenes
+        del book["scenes"][max_scenes:]
+    if len(book["scenes"]) < min_scenes:
+        problems["scenes"] = f"{len(book['scenes'])} scenes with text, need {min_scenes}-{max_scenes}"
+        return book, problems
+
+    missing = [i for i, scene in enumerate(book["scenes"], 1) if scene["prompt"] is None]
+    if missing:
+        problems["prompts"] = missing
+    return book, problems
+
+
+def _merge_repair(book: dict, problems: dict, data) -> dict:
+    if not isinstance(data, dict):
+        return book
+    if "character_desc" in problems and _text(data.get("character_desc")):
+        book["character_desc"] = _text(data.get("character_desc"))
+    if "scenes" in problems:
+        repaired, repaired_problems = validate_one_shot({"character_desc": "-", "scenes": data.get("scenes")})
+        # Keep whichever scene list is more complete
+        if len(repaired["scenes"]) > len(book["scenes"]) or "scenes" not in repaired_problems:
+            book["scenes"] = repaired["scenes"]
+            book["dropped_scenes"] = repaired["dropped_scenes"]
+    elif "prompts" in problems and isinstance(data.get("prompts"), dict):
+        for i in problems["prompts"]:
+            prompt = _text(data["prompts"].get(str(i)))
+            if prompt is not None:
+                book["scenes"][i - 1]["prompt"] = prompt
+    return book
+
+
+class OneShotStory:
+    # The result of one_shot mode, with the same surface the storybook uses
+    # on a StoryStream (scenes, result(), report(), ...), plus the character
+    # description and one prompt per scene.
+
+    def __init__(self, character_desc: str, scenes: list[str], prompts: list[str], report: dict):
+        self.character_desc = character_desc
+        self.scenes = scenes
+        self.prompts = prompts
+        self.max_scenes = len(scenes)
+        self._report = report
+
+    @property
+    def text(self) -> str:
+        return " [SCENE_BREAK] ".join(self.scenes) + " [SCENE_BREAK]"
+
+    def done(self) -> bool:
+        return True
+
+    def result(self) -> str:
+        return self.text
+
+    def report(self) -> dict:
+        return dict(self._report)
+
+    def cancel(self):
+        pass
+
+
+async def a_generate_one_shot(
+    story_agent: Agent,
+    name: str,
+    age: int,
+    keywords: str,
+    style_preset: str,
+    prompt_agent: Agent | None = None,
+) -> OneShotStory:
+    # One JSON call for the whole book, then at most one repair call asking
+    # only for the fields that failed validation. Prompts still missing after
+    # that fall back to per-scene calls on prompt_agent, a missing character to
+    # the usual character call; too few scenes is an error.
+    with stage("one_shot") as span:
+        resp = await a_run_agent(story_agent, one_shot_prompt(name, age, keywords, style_preset), schema=ONE_SHOT_SCHEMA)
+        book, problems = validate_one_shot(parse_json_reply(resp.text))
+        repaired = sorted(problems)
+
+        if problems:
+            with stage("one_shot_repair", fields=",".join(repaired)):
+                prompt = one_shot_repair_prompt(name, age, keywords, style_preset, book, problems)
+                resp = await a_run_agent(story_agent, prompt, schema=ONE_SHOT_SCHEMA)
+                book = _merge_repair(book, problems, parse_json_reply(resp.text))
+            dropped = book["dropped_scenes"]
+            book, problems = validate_one_shot({
+                "character_desc": book["character_desc"],
+                "scenes": book["scenes"],
+            })
+            book["dropped_scenes"] += dropped
+
+        if "scenes" in problems and not book["scenes"]:
+            raise ValueError(f"One-shot generation returned no usable scenes ({problems['scenes']}).")
+        span.set("scenes", len(book["scenes"]))
+        span.set("repaired", ",".join(repaired))
+
+    character_desc = book["character_desc"]
+    if character_desc is None:
+        character_desc = await a_generate_character_desc(prompt_agent or story_agent, name, age, keywords)
+    else:
+        character_desc = sanitize(character_desc)
+
+    scenes = [sanitize(scene["text"]) for scene in book["scenes"]]
+    prompts = [scene["prompt"] and sanitize(scene["prompt"]) for scene in book["scenes"]]
+    missing = [i for i, prompt in enumerate(prompts) if prompt is None]
+    if missing:
+        if prompt_agent is None:
+            raise ValueError(f"One-shot generation left {len(missing)} scene prompts missing and no prompt_agent to write them.")
+        written = await asyncio.gather(*(
+            a_generate_image_prompt(prompt_agent, scenes[i], character_desc, style_preset) for i in missing
+        ))
+        for i, prompt in zip(missing, written):
+            prompts[i] = prompt
+
+    report = {
+        "mode": "one_shot",
+        "scenes": len(scenes),
+        "words": sum(len(scene.split()) for scene in scenes),
+        "dropped_scenes": book["dropped_scenes"],
+        "dropped_words": 0,
+        "below_min_scenes": len(scenes) < MIN_SCENES,
+        "repaired": repaired,
+        "fallback_prompts": len(missing),
+    }
+    return OneShotStory(character_desc, scenes, prompts, report)
+
+
+def generate_one_shot(
+    story_agent: Agent,
+    name: str,
+    age: int,
+    keywords: str,
+    style_preset: str,
+    prompt_agent: Agent | None = None,
+) -> OneShotStory:
+    return aio.run(a_generate_one_shot(story_agent, name, age, keywords, style_preset, prompt_agent))
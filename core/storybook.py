@@ -1,7 +1,5 @@
 #core/storybook.py
-import base64
 import json
-from io import BytesIO
 from pathlib import Path
 from datapizza.agents import Agent
 from diffusers import StableDiffusionPipeline
@@ -11,10 +9,24 @@ from .clients import *
 from .story import *
 from .images import *
 from .export import *
+from .media import build_media, gallery_html
+from .catalog import index_story
+from .tracing import stage, story_trace
+from .sanitizer import sanitize
 
 
+def write_story_record(story_out_dir: Path, story_record: dict):
+    story_json_path = story_out_dir / "story.json"
+    with stage("json"):
+        story_json_path.write_text(
+            json.dumps(story_record, ensure_ascii=False, indent=2),
+            encoding="utf-8",
+        )
+    with stage("catalog"):
+        index_story(story_record, story_json_path)
 
-def generate_storybook(
+
+def iter_storybook(
     story_agent: Agent,
     prompt_agent: Agent,
     pipe: StableDiffusionPipeline,
@@ -22,128 +34,174 @@ def generate_storybook(
     age: int,
     keywords: str,
     story_id: str,
+    seed: int | None = None,
+    generation_mode: str = GENERATION_MODE,
+    prompt_mode: str = PROMPT_MODE,
 ):
-    clean_keywords = sanitize_keywords(keywords)
+    # Event stream: one "scene" event per rendered illustration (in order), one
+    # "story" event once the whole text is in, then a "done" event with the same
+    # dict generate_storybook returns. In multi_call mode the story streams in
+    # while scenes render, so "story" may come after the first "scene" events,
+    # whose "total" is None until it does. prompt_mode "template" builds those
+    # scenes' SD prompts locally instead of one prompt-agent call per scene.
+    # Every stage is traced into timings.json.
+    if generation_mode not in GENERATION_MODES:
+        raise ValueError(f"Unknown generation mode {generation_mode!r}; expected one of {GENERATION_MODES}.")
+    if prompt_mode not in PROMPT_MODES:
+        raise ValueError(f"Unknown prompt mode {prompt_mode!r}; expected one of {PROMPT_MODES}.")
+    with story_trace(story_id) as trace:
+        events = _storybook_events(story_agent, prompt_agent, pipe, name, age, keywords, story_id, seed, generation_mode, prompt_mode)
+        for event in events:
+            if event["type"] == "done" and trace is not None:
+                trace.save(Path(OUT_DIR) / story_id / "timings.json")
+            yield event
 
-    character_desc = generate_character_desc(prompt_agent, name, age, clean_keywords)
-    story = generate_story(story_agent, name, age, clean_keywords)
 
-    scenes = [s.strip() for s in story.split("[SCENE_BREAK]") if s.strip()]
-    scenes = [s.replace("[SCENE_BREAK]", "").strip() for s in scenes]
+def _storybook_events(
+    story_agent: Agent,
+    prompt_agent: Agent,
+    pipe: StableDiffusionPipeline,
+    name: str,
+    age: int,
+    keywords: str,
+    story_id: str,
+    seed: int | None,
+    generation_mode: str,
+    prompt_mode: str,
+):
+    clean_keywords = sanitize(keywords)
 
-    MAX_CHARS_PER_SCENE = 300
-    normalized_scenes = []
-    for s in scenes:
-        if len(s) <= MAX_CHARS_PER_SCENE:
-            normalized_scenes.append(s)
-        else:
-            parts = [p.strip() for p in s.split(".") if p.strip()]
-            chunk = ""
-            for p in parts:
-                candidate = (chunk + " " + p + ".").strip()
-                if len(candidate) > MAX_CHARS_PER_SCENE and chunk:
-                    normalized_scenes.append(chunk)
-                    chunk = p + "."
-                else:
-                    chunk = candidate
-            if chunk:
-                normalized_scenes.append(chunk)
-
-    scenes = normalized_scenes[:15]
-    if len(scenes) == 0:
-        raise ValueError("No scenes generated. Check [SCENE_BREAK] formatting.")
+    if generation_mode == "one_shot":
+        # Character, scenes and every prompt from one JSON call (plus a repair
+        # call only if something came back missing)
+        story = generate_one_shot(story_agent, name, age, clean_keywords, STYLE_PRESET, prompt_agent)
+        yield from _render_storybook(story, story.character_desc, story.prompts, prompt_agent, pipe, name, age, keywords, story_id, seed, generation_mode, prompt_mode)
+        return
+
+    # The story streams in on the LLM loop while the character is described;
+    # each scene is handed to prompt writing and diffusion as soon as it is
+    # complete, long before the model has finished the last one.
+    story = StoryStream(story_agent, name, age, clean_keywords)
+    try:
+        character_desc = generate_character_desc(prompt_agent, name, age, clean_keywords)
+        yield from _render_storybook(story, character_desc, None, prompt_agent, pipe, name, age, keywords, story_id, seed, generation_mode, prompt_mode)
+    finally:
+        story.cancel()
+
+
+def _render_storybook(
+    story: "StoryStream | OneShotStory",
+    character_desc: str,
+    prompts: list[str] | None,
+    prompt_agent: Agent,
+    pipe: StableDiffusionPipeline,
+    name: str,
+    age: int,
+    keywords: str,
+    story_id: str,
+    seed: int | None,
+    generation_mode: str,
+    prompt_mode: str,
+):
+    # prompts: one per scene when they are already written (one_shot mode);
+    # otherwise they are built per prompt_mode as scenes arrive.
+
+    announced = False
+
+    def story_event():
+        return {
+            "type": "story",
+            "story_id": story_id,
+            "character_desc": character_desc,
+            "story": story.result(),
+            "scenes": list(story.scenes),
+        }
 
     story_out_dir = Path(OUT_DIR) / story_id
     story_out_dir.mkdir(parents=True, exist_ok=True)
 
-    slides_b64 = []
+    # One seed per scene, recorded in story.json so any slide can be re-rendered.
+    # The scene count may not be known yet, but it is capped.
+    base_seed = seed if seed is not None else new_seed()
+    seeds = [base_seed + i for i in range(story.max_scenes)]
+
+    assets = []
     prompts_used = []
     image_paths = []
 
-    for i, scene in enumerate(scenes, 1):
-        img, pr = generate_ai_illustration(
-            scene_text=scene,
+    # The first PDF variant is written page by page as scenes come in (the
+    # "(i/N)" counters are filled in on close); the others are built from the
+    # saved PNGs in worker processes at the end.
+    title = f"{name}'s AI Christmas Storybook"
+    pdf_base = story_out_dir / f"{name}_christmas_storybook.pdf"
+    variants = list(PDF_EXPORT_VARIANTS)
+    opts = PDF_VARIANTS[variants[0]]
+    pdf_paths = {v: variant_pdf_path(pdf_base, v) for v in variants}
+    pdf = StorybookPDF(
+        pdf_paths[variants[0]], title, total=None,
+        dpi=opts["dpi"], image_format=opts["image_format"], quality=opts["quality"],
+    )
+
+    if prompts is not None:
+        illustrations = iter_illustrations(prompts, pipe, seeds=seeds)
+    else:
+        illustrations = iter_ai_illustrations(
+            scene_texts=story,
             character_desc=character_desc,
             style_preset=STYLE_PRESET,
             prompt_agent=prompt_agent,
             pipe=pipe,
+            seeds=seeds,
+            prompt_mode=prompt_mode,
+            names=(name,),
         )
-        prompts_used.append(pr)
+
+    # Each image is PNG-encoded once, in the background. Its file is written as
+    # soon as that encode is done and before the scene is announced, so every
+    # image_path handed out exists, and a book that fails midway keeps the
+    # scenes it already rendered.
+    for i, asset in enumerate(illustrations, 1):
+        if not announced and story.done():
+            announced = True
+            yield story_event()
+
+        assets.append(asset)
+        prompts_used.append(asset.prompt)
+        scene = story.scenes[i - 1]
 
         img_path = story_out_dir / f"{i:02d}.png"
-        img.save(img_path)
-        #image_paths.append(str(img_path))
+        with stage("png_write", scene=i):
+            asset.save(img_path)
         image_paths.append(img_path.as_posix())
+        pdf.add_page(scene, asset.image)
 
-        buf = BytesIO()
-        img.save(buf, format="PNG")
-        slides_b64.append(base64.b64encode(buf.getvalue()).decode())
-
-
-    html = f"""
-    <style>
-      .container {{ max-width: 2400px; margin: 30px auto; padding: 0 20px; }}
-      .title {{ text-align: center; font-size: 36px; font-weight: bold; margin-bottom: 40px;
-                background: linear-gradient(135deg, #667eea, #764ba2); -webkit-background-clip: text;
-                -webkit-text-fill-color: transparent; }}
-      .grid {{ display: grid; grid-template-columns: repeat(4, 1fr); gap: 20px; }}
-      .card {{ position: relative; border-radius: 12px; overflow: hidden;
-               box-shadow: 0 8px 25px rgba(0,0,0,0.12); background: #fff; }}
-      .card img {{ width: 100%; height: auto; display: block; }}
-      .caption {{
-          position: absolute;
-          bottom: 0; left: 0; right: 0;
-          padding: 12px 16px;
-          color: #fff;
-          font-weight: 800;
-          font-size: 16px;
-          line-height: 1.3;
-          text-shadow:
-            -2px -2px 0 rgba(0,0,0,0.8),
-             2px -2px 0 rgba(0,0,0,0.8),
-            -2px  2px 0 rgba(0,0,0,0.8),
-             2px  2px 0 rgba(0,0,0,0.8);
-      }}
-      .counter {{
-          position: absolute;
-          bottom: 8px; right: 12px;
-          font-size: 14px; font-weight: 900;
-          color: #e6f5ff;
-          text-shadow:
-            -1px -1px 0 rgba(0,0,0,0.9),
-             1px -1px 0 rgba(0,0,0,0.9),
-            -1px  1px 0 rgba(0,0,0,0.9),
-             1px  1px 0 rgba(0,0,0,0.9);
-      }}
-      @media (max-width: 1600px) {{ .grid {{ grid-template-columns: repeat(3, 1fr); }} .caption {{ font-size: 15px; }} }}
-      @media (max-width: 1200px) {{ .grid {{ grid-template-columns: repeat(2, 1fr); }} .caption {{ font-size: 14px; }} }}
-      @media (max-width: 700px)  {{ .grid {{ grid-template-columns: 1fr; }} .caption {{ font-size: 13px; }} }}
-    </style>
-
-    <div class="container">
-      <div class="title">Personalized AI Story for {name}</div>
-      <div class="grid">
-        {''.join([f'''
-          <div class="card">
-            <img src="data:image/png;base64,{img}">
-            <div class="caption">
-              {scenes[i]}
-              <div class="counter">{i+1}/{len(slides_b64)}</div>
-            </div>
-          </div>
-        ''' for i, img in enumerate(slides_b64)])}
-      </div>
-    </div>
-    """
-
-
-    pdf_path = story_out_dir / f"{name}_christmas_storybook.pdf"
-    export_storybook_pdf(
-        pdf_path=str(pdf_path),
-        title=f"{name}'s AI Christmas Storybook",
-        scenes=scenes,
-        image_paths=image_paths,
-    )
+        yield {
+            "type": "scene",
+            "index": i,
+            "total": len(story.scenes) if announced else None,
+            "scene": scene,
+            "prompt": asset.prompt,
+            "seed": asset.seed,
+            "image": asset.image,
+            "image_path": img_path.as_posix(),
+        }
+
+    if not announced:
+        yield story_event()
+
+    scenes = list(story.scenes)
+    seeds = seeds[:len(scenes)]
+    story_text = story.result()
+
+    pdf.close()
+
+    if len(variants) > 1:
+        export_storybook_variants(str(pdf_base), title, scenes, image_paths, variants[1:])
+
+    # Thumbnails come from the in-memory images; the grid references them by URL
+    with stage("html"):
+        media = build_media(story_id, image_paths, images=[asset.image for asset in assets])
+        html = gallery_html(name, scenes, media)
 
     story_record = {
         "id": story_id,
@@ -152,23 +210,111 @@ def generate_storybook(
         "age": age,
         "keywords": keywords,
         "character_desc": character_desc,
-        "story": story,
+        "story": story_text,
         "scenes": scenes,
+        "segmentation": story.report(),
+        "generation_mode": generation_mode,
+        "prompt_mode": prompt_mode,
         "image_paths": image_paths,
+        "prompts": prompts_used,
+        "seeds": seeds,
+        "pdf_path": Path(pdf_paths[variants[0]]).as_posix(),
+        "pdf_paths": {v: Path(p).as_posix() for v, p in pdf_paths.items()},
     }
 
-    story_json_path = story_out_dir / "story.json"
-    story_json_path.write_text(
-        json.dumps(story_record, ensure_ascii=False, indent=2),
-        encoding="utf-8",
+    write_story_record(story_out_dir, story_record)
+
+    yield {
+        "type": "done",
+        "result": {
+            "character_desc": character_desc,
+            "story": story_text,
+            "scenes": scenes,
+            "image_paths": image_paths,
+            "html": html,
+            "prompts_used": prompts_used,
+            "seeds": seeds,
+        },
+    }
+
+
+def generate_storybook(
+    story_agent: Agent,
+    prompt_agent: Agent,
+    pipe: StableDiffusionPipeline,
+    name: str,
+    age: int,
+    keywords: str,
+    story_id: str,
+    seed: int | None = None,
+    generation_mode: str = GENERATION_MODE,
+    prompt_mode: str = PROMPT_MODE,
+):
+    for event in iter_storybook(
+        story_agent, prompt_agent, pipe, name, age, keywords, story_id,
+        seed=seed, generation_mode=generation_mode, prompt_mode=prompt_mode,
+    ):
+        if event["type"] == "done":
+            return event["result"]
+
+
+def regenerate_scene(
+    story_id: str,
+    index: int,
+    pipe: StableDiffusionPipeline,
+    prompt_agent: Agent | None = None,
+    seed: int | None = None,
+    new_prompt: bool = False,
+    prompt_mode: str = PROMPT_MODE,
+):
+    # Re-renders slide `index` (1-based, like 01.png) of a saved story with a
+    # new seed (or the given one), keeping the story text, the other images and,
+    # unless new_prompt is set, the stored diffusion prompt. A new prompt comes
+    # from prompt_agent, or from the local template with prompt_mode "template".
+    story_out_dir = Path(OUT_DIR) / story_id
+    story_record = json.loads((story_out_dir / "story.json").read_text(encoding="utf-8"))
+
+    scenes = story_record["scenes"]
+    if not 1 <= index <= len(scenes):
+        raise ValueError(f"Scene index must be between 1 and {len(scenes)}, got {index}.")
+
+    prompts = story_record.get("prompts") or [None] * len(scenes)
+    seeds = story_record.get("seeds") or [None] * len(scenes)
+
+    prompt = prompts[index - 1]
+    if new_prompt or prompt is None:
+        if prompt_mode == "template":
+            prompt = template_prompt(
+                scenes[index - 1], story_record["character_desc"], STYLE_PRESET, pipe, names=(story_record["name"],)
+            )
+        elif prompt_agent is None:
+            raise ValueError("A prompt_agent is required to write a new prompt for this scene.")
+        else:
+            prompt = generate_image_prompt(prompt_agent, scenes[index - 1], story_record["character_desc"], STYLE_PRESET)
+
+    seed = seed if seed is not None else new_seed()
+    asset = next(iter_illustrations([prompt], pipe, batch_size=1, seeds=[seed]))
+    img_path = story_out_dir / f"{index:02d}.png"
+    asset.save(img_path)
+    # A cache hit links a PNG that may predate this scene's thumbnails
+    build_media(story_id, [img_path], images=[asset.image], force=True)
+
+    prompts[index - 1] = prompt
+    seeds[index - 1] = seed
+    story_record["prompts"] = prompts
+    story_record["seeds"] = seeds
+
+    # The other pages come straight from the PNGs already on disk
+    pdf_base = story_out_dir / f"{story_record['name']}_christmas_storybook.pdf"
+    variants = list(story_record.get("pdf_paths") or PDF_EXPORT_VARIANTS)
+    export_storybook_variants(
+        str(pdf_base),
+        f"{story_record['name']}'s AI Christmas Storybook",
+        scenes,
+        story_record["image_paths"],
+        variants,
     )
 
+    write_story_record(story_out_dir, story_record)
+    return story_record
 
-    return {
-        "character_desc": character_desc,
-        "story": story,
-        "scenes": scenes,
-        "image_paths": image_paths,
-        "html": html,
-        "prompts_used": prompts_used,
-    }
@@ -0,0 +1,242 @@
+#core/tracing.py
+import contextvars
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+from .config import *
+
+# Every `with stage(name):` block is a span. Its duration goes to:
+#   - each active StageRecorder (benchmarks),
+#   - the current story's StoryTrace (saved as timings.json next to story.json),
+#   - an OpenTelemetry span when TRACING == "otel".
+# With none of those active a stage costs a couple of checks and yields a no-op
+# span. Stages may nest (e.g. text_encode inside diffusion) and run on several
+# threads at once, so their totals can add up to more than the wall time.
+_RECORDERS = []
+_LOCK = threading.Lock()
+_TRACE = contextvars.ContextVar("story_trace", default=None)
+_OTEL_TRACER = None
+
+
+def _otel():
+    global _OTEL_TRACER
+    if TRACING != "otel":
+        return None
+    if _OTEL_TRACER is None:
+        try:
+            from opentelemetry import trace
+        except ImportError as e:
+            raise ImportError("TRACING=otel needs `pip install opentelemetry-api` (plus an SDK/exporter).") from e
+        _OTEL_TRACER = trace.get_tracer("christmas-storybook")
+    return _OTEL_TRACER
+
+
+class StageRecorder:
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            entry = self.stages.setdefault(name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+            entry["count"] += 1
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                name: {
+                    "count": e["count"],
+                    "seconds": round(e["seconds"], 4),
+                    "mean_seconds": round(e["seconds"] / e["count"], 4),
+                    "max_seconds": round(e["max_seconds"], 4),
+                }
+                for name, e in self.stages.items()
+            }
+
+
+class StoryTrace:
+    # Every span of one storybook run, in the order they finished
+
+    def __init__(self, story_id: str):
+        self.story_id = story_id
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, start: float, seconds: float, attrs: dict):
+        span = {"name": name, "start": round(start - self.start, 4), "seconds": round(seconds, 4)}
+        if attrs:
+            span["attrs"] = attrs
+        with self._lock:
+            self.spans.append(span)
+
+    def report(self) -> dict:
+        recorder = StageRecorder()
+        llm = {"calls": 0, "cached": 0, "coalesced": 0, "seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            recorder.add(span["name"], span["seconds"])
+            if span["name"] == "llm_call":
+                attrs = span.get("attrs", {})
+                llm["calls"] += 1
+                llm["cached"] += int(bool(attrs.get("cached")))
+                llm["coalesced"] += int(bool(attrs.get("coalesced")))
+                llm["seconds"] += span["seconds"]
+                llm["prompt_tokens"] += attrs.get("prompt_tokens", 0)
+                llm["completion_tokens"] += attrs.get("completion_tokens", 0)
+        llm["seconds"] = round(llm["seconds"], 4)
+
+        return {
+            "story_id": self.story_id,
+            "started_at": self.started_at,
+            "total_seconds": round(time.perf_counter() - self.start, 4),
+            "stages": recorder.report(),
+            "llm": llm,
+            "spans": spans,
+        }
+
+    def save(self, path: Path):
+        Path(path).write_text(json.dumps(self.report(), ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+class Span:
+    __slots__ = ("attrs", "_otel")
+
+    def __init__(self, attrs: dict, otel_span=None):
+        self.attrs = attrs
+        self._otel = otel_span
+
+    def set(self, key: str, value):
+        self.attrs[key] = value
+        if self._otel is not None:
+            self._otel.set_attribute(key, value)
+
+
+class _NoopSpan:
+    def set(self, key: str, value):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+def tracing_active() -> bool:
+    return bool(_RECORDERS) or _TRACE.get() is not None or TRACING == "otel"
+
+
+def _finish(name: str, start: float, seconds: float, attrs: dict, trace: StoryTrace | None):
+    for recorder in list(_RECORDERS):
+        recorder.add(name, seconds)
+    if trace is not None:
+        trace.add(name, start, seconds, attrs)
+
+
+@contextmanager
+def stage(name: str, **attrs):
+    trace = _TRACE.get()
+    tracer = _otel()
+    if not _RECORDERS and trace is None and tracer is None:
+        yield _NOOP
+        return
+
+    otel_cm = tracer.start_as_current_span(name, attributes=attrs) if tracer is not None else nullcontext()
+    with otel_cm as otel_span:
+        span = Span(dict(attrs), otel_span)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            _finish(name, start, time.perf_counter() - start, span.attrs, trace)
+
+
+def record(name: str, seconds: float, **attrs):
+    # For durations measured elsewhere (e.g. in a diffusers step callback) that just ended
+    trace = _TRACE.get()
+    tracer = _otel()
+    end = time.perf_counter()
+    _finish(name, end - seconds, seconds, attrs, trace)
+    if tracer is not None:
+        end_ns = time.time_ns()
+        span = tracer.start_span(name, attributes=attrs, start_time=end_ns - int(seconds * 1e9))
+        span.end(end_time=end_ns)
+
+
+def step_timer():
+    # diffusers callback_on_step_end recording one "diffusion_step" per step.
+    # Call finish() when the pipeline returns: the time since the last step is
+    # the VAE decode (plus image post-processing).
+    if not tracing_active():
+        return None
+    last = [time.perf_counter()]
+
+    def on_step_end(pipeline, step, timestep, callback_kwargs):
+        now = time.perf_counter()
+        record("diffusion_step", now - last[0], step=step)
+        last[0] = now
+        return callback_kwargs
+
+    def finish():
+        record("vae_decode", time.perf_counter() - last[0])
+
+    on_step_end.finish = finish
+    return on_step_end
+
+
+def bind(fn):
+    # Thread pools don't inherit context variables; wrap fn at submit time so
+    # its spans land in the submitting story's trace.
+    ctx = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return ctx.run(fn, *args, **kwargs)
+
+    return run
+
+
+@contextmanager
+def story_trace(story_id: str):
+    # Makes every stage() in this context (and in bind()-wrapped pool work) part
+    # of one StoryTrace. Yields None when TRACING is "off".
+    if TRACING == "off":
+        yield None
+        return
+
+    trace = StoryTrace(story_id)
+    token = _TRACE.set(trace)
+    try:
+        with stage("storybook", story_id=story_id):
+            yield trace
+    finally:
+        # iter_storybook is a generator: if it is closed from another context
+        # the token can't be reset there, so just clear the variable
+        try:
+            _TRACE.reset(token)
+        except ValueError:
+            _TRACE.set(None)
+
+
+@contextmanager
+def recording():
+    recorder = StageRecorder()
+    with _LOCK:
+        _RECORDERS.append(recorder)
+    try:
+        yield recorder
+    finally:
+        with _LOCK:
+            _RECORDERS.remove(recorder)
+
+
+def load_timings(story_dir: Path) -> dict | None:
+    path = Path(story_dir) / "timings.json"
+    if not path.exists():
+        return None
+    return json.loads(path.read_text(encoding="utf-8"))
@@ -1,7 +1,9 @@
-import json
+import math
 from pathlib import Path
 import streamlit as st
-import base64
+from core.catalog import count_stories, index_missing, load_story, rebuild_catalog, search_stories
+from core.media import build_media, gallery_html
+from core.tracing import load_timings
 
 BASE_DIR = Path(__file__).resolve().parents[1]
 OUT_DIR = BASE_DIR / "outputs"
@@ -19,28 +21,43 @@ if not OUT_DIR.exists():
     st.info("No stories saved yet.")
     st.stop()
 
-story_files = sorted(OUT_DIR.glob("*/story.json"), reverse=True)
-options = []
-records = []
-for path in story_files:
-    with open(path, encoding="utf-8") as f:
-        data = json.load(f)
-    records.append(data)
-    
-    title = data.get(
-        "display_title",
-        f"{data['name']} ({data['age']} y) – {path.stem}",
-    )
-    options.append(title)
+PAGE_SIZE = 25
 
-if not options:
-    st.info("No stories saved yet.")
+
+# Stories on disk that the catalog doesn't know yet (written before it
+# existed, or copied in) are indexed once per process; new books are indexed
+# by write_story_record and anything copied in later by the rebuild button
+@st.cache_resource
+def _backfill_catalog():
+    index_missing(OUT_DIR)
+
+
+_backfill_catalog()
+
+if st.sidebar.button("Rebuild story index"):
+    st.sidebar.success(f"Indexed {rebuild_catalog(OUT_DIR)} stories.")
+
+query = st.text_input("Search", placeholder="Name, themes or words from the story")
+total = count_stories(query)
+
+if total == 0:
+    st.info("No stories match your search." if query.strip() else "No stories saved yet.")
     st.stop()
 
-selected = st.selectbox("Select a storybook", options)
+pages = math.ceil(total / PAGE_SIZE)
+page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1) if pages > 1 else 1
+rows = search_stories(query, limit=PAGE_SIZE, offset=(page - 1) * PAGE_SIZE)
+
+selected = st.selectbox(
+    f"Select a storybook ({total} found)",
+    rows,
+    format_func=lambda row: row["display_title"],
+)
 
-idx = options.index(selected)
-data = records[idx]
+data = load_story(selected["id"])
+if data is None:
+    st.warning("This story's files are missing; use 'Rebuild story index' in the sidebar.")
+    st.stop()
 
 
 st.subheader("Story info")
@@ -63,9 +80,23 @@ with col2:
     story_text = data["story"].replace("[SCENE_BREAK]", "\n")
     st.write(story_text)
 
+# Written by iter_storybook next to story.json (older stories have none)
+timings = load_timings(Path(selected["path"]).parent)
+if timings:
+    with st.expander(f"Timing breakdown ({timings['total_seconds']:.1f} s)"):
+        llm = timings["llm"]
+        st.caption(
+            f"LLM: {llm['calls']} calls ({llm['cached']} cached), {llm['seconds']:.1f} s, "
+            f"{llm['prompt_tokens']} prompt + {llm['completion_tokens']} completion tokens"
+        )
+        st.table([
+            {"stage": name, "count": s["count"], "total s": s["seconds"], "mean s": s["mean_seconds"], "max s": s["max_seconds"]}
+            for name, s in sorted(timings["stages"].items(), key=lambda kv: -kv[1]["seconds"])
+        ])
+
 st.divider()
 
-slides_b64 = []
+image_paths = []
 for img_path in data["image_paths"]:
     #full_path = (BASE_DIR / img_path).resolve()
     full_path = (BASE_DIR / Path(img_path)).resolve()
@@ -74,67 +105,13 @@ for img_path in data["image_paths"]:
         st.write(f"resolved full_path: {full_path}")
         continue  
         
-    with open(full_path, "rb") as f:
-        b = f.read()
-    slides_b64.append(base64.b64encode(b).decode())
+    image_paths.append(full_path)
 
 name = data["name"]
 scenes = data["scenes"]
 
-html = f"""
-<style>
-  .container {{ max-width: 2400px; margin: 30px auto; padding: 0 20px; }}
-  .title {{ text-align: center; font-size: 36px; font-weight: bold; margin-bottom: 40px;
-            background: linear-gradient(135deg, #667eea, #764ba2); -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent; }}
-  .grid {{ display: grid; grid-template-columns: repeat(4, 1fr); gap: 20px; }}
-  .card {{ position: relative; border-radius: 12px; overflow: hidden;
-           box-shadow: 0 8px 25px rgba(0,0,0,0.12); background: #fff; }}
-  .card img {{ width: 100%; height: auto; display: block; }}
-  .caption {{
-      position: absolute;
-      bottom: 0; left: 0; right: 0;
-      padding: 12px 16px;
-      color: #fff;
-      font-weight: 800;
-      font-size: 16px;
-      line-height: 1.3;
-      text-shadow:
-        -2px -2px 0 rgba(0,0,0,0.8),
-         2px -2px 0 rgba(0,0,0,0.8),
-        -2px  2px 0 rgba(0,0,0,0.8),
-         2px  2px 0 rgba(0,0,0,0.8);
-  }}
-  .counter {{
-      position: absolute;
-      bottom: 8px; right: 12px;
-      font-size: 14px; font-weight: 900;
-      color: #e6f5ff;
-      text-shadow:
-        -1px -1px 0 rgba(0,0,0,0.9),
-         1px -1px 0 rgba(0,0,0,0.9),
-        -1px  1px 0 rgba(0,0,0,0.9),
-         1px  1px 0 rgba(0,0,0,0.9);
-  }}
-  @media (max-width: 1600px) {{ .grid {{ grid-template-columns: repeat(3, 1fr); }} .caption {{ font-size: 15px; }} }}
-  @media (max-width: 1200px) {{ .grid {{ grid-template-columns: repeat(2, 1fr); }} .caption {{ font-size: 14px; }} }}
-  @media (max-width: 700px)  {{ .grid {{ grid-template-columns: 1fr; }} .caption {{ font-size: 13px; }} }}
-</style>
-
-<div class="container">
-  <div class="title">Personalized AI Story for {name}</div>
-  <div class="grid">
-    {''.join([f'''
-      <div class="card">
-        <img src="data:image/png;base64,{img}">
-        <div class="caption">
-          {scenes[i]}
-          <div class="counter">{i+1}/{len(slides_b64)}</div>
-        </div>
-      </div>
-    ''' for i, img in enumerate(slides_b64)])}
-  </div>
-</div>
-"""
+# Thumbnails are generated once per story and served as static files
+media = build_media(data["id"], image_paths)
+html = gallery_html(name, scenes, media)
 
 st.components.v1.html(html, height=3000, scrolling=True)
@@ -0,0 +1,18 @@
+#tests/conftest.py
+import json
+from pathlib import Path
+
+import pytest
+
+
+@pytest.fixture
+def write_story():
+    # Writes an outputs/<id>/story.json the way generate_storybook does
+    def write(out_dir: Path, story_id: str, name: str, keywords: str, story: str) -> Path:
+        path = Path(out_dir) / story_id / "story.json"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        record = {"id": story_id, "name": name, "age": 6, "keywords": keywords, "story": story}
+        path.write_text(json.dumps(record), encoding="utf-8")
+        return path
+
+    return write
@@ -0,0 +1,33 @@
+#tests/test_cache.py
+import os
+
+from core.cache import ImageCache
+
+
+def test_overwrite_counts_the_new_size_once(tmp_path):
+    cache = ImageCache(tmp_path / "images", max_bytes=10_000)
+    cache.put_bytes("aa01", b"x" * 100)
+    assert cache.stats()["bytes"] == 100
+    cache.put_bytes("aa01", b"x" * 150)
+    cache.put_bytes("bb02", b"x" * 50)
+    assert cache.stats()["bytes"] == 200
+    assert cache.stats()["evictions"] == 0
+
+
+def test_hits_keep_entries_without_touching_linked_files(tmp_path):
+    cache = ImageCache(tmp_path / "images", max_bytes=250)
+    cache.put_bytes("aa01", b"a" * 100)
+    cache.put_bytes("bb02", b"b" * 100)
+
+    story_png = tmp_path / "01.png"
+    assert cache.link("aa01", story_png)
+    os.utime(story_png, (1_000_000, 1_000_000))
+
+    assert cache.get_bytes("aa01") == b"a" * 100
+    assert story_png.stat().st_mtime == 1_000_000
+
+    # "bb02" is now the least recently used one
+    cache.put_bytes("cc03", b"c" * 100)
+    assert cache.get_bytes("bb02") is None
+    assert cache.get_bytes("aa01") is not None
+    assert cache.stats()["bytes"] == 200
@@ -0,0 +1,27 @@
+#tests/test_catalog.py
+import json
+
+import pytest
+
+from core import catalog
+
+
+@pytest.fixture(autouse=True)
+def catalog_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, "CATALOG_PATH", tmp_path / "catalog.sqlite3")
+
+
+def test_index_missing_adds_unindexed_stories_next_to_indexed_ones(tmp_path, write_story):
+    out_dir = tmp_path / "outputs"
+    new = write_story(out_dir, "new00001", "Ada", "snow, sled", "Ada rode the sled.")
+    write_story(out_dir, "old00001", "Milo", "reindeer, cocoa", "Milo met a reindeer.")
+    catalog.index_story(json.loads(new.read_text(encoding="utf-8")), new)
+    assert catalog.count_stories() == 1
+
+    assert catalog.index_missing(out_dir) == 1
+    assert catalog.count_stories() == 2
+    assert [s["id"] for s in catalog.search_stories("reindeer")] == ["old00001"]
+    assert catalog.load_story("old00001")["name"] == "Milo"
+
+    # Nothing left to add on the next page load
+    assert catalog.index_missing(out_dir) == 0
@@ -0,0 +1,99 @@
+#tests/test_devices.py
+import functools
+import os
+import signal
+import time
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+pytest.importorskip("transformers")
+
+from benchmarks.fakes import tiny_pipeline
+from core.devices import DevicePool
+from core.tracing import recording
+
+SIZE = {"width": 128, "height": 128}
+
+
+def _prompts(tag: str) -> list[str]:
+    return [f"{tag} scene {i}: a {w} in the snow" for i, w in enumerate("fox owl sled elf cocoa bell".split())]
+
+
+def _wait(condition, timeout: float = 120.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("timed out waiting for the pool")
+
+
+@pytest.fixture(scope="module")
+def pool(tmp_path_factory):
+    # Two CPU replicas, each building the same tiny SDXL in its own process.
+    # They inherit the working directory, so their image cache starts empty.
+    workdir = tmp_path_factory.mktemp("pool")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with DevicePool(["cpu", "cpu"], factory=functools.partial(tiny_pipeline, workdir, 0, "fast"), heartbeat_seconds=0.2) as pool:
+            yield pool
+    finally:
+        os.chdir(cwd)
+
+
+def _all_ready(pool: DevicePool) -> bool:
+    return all(h["ready"] for h in pool.health())
+
+
+def test_scenes_are_sharded_across_replicas_and_come_back_in_order(pool):
+    prompts = _prompts("shard")
+
+    def feed():
+        # With both replicas free, the first two scenes go to different ones
+        _wait(lambda: _all_ready(pool))
+        yield from prompts
+
+    before = {h["slot"]: h["rendered"] for h in pool.health()}
+    assets = list(pool.iter_illustrations(feed(), seeds=list(range(len(prompts))), **SIZE))
+
+    assert [a.prompt for a in assets] == prompts
+    assert [a.seed for a in assets] == list(range(len(prompts)))
+    assert all(a.png.startswith(b"\x89PNG") for a in assets)
+    rendered = {h["slot"]: h["rendered"] - before[h["slot"]] for h in pool.health()}
+    assert sum(rendered.values()) == len(prompts)
+    assert all(n > 0 for n in rendered.values())
+
+
+def test_scene_is_requeued_when_its_replica_is_killed(pool):
+    prompts = _prompts("kill")
+    killed = []
+
+    def kill_busy() -> bool:
+        # Kills a replica in the middle of scene 0 or 1
+        with pool._lock:
+            for state in pool._slots:
+                if state["task"] is not None and state["proc"].is_alive():
+                    killed.append(state["task"][0][1])
+                    os.kill(state["proc"].pid, signal.SIGKILL)
+                    return True
+        return False
+
+    def feed():
+        _wait(lambda: _all_ready(pool))
+        for i, prompt in enumerate(prompts):
+            if i == 2:
+                _wait(kill_busy)
+            yield prompt
+
+    with recording() as recorder:
+        assets = list(pool.iter_illustrations(feed(), seeds=list(range(100, 100 + len(prompts))), **SIZE))
+
+    assert killed
+    assert [a.prompt for a in assets] == prompts
+    report = recorder.report()
+    assert report["device_restart"]["count"] == 1
+    assert report["device_render"]["count"] == len(prompts)
+    assert sum(h["restarts"] for h in pool.health()) == 1
@@ -0,0 +1,76 @@
+#tests/test_images.py
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+pytest.importorskip("datapizza")
+
+from types import SimpleNamespace
+
+import numpy as np
+from PIL import Image
+
+from core.images import iter_illustrations, scene_features, template_prompt
+
+
+class ExportedPipeline:
+    # Stands in for an optimum ORT/OpenVINO pipeline: prompts and numpy
+    # generators only, no embeddings, callbacks or torch generators
+    exported_backend = "onnx"
+    quality_preset = "fast"
+    name_or_path = "tiny/exported"
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, prompt, negative_prompt, height, width, num_inference_steps, guidance_scale, generator):
+        assert isinstance(generator, np.random.RandomState)
+        self.calls.append({"prompt": prompt, "negative_prompt": negative_prompt, "seed_draw": generator.randint(2**31)})
+        return SimpleNamespace(images=[Image.new("RGB", (width, height)) for _ in prompt])
+
+
+def test_noun_phrase_is_kept_whole_and_honorific_stays_with_its_name():
+    features = scene_features("Mrs. Claus gave Ada a warm cup of hot cocoa in the cozy kitchen.", names=("Ada",))
+    assert features["action"] == "mrs claus gave a warm cup of hot cocoa"
+    assert features["setting"] == "in the cozy kitchen"
+    assert not any("mrs" in d or "cocoa" in d for d in features["details"])
+
+
+def test_phrase_ends_at_a_clause_break():
+    features = scene_features("The little dog built a big snowman in the snowy park while Ada laughed.", names=("Ada",))
+    assert features["action"] == "little dog built a big snowman"
+    assert features["setting"] == "in the snowy park"
+
+
+def test_irregular_verb_is_the_action_not_a_detail():
+    features = scene_features("Ada woke up early on Christmas morning. She ran to the window and saw snow everywhere.", names=("Ada",))
+    assert features["action"] == "woke up early"
+    assert "woke" not in " ".join(features["details"])
+
+
+def test_named_honorific_is_left_out_with_the_name():
+    features = scene_features("Later Mr. Frost waved from the sleigh.", names=())
+    assert "mr" not in features["action"].split()
+    assert "frost" not in features["action"]
+
+
+def test_template_prompt_keeps_whole_phrases():
+    prompt = template_prompt(
+        "Mrs. Claus gave Ada a warm cup of hot cocoa in the cozy kitchen.",
+        "a girl with red mittens, green scarf",
+        "watercolor storybook illustration, warm light",
+        names=("Ada",),
+    )
+    assert prompt.startswith("mrs claus gave a warm cup of hot cocoa in the cozy kitchen, ")
+    assert "Ada" not in prompt
+
+
+def test_exported_pipelines_render_through_plain_prompts_with_numpy_seeds():
+    pipe = ExportedPipeline()
+    assets = list(iter_illustrations(["a fox", "an owl"], pipe, width=64, height=64, cache=None, seeds=[3, 4]))
+
+    assert [a.prompt for a in assets] == ["a fox", "an owl"]
+    # One scene per call, each with its own seed
+    assert [c["prompt"] for c in pipe.calls] == [["a fox"], ["an owl"]]
+    assert [c["seed_draw"] for c in pipe.calls] == [np.random.RandomState(s).randint(2**31) for s in (3, 4)]
+    assert all(c["negative_prompt"] for c in pipe.calls)
@@ -0,0 +1,73 @@
+#tests/test_jobs.py
+import sqlite3
+import time
+from contextlib import closing
+
+import pytest
+
+from core import jobs
+
+
+@pytest.fixture(autouse=True)
+def jobs_db(tmp_path, monkeypatch):
+    path = tmp_path / "jobs.sqlite3"
+    monkeypatch.setattr(jobs, "JOBS_DB_PATH", path)
+    return path
+
+
+def _kill_worker(story_id: str):
+    # The worker stops heartbeating long enough ago to count as dead
+    jobs._update_job(story_id)
+    with closing(sqlite3.connect(jobs.JOBS_DB_PATH)) as conn, conn:
+        conn.execute("UPDATE jobs SET heartbeat = ? WHERE story_id = ?", (time.time() - 3600, story_id))
+
+
+def test_jobs_record_a_key_reference_not_the_key(jobs_db):
+    story_id = jobs.submit_job("Ada", 6, "snow", key_env="GROQ_API_KEY_TEAM_A")
+
+    job = jobs.claim_job("worker")
+    assert job["key_env"] == "GROQ_API_KEY_TEAM_A"
+    assert "groq_api_key" not in job
+    assert job["story_id"] == story_id
+
+
+def test_key_references_must_name_a_groq_key_variable():
+    with pytest.raises(ValueError, match="key variable"):
+        jobs.submit_job("Ada", 6, "snow", key_env="HF_TOKEN")
+
+
+def test_stale_jobs_fail_after_max_attempts():
+    story_id = jobs.submit_job("Ada", 6, "snow")
+
+    for attempt in range(1, 3):
+        assert jobs.claim_job(f"worker-{attempt}")["story_id"] == story_id
+        _kill_worker(story_id)
+        assert jobs.requeue_stale_jobs(max_attempts=3) == 1
+        assert jobs.job_status(story_id)["status"] == "queued"
+
+    # The last allowed attempt dies too: the job is failed, not requeued
+    jobs.claim_job("worker-3")
+    _kill_worker(story_id)
+    assert jobs.requeue_stale_jobs(max_attempts=3) == 0
+    job = jobs.job_status(story_id)
+    assert job["status"] == "failed"
+    assert job["attempts"] == 3
+    assert jobs.claim_job("worker-4") is None
+
+
+def test_old_queues_are_migrated_and_their_keys_cleared(jobs_db):
+    with closing(sqlite3.connect(jobs_db)) as conn, conn:
+        conn.execute(
+            "CREATE TABLE jobs (story_id TEXT PRIMARY KEY, status TEXT NOT NULL, params TEXT NOT NULL, groq_api_key TEXT, "
+            "progress INTEGER NOT NULL DEFAULT 0, total INTEGER, error TEXT, worker TEXT, created REAL NOT NULL, "
+            "started REAL, finished REAL, heartbeat REAL)"
+        )
+        conn.execute("INSERT INTO jobs (story_id, status, params, groq_api_key, created) VALUES ('old', 'queued', '{}', 'gsk_secret', 0)")
+
+    job = jobs.claim_job("worker")
+
+    assert job["key_env"] == "GROQ_API_KEY"
+    assert job["attempts"] == 0
+    assert job["groq_api_key"] is None
+    with closing(sqlite3.connect(jobs_db)) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM jobs WHERE groq_api_key IS NOT NULL").fetchone()[0] == 0
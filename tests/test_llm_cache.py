@@ -0,0 +1,133 @@
+#tests/test_llm_cache.py
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("datapizza")
+
+from core import llm_cache
+from core.llm_cache import CachedAgent, LLMCache, response_format
+
+SCHEMA = {"title": "book", "type": "object", "properties": {"story": {"type": "string"}}}
+
+
+class FakeAgent:
+    name = "story"
+    system_prompt = "You write stories."
+
+    async def a_run(self, task_input, **kwargs):
+        raise AssertionError("schema calls go to the client")
+
+
+class SlowAgent(FakeAgent):
+    # Answers only once release is set, so identical calls overlap
+    def __init__(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def a_run(self, task_input, **kwargs):
+        self.calls += 1
+        await self.release.wait()
+        return SimpleNamespace(text=f"answer to {task_input}", usage=None)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Frozen time.time() for llm_cache; advance with clock[0] += seconds
+    now = [1_000_000.0]
+    monkeypatch.setattr(llm_cache, "time", SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+class FakeClient:
+    # Records every a_invoke call, like a client that forwards extra kwargs
+    def __init__(self):
+        self.calls = []
+
+    async def a_invoke(self, input, system_prompt=None, **kwargs):
+        self.calls.append({"input": input, "system_prompt": system_prompt, **kwargs})
+        return SimpleNamespace(text='{"story": "Once"}', usage=None)
+
+
+class StrictClient(FakeClient):
+    # A client whose a_invoke has no response_format keyword
+    async def a_invoke(self, input, system_prompt=None):
+        return await super().a_invoke(input, system_prompt=system_prompt)
+
+
+def _agent(client) -> CachedAgent:
+    return CachedAgent(FakeAgent(), "model", cache=None, client=client)
+
+
+def test_schema_requests_send_the_response_format():
+    client = FakeClient()
+    resp = asyncio.run(_agent(client).a_run("Write a story", schema=SCHEMA))
+
+    assert resp.text == '{"story": "Once"}'
+    assert client.calls == [{"input": "Write a story", "system_prompt": "You write stories.", "response_format": response_format(SCHEMA)}]
+
+
+def test_clients_without_response_format_fall_back_to_a_plain_call():
+    client = StrictClient()
+    agent = _agent(client)
+
+    first = asyncio.run(agent.a_run("Write a story", schema=SCHEMA))
+    second = asyncio.run(agent.a_run("Write another", schema=SCHEMA))
+
+    assert first.text == second.text == '{"story": "Once"}'
+    assert not agent.response_format_supported
+    assert client.calls == [
+        {"input": "Write a story", "system_prompt": "You write stories."},
+        {"input": "Write another", "system_prompt": "You write stories."},
+    ]
+
+
+def test_entries_expire_after_the_ttl(tmp_path, clock):
+    cache = LLMCache(tmp_path / "llm.sqlite3", ttl_seconds=60, max_entries=10)
+    cache.put("k", "story", "Once")
+
+    clock[0] += 59
+    assert cache.get("k") == "Once"
+    clock[0] += 2
+    assert cache.get("k") is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 0, "max_entries": 10}
+
+
+def test_least_recently_used_entries_go_first(tmp_path, clock):
+    cache = LLMCache(tmp_path / "llm.sqlite3", ttl_seconds=3600, max_entries=2)
+    cache.put("a", "story", "A")
+    clock[0] += 1
+    cache.put("b", "story", "B")
+    clock[0] += 1
+    assert cache.get("a") == "A"
+    clock[0] += 1
+    cache.put("c", "story", "C")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "A"
+    assert cache.get("c") == "C"
+    assert cache.stats()["entries"] == 2
+
+
+def test_identical_concurrent_calls_share_one_request(tmp_path):
+    cache = LLMCache(tmp_path / "llm.sqlite3", ttl_seconds=3600, max_entries=10)
+    inner = SlowAgent()
+    agent = CachedAgent(inner, "model", cache)
+
+    async def both():
+        calls = [asyncio.create_task(agent.a_run("Write a story")) for _ in range(2)]
+        while agent.coalesced == 0:
+            await asyncio.sleep(0.01)
+        inner.release.set()
+        return await asyncio.gather(*calls)
+
+    first, second = asyncio.run(asyncio.wait_for(both(), 10))
+
+    assert inner.calls == 1
+    assert first.text == second.text == "answer to Write a story"
+    # The shared answer came off the network, not out of the cache
+    shared = second if getattr(second, "coalesced", False) else first
+    assert shared.coalesced and not shared.cached
+    assert cache.stats()["hits"] == 0
+    assert cache.get(llm_cache.llm_cache_key("story", inner.system_prompt, "model", "Write a story")) == first.text
@@ -0,0 +1,29 @@
+#tests/test_media.py
+import os
+
+from PIL import Image
+
+from core import media
+
+
+def _png(path, color, mtime):
+    Image.new("RGB", (64, 96), color).save(path)
+    os.utime(path, (mtime, mtime))
+
+
+def _thumb_color(story_id, stem):
+    with Image.open(media.MEDIA_DIR / story_id / f"{stem}_{media.THUMB_WIDTHS[0]}.webp") as thumb:
+        return thumb.convert("RGB").getpixel((0, 0))
+
+
+def test_forced_rebuild_replaces_thumbnails_newer_than_the_png(tmp_path, monkeypatch):
+    monkeypatch.setattr(media, "MEDIA_DIR", tmp_path / "media")
+    png = tmp_path / "01.png"
+    _png(png, (255, 0, 0), 2_000_000_000)
+    media.build_media("s1", [png])
+
+    # A re-rendered scene linked from the image cache: new pixels, old mtime
+    _png(png, (0, 0, 255), 1_000_000_000)
+    media.build_media("s1", [png], force=True)
+    red, _, blue = _thumb_color("s1", "01")
+    assert blue > 200 and red < 50
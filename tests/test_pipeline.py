@@ -0,0 +1,47 @@
+#tests/test_pipeline.py
+import threading
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from core import pipeline
+
+
+def test_unknown_profile_is_a_value_error():
+    with pytest.raises(ValueError, match="memory profile"):
+        pipeline.get_pipeline(profile="no-such-profile", device="cpu")
+
+
+def test_loads_of_different_pipelines_do_not_wait_for_each_other(monkeypatch):
+    slow_started = threading.Event()
+    release = threading.Event()
+
+    def build_pipeline(hf_token, model_id, device, dtype, profile, lora, backend):
+        if model_id == "slow":
+            slow_started.set()
+            assert release.wait(10)
+        return object()
+
+    monkeypatch.setattr(pipeline, "build_pipeline", build_pipeline)
+    monkeypatch.setattr(pipeline, "evict_pipelines", lambda **kwargs: 0)
+    monkeypatch.setattr(pipeline, "_PIPELINES", {})
+
+    def load(model_id):
+        key = (model_id, "float32", "cpu", "balanced", None, "eager")
+        return pipeline._load(key, None, model_id, "cpu", None, "balanced")
+
+    slow = threading.Thread(target=load, args=("slow",))
+    slow.start()
+    try:
+        assert slow_started.wait(10)
+        # Would block behind "slow" with a single global load lock
+        fast = threading.Thread(target=load, args=("fast",))
+        fast.start()
+        fast.join(5)
+        assert not fast.is_alive()
+    finally:
+        release.set()
+        slow.join(10)
+    assert set(k[0] for k in pipeline._PIPELINES) == {"slow", "fast"}